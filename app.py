@@ -1,11 +1,23 @@
-from flask import Flask, request, render_template, jsonify
+from flask import Flask, Response, request, render_template, jsonify, stream_with_context, url_for, g
+import io
 import os
-import boto3
+import json
+import uuid
+import zipfile
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import logging
 import traceback
-from pdf_utils import parse_pdf
-from summarization import generate_summary, extract_keywords
-from mongodb_utils import insert_metadata, update_document, update_document_error
+from pdf_utils import analyze_pdf
+from summarization import summarize_text, load_sentence_tokenizer
+from result_cache import get_result_cache
+from near_duplicates import signature_for_text, link_near_duplicate
+from mongodb_utils import insert_metadata, update_document, update_document_error, ensure_indexes
+from mongodb_utils import create_job, update_job_status, get_job, JOB_TERMINAL_STATUSES
+from metrics import track_stage, stage_in_flight, record_timings, count_document, timings_breakdown
+from metrics import request_started, request_finished, render_metrics, start_profiler, finish_profiler
 from dotenv import load_dotenv
 import time
 
@@ -14,71 +26,504 @@ load_dotenv()
 
 app = Flask(__name__)
 
-# AWS S3 setup
-s3_client = boto3.client(
-    's3',
-    aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-    aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
-    region_name=os.getenv('AWS_REGION')
-)
+# AWS S3 setup (S3_ENDPOINT_URL points at a local stand-in such as moto or MinIO).
+# boto3 is imported and the client created on first upload: see get_s3_client
 bucket_name = os.getenv('S3_BUCKET_NAME')
 
+# Uploads up to UPLOAD_SPOOL_MEMORY_BYTES are kept in memory, larger ones in a temp file;
+# S3 switches to a multipart upload above S3_MULTIPART_THRESHOLD
+UPLOAD_SPOOL_MEMORY_BYTES = int(os.getenv('UPLOAD_SPOOL_MEMORY_BYTES', str(8 * 1024 * 1024)))
+S3_MULTIPART_THRESHOLD = int(os.getenv('S3_MULTIPART_THRESHOLD', str(16 * 1024 * 1024)))
+S3_MULTIPART_CHUNKSIZE = int(os.getenv('S3_MULTIPART_CHUNKSIZE', str(8 * 1024 * 1024)))
+S3_UPLOAD_WORKERS = int(os.getenv('S3_UPLOAD_WORKERS', '8'))
+
+# Load the sentence tokenizer at import instead of on the first request; worth
+# it with gunicorn --preload, where forked workers share the loaded model
+PRELOAD_MODELS = os.getenv('PRELOAD_MODELS', '').lower() in ('1', 'true', 'yes')
+if PRELOAD_MODELS:
+    load_sentence_tokenizer()
+
 # Logging setup
 logging.basicConfig(filename='app_errors.log', level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Background job settings
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '4'))
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '0.5'))
+JOB_MAX_WAIT = float(os.getenv('JOB_MAX_WAIT', '30'))
+JOB_STREAM_TIMEOUT = float(os.getenv('JOB_STREAM_TIMEOUT', '300'))
+
+# Batch upload settings: per-request limits on files and (uncompressed) bytes,
+# a pool of BATCH_WORKERS threads shared by all batches, and at most
+# BATCH_REQUEST_CONCURRENCY files of any one batch in it at a time, so a large
+# batch queues behind itself instead of taking every worker
+BATCH_MAX_FILES = int(os.getenv('BATCH_MAX_FILES', '50'))
+BATCH_MAX_BYTES = int(os.getenv('BATCH_MAX_BYTES', str(200 * 1024 * 1024)))
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', '8'))
+BATCH_REQUEST_CONCURRENCY = int(os.getenv('BATCH_REQUEST_CONCURRENCY', '2'))
+
+# Per-process thread pools (background jobs, S3 uploads), created on first
+# use so each gunicorn worker gets its own threads after fork
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(name, max_workers):
+    with _executors_lock:
+        executor, pid = _executors.get(name, (None, None))
+        if executor is None or pid != os.getpid():
+            executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+            _executors[name] = (executor, os.getpid())
+        return executor
+
+
+def get_job_executor():
+    return get_executor("upload-job", JOB_WORKERS)
+
+
+# Per-process S3 client, created on first use; importing boto3 and building a
+# client take longer than the rest of the app's start-up
+_s3_client = None
+_s3_client_pid = None
+_s3_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    global _s3_client, _s3_client_pid
+    with _s3_client_lock:
+        if _s3_client is None or _s3_client_pid != os.getpid():
+            import boto3
+            _s3_client = boto3.client(
+                's3',
+                aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+                aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
+                region_name=os.getenv('AWS_REGION'),
+                endpoint_url=os.getenv('S3_ENDPOINT_URL')
+            )
+            _s3_client_pid = os.getpid()
+        return _s3_client
+
+
+# The request body, read once: in memory below UPLOAD_SPOOL_MEMORY_BYTES and
+# in a temp file above it, hashed while it is read. open() hands out
+# independent readers, so S3 and the parser can consume it at the same time.
+class UploadSpool:
+    def __init__(self, stream, chunk_size=1024 * 1024):
+        self.data = None
+        self.path = None
+        self.size = 0
+        digest = hashlib.sha256()
+        buffer = io.BytesIO()
+        temp_file = None
+        try:
+            for chunk in iter(lambda: stream.read(chunk_size), b""):
+                digest.update(chunk)
+                self.size += len(chunk)
+                if temp_file is None and self.size > UPLOAD_SPOOL_MEMORY_BYTES:
+                    temp_file = tempfile.NamedTemporaryFile(prefix="upload-", suffix=".pdf", delete=False)
+                    temp_file.write(buffer.getvalue())
+                    buffer = None
+                (temp_file or buffer).write(chunk)
+        finally:
+            if temp_file is not None:
+                temp_file.close()
+                self.path = temp_file.name
+        if temp_file is None:
+            self.data = buffer.getvalue()
+        self.sha256 = digest.hexdigest()
+
+    # A fresh reader positioned at the start of the upload
+    def open(self):
+        if self.path:
+            return open(self.path, 'rb')
+        return io.BytesIO(self.data)
+
+    # Something analyze_pdf can read without another copy (bytes or a path)
+    def source(self):
+        return self.path or self.data
+
+    def close(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+        self.data = None
+
+
+# Upload a spooled file to S3 (multipart above S3_MULTIPART_THRESHOLD)
+def upload_to_s3(client, spool, bucket, s3_key):
+    from boto3.s3.transfer import TransferConfig
+    s3_transfer_config = TransferConfig(
+        multipart_threshold=S3_MULTIPART_THRESHOLD,
+        multipart_chunksize=S3_MULTIPART_CHUNKSIZE
+    )
+    with spool.open() as file_obj:
+        client.upload_fileobj(
+            file_obj, bucket, s3_key,
+            ExtraArgs={"ContentType": "application/pdf"},
+            Config=s3_transfer_config
+        )
+
+
+# Validate the uploaded file; returns (file, None) or (None, error response)
+def get_uploaded_pdf():
+    if 'file' not in request.files:
+        return None, (jsonify({"error": "No file part in the request"}), 400)
+
+    file = request.files['file']
+    if file.filename == '':
+        return None, (jsonify({"error": "No selected file"}), 400)
+
+    if not file.filename.endswith('.pdf'):
+        return None, (jsonify({"error": "Invalid file type. Only PDF files are allowed."}), 400)
+    return file, None
+
+
+# Raised while collecting a batch; carries the error message and HTTP status
+class BatchRejected(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+# Spool every PDF of a batch upload: PDFs posted under "files" (or "file") and
+# the PDFs inside posted ZIP archives. Returns a list of (filename, spool);
+# raises BatchRejected when a file is neither a PDF nor a ZIP or the batch is
+# over BATCH_MAX_FILES or BATCH_MAX_BYTES. ZIP entries are checked against the
+# limits by their declared size before anything is extracted.
+def collect_batch_pdfs(uploads):
+    pdfs = []
+    total_bytes = 0
+
+    def admit(size):
+        nonlocal total_bytes
+        total_bytes += size
+        if len(pdfs) + 1 > BATCH_MAX_FILES:
+            raise BatchRejected(f"Too many files: at most {BATCH_MAX_FILES} PDFs per batch", 413)
+        if total_bytes > BATCH_MAX_BYTES:
+            raise BatchRejected(f"Batch too large: at most {BATCH_MAX_BYTES} bytes per batch", 413)
+
+    try:
+        for file in uploads:
+            name = file.filename or ""
+            if name.lower().endswith('.zip'):
+                try:
+                    archive = zipfile.ZipFile(file.stream)
+                except zipfile.BadZipFile:
+                    raise BatchRejected(f"Not a valid ZIP archive: {name}")
+                with archive:
+                    for info in archive.infolist():
+                        entry = os.path.basename(info.filename)
+                        # Skip folders, macOS resource forks and non-PDF entries
+                        if info.is_dir() or info.filename.startswith('__MACOSX/') or not entry.lower().endswith('.pdf'):
+                            continue
+                        admit(info.file_size)
+                        with archive.open(info) as entry_stream:
+                            pdfs.append((entry, UploadSpool(entry_stream)))
+            elif name.endswith('.pdf'):
+                spool = UploadSpool(file.stream)
+                try:
+                    admit(spool.size)
+                except BatchRejected:
+                    spool.close()
+                    raise
+                pdfs.append((os.path.basename(name), spool))
+            else:
+                raise BatchRejected(f"Invalid file type: {name}. Only PDF and ZIP files are allowed.")
+        if not pdfs:
+            raise BatchRejected("No PDF files in the request")
+        return pdfs
+    except Exception:
+        for _, spool in pdfs:
+            spool.close()
+        raise
+
+
+# Store one spooled PDF in S3 while it is parsed and summarized from the
+# local spool (or answered from the result cache); nothing is read back from
+# S3. Returns the JSON response body and HTTP status code once both are done.
+# Each stage's time is stored on the document; S3 overlaps the others.
+def process_upload(s3_key, spool, record_metadata=True):
+    timings = {}
+
+    def timed_upload():
+        with track_stage("s3_upload", timings):
+            upload_to_s3(get_s3_client(), spool, bucket_name, s3_key)
+
+    upload = get_executor("s3-upload", S3_UPLOAD_WORKERS).submit(timed_upload)
+    try:
+        # Metadata insertion for the uploaded file
+        if record_metadata:
+            with track_stage("db_write", timings):
+                insert_metadata({"filename": s3_key, "size": spool.size, "sha256": spool.sha256}, "Uploaded via Web UI")
+
+        # A re-upload of the same bytes is answered from the result cache
+        result_cache = get_result_cache()
+        cached = result_cache.get(spool.sha256)
+        if cached:
+            upload.result()
+            with track_stage("db_write"):
+                update_document(s3_key, cached["summary"], cached["keywords"], 0.0, timings_breakdown(timings))
+            count_document("processed")
+            return {"summary": cached["summary"], "keywords": cached["keywords"]}, 200
+
+        # Start processing the PDF file
+        with track_stage("parse", timings):
+            analysis = analyze_pdf(spool.source(), workers=1)
+            parsed_text = analysis.text if analysis else None
+            signature = signature_for_text(parsed_text) if parsed_text else None
+
+        # A near duplicate of a processed document reuses its summary and keywords
+        with track_stage("db_write", timings):
+            match = link_near_duplicate(s3_key, signature)
+        if match:
+            upload.result()
+            with track_stage("db_write"):
+                update_document(s3_key, match["summary"], match["keywords"], 0.0, timings_breakdown(timings))
+            count_document("processed")
+            return {"summary": match["summary"], "keywords": match["keywords"],
+                    "duplicate_of": match["duplicate_of"]}, 200
+
+        if parsed_text:
+            # Generate summary and keywords
+            summary_timings = {}
+            with stage_in_flight("summarize"):
+                summary, keywords = summarize_text(parsed_text, spool.sha256, summary_timings)
+            record_timings(summary_timings, timings)
+            result_cache.put(spool.sha256, {
+                "summary": summary,
+                "keywords": keywords,
+                "category": analysis.category,
+                "page_count": analysis.page_count,
+            })
+            upload.result()
+            processing_time = summary_timings["summarize"] + summary_timings["keywords"]
+
+            # Update MongoDB with the results
+            with track_stage("db_write"):
+                update_document(s3_key, summary, keywords, processing_time, timings_breakdown(timings))
+            count_document("processed")
+
+            # Return the summary and keywords as response
+            return {"summary": summary, "keywords": keywords}, 200
+
+        else:
+            upload.result()
+            update_document_error(s3_key, "Failed to parse PDF", timings_breakdown(timings))
+            count_document("error")
+            return {"error": "Failed to parse PDF"}, 500
+    finally:
+        # The spool must outlive the upload, even when processing failed
+        wait([upload])
+
+
+# Background worker for a queued job; results and errors land on the job's
+# document. Slow jobs are profiled like slow requests.
+def run_upload_job(job_id, s3_key, spool):
+    update_job_status(job_id, "running")
+    started = time.perf_counter()
+    profiler = start_profiler()
+    try:
+        process_upload(s3_key, spool, record_metadata=False)
+    except Exception as e:
+        logging.error(f"Error processing job {job_id} ({s3_key}): {e}")
+        logging.error(traceback.format_exc())
+        update_document_error(s3_key, "An error occurred while processing the file")
+        count_document("error")
+    finally:
+        spool.close()
+        finish_profiler(profiler, f"job {job_id}", time.perf_counter() - started)
+
+
+# Process one file of a batch; returns its NDJSON result line as a dict, with
+# a status of "processed" or "error" like a job's
+def run_batch_file(index, filename, s3_key, spool):
+    try:
+        body, status = process_upload(s3_key, spool)
+    except Exception as e:
+        logging.error(f"Error processing batch file {s3_key}: {e}")
+        logging.error(traceback.format_exc())
+        body, status = {"error": "An error occurred while processing the file"}, 500
+    finally:
+        spool.close()
+    return dict(body, index=index, filename=filename, document_name=s3_key,
+                status="processed" if status == 200 else "error")
+
+
+# Public view of a job's document
+def job_response(job):
+    response = {"job_id": job["job_id"], "status": job["status"], "document_name": job.get("document_name")}
+    for field in ("summary", "keywords", "processing_time", "error_message"):
+        if field in job:
+            response[field] = job[field]
+    return response
+
+
+# Request latency, in-flight and error metrics for every route, plus the
+# sampling profiler when PROFILE_SLOW_REQUEST_SECONDS is set
+@app.before_request
+def start_request_metrics():
+    g.request_metrics = request_started()
+
+
+@app.after_request
+def finish_request_metrics(response):
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    request_finished(g.pop("request_metrics", None), request.method, endpoint, response.status_code)
+    return response
+
+
+# Prometheus scrape endpoint
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    body, content_type = render_metrics()
+    if body is None:
+        return jsonify({"error": "Metrics are unavailable: prometheus_client is not installed"}), 501
+    return Response(body, content_type=content_type)
+
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
-        if 'file' not in request.files:
-            return jsonify({"error": "No file part in the request"}), 400
-
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({"error": "No selected file"}), 400
-
-        if file and file.filename.endswith('.pdf'):
-            try:
-                start_time = time.time()
-
-                # Upload file to S3
-                s3_key = f"uploads/{file.filename}"
-                s3_client.upload_fileobj(
-                    file, bucket_name, s3_key,
-                    ExtraArgs={"ContentType": "application/pdf"}
-                )
-
-                # Metadata insertion for the uploaded file
-                insert_metadata(s3_key, "Uploaded via Web UI")
-
-                # Start processing the PDF file
-                s3_object = s3_client.get_object(Bucket=bucket_name, Key=s3_key)
-                parsed_text = parse_pdf(s3_object['Body'])
-
-                if parsed_text:
-                    # Generate summary and keywords
-                    summary = generate_summary(parsed_text)
-                    keywords = extract_keywords(parsed_text)
-                    processing_time = time.time() - start_time
-
-                    # Update MongoDB with the results
-                    update_document(s3_key, summary, keywords, processing_time)
-
-                    # Return the summary and keywords as response
-                    return jsonify({"summary": summary, "keywords": keywords}), 200
-
-                else:
-                    update_document_error(s3_key, "Failed to parse PDF")
-                    return jsonify({"error": "Failed to parse PDF"}), 500
-
-            except Exception as e:
-                logging.error(f"Error processing file {file.filename}: {e}")
-                logging.error(traceback.format_exc())
-                return jsonify({"error": "An error occurred while processing the file"}), 500
-        else:
-            return jsonify({"error": "Invalid file type. Only PDF files are allowed."}), 400
+        ensure_indexes()
+        file, error_response = get_uploaded_pdf()
+        if error_response:
+            return error_response
+
+        spool = None
+        try:
+            spool = UploadSpool(file.stream)
+            body, status = process_upload(f"uploads/{file.filename}", spool)
+            return jsonify(body), status
+
+        except Exception as e:
+            logging.error(f"Error processing file {file.filename}: {e}")
+            logging.error(traceback.format_exc())
+            return jsonify({"error": "An error occurred while processing the file"}), 500
+        finally:
+            if spool is not None:
+                spool.close()
     else:
         return render_template('index.html')
 
+
+# Upload many PDFs, or ZIP archives of PDFs, in one request. The files are
+# processed on the shared batch pool and the response streams one NDJSON line
+# per file as it finishes (in completion order, with its index in the
+# request), then a final line with the totals.
+@app.route('/batch', methods=['POST'])
+def batch_upload():
+    if request.content_length and request.content_length > BATCH_MAX_BYTES:
+        return jsonify({"error": f"Batch too large: at most {BATCH_MAX_BYTES} bytes per batch"}), 413
+    uploads = request.files.getlist('files') + request.files.getlist('file')
+    if not uploads:
+        return jsonify({"error": "No files part in the request"}), 400
+    ensure_indexes()
+
+    try:
+        pdfs = collect_batch_pdfs(uploads)
+    except BatchRejected as e:
+        return jsonify({"error": str(e)}), e.status
+    except Exception as e:
+        logging.error(f"Error reading batch upload: {e}")
+        logging.error(traceback.format_exc())
+        return jsonify({"error": "An error occurred while reading the files"}), 500
+
+    batch_id = uuid.uuid4().hex
+    executor = get_executor("batch-upload", BATCH_WORKERS)
+
+    def results():
+        pending = set()
+        queued = list(enumerate(pdfs))
+        counts = {"processed": 0, "error": 0}
+        try:
+            while queued or pending:
+                while queued and len(pending) < BATCH_REQUEST_CONCURRENCY:
+                    index, (filename, spool) = queued.pop(0)
+                    # Each file gets its own key so its document_name is unique
+                    s3_key = f"uploads/{batch_id}/{index}-{filename}"
+                    pending.add(executor.submit(run_batch_file, index, filename, s3_key, spool))
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    line = future.result()
+                    counts[line["status"]] += 1
+                    yield json.dumps(line, default=str) + "\n"
+            yield json.dumps({"batch_id": batch_id, "done": True, "files": len(pdfs), **counts}) + "\n"
+        finally:
+            # Client gone: drop the files not started yet; those running finish
+            for _, (_, spool) in queued:
+                spool.close()
+
+    return Response(stream_with_context(results()), mimetype='application/x-ndjson',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# Queue an upload for background processing and return its job id at once
+@app.route('/jobs', methods=['POST'])
+def create_upload_job():
+    ensure_indexes()
+    file, error_response = get_uploaded_pdf()
+    if error_response:
+        return error_response
+
+    try:
+        spool = UploadSpool(file.stream)
+        job_id = uuid.uuid4().hex
+        # Each job gets its own key so its document_name is unique
+        s3_key = f"uploads/{job_id}/{file.filename}"
+
+        if not create_job(job_id, {"filename": s3_key, "size": spool.size, "sha256": spool.sha256}, "Uploaded via Web UI"):
+            spool.close()
+            return jsonify({"error": "Could not queue the file for processing"}), 503
+        get_job_executor().submit(run_upload_job, job_id, s3_key, spool)
+
+        status_url = url_for('get_upload_job', job_id=job_id)
+        return jsonify({"job_id": job_id, "status": "queued", "status_url": status_url}), 202, {"Location": status_url}
+
+    except Exception as e:
+        logging.error(f"Error queueing file {file.filename}: {e}")
+        logging.error(traceback.format_exc())
+        return jsonify({"error": "An error occurred while processing the file"}), 500
+
+
+# Job status and results; ?wait=<seconds> long-polls until the job finishes
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_upload_job(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    wait = min(max(request.args.get('wait', 0, type=float), 0), JOB_MAX_WAIT)
+    deadline = time.monotonic() + wait
+    while job["status"] not in JOB_TERMINAL_STATUSES and time.monotonic() < deadline:
+        time.sleep(JOB_POLL_INTERVAL)
+        job = get_job(job_id) or job
+    return jsonify(job_response(job)), 200
+
+
+# Server-sent events: one "status" event per status change, ending when the job finishes
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def stream_upload_job(job_id):
+    if get_job(job_id) is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    def events():
+        last_status = None
+        last_sent = time.monotonic()
+        deadline = last_sent + JOB_STREAM_TIMEOUT
+        while time.monotonic() < deadline:
+            job = get_job(job_id)
+            if job is not None and job["status"] != last_status:
+                last_status = job["status"]
+                last_sent = time.monotonic()
+                yield f"event: status\ndata: {json.dumps(job_response(job), default=str)}\n\n"
+                if last_status in JOB_TERMINAL_STATUSES:
+                    return
+            elif time.monotonic() - last_sent >= 15:
+                last_sent = time.monotonic()
+                yield ": keep-alive\n\n"
+            time.sleep(JOB_POLL_INTERVAL)
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 if __name__ == '__main__':
     app.run(debug=False, host='0.0.0.0', port=int(os.getenv('PORT', 5000)))
 
@@ -0,0 +1,186 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from urllib.parse import urlsplit
+import aiohttp
+from pdf_utils import (
+    get_download_cache, conditional_headers, download_path,
+    DownloadTooLarge, PDF_DOWNLOAD_MAX_BYTES, DOWNLOAD_CHUNK_SIZE,
+)
+
+# Logging setup
+logging.basicConfig(filename='pdf_utils.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Fetch stage settings, overridable through the environment
+FETCH_MAX_IN_FLIGHT = int(os.getenv("FETCH_MAX_IN_FLIGHT", "32"))
+FETCH_PER_HOST_LIMIT = int(os.getenv("FETCH_PER_HOST_LIMIT", "4"))
+FETCH_POLITENESS_DELAY = float(os.getenv("FETCH_POLITENESS_DELAY", "0.25"))
+# Seconds to connect, and seconds a response may go without sending data;
+# a large download that keeps receiving is not cut off
+FETCH_CONNECT_TIMEOUT = float(os.getenv("FETCH_CONNECT_TIMEOUT", "10"))
+FETCH_TIMEOUT = float(os.getenv("FETCH_TIMEOUT", "30"))
+# Threads that write downloaded chunks and the download cache, off the event loop
+FETCH_WRITER_THREADS = int(os.getenv("FETCH_WRITER_THREADS", "4"))
+FETCH_RETRIES = int(os.getenv("FETCH_RETRIES", "3"))
+FETCH_BACKOFF = float(os.getenv("FETCH_BACKOFF", "1.0"))
+FETCH_MAX_BACKOFF = 30.0
+
+
+# Caps concurrent requests per host and spaces out request starts to the same
+# host by at least `delay` seconds
+class HostLimiter:
+    def __init__(self, per_host_limit=None, delay=None):
+        self.per_host_limit = per_host_limit or FETCH_PER_HOST_LIMIT
+        self.delay = FETCH_POLITENESS_DELAY if delay is None else delay
+        self._semaphores = {}
+        self._next_start = {}
+        self._locks = {}
+
+    def _host_state(self, host):
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self.per_host_limit)
+            self._locks[host] = asyncio.Lock()
+            self._next_start[host] = 0.0
+        return self._semaphores[host], self._locks[host]
+
+    async def acquire(self, url):
+        host = urlsplit(url).netloc
+        semaphore, lock = self._host_state(host)
+        await semaphore.acquire()
+        async with lock:
+            wait = self._next_start[host] - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._next_start[host] = time.monotonic() + self.delay
+        return host
+
+    def release(self, host):
+        self._semaphores[host].release()
+
+
+# Download one PDF into dest_folder; same result and caching as pdf_utils.download_pdf.
+# File and cache writes run on the writer executor (default: the loop's).
+async def fetch_pdf(session, url, dest_folder, limiter, writer=None):
+    loop = asyncio.get_running_loop()
+    cache = get_download_cache(dest_folder)
+    cached = await loop.run_in_executor(writer, cache.get, url)
+    file_name, file_path = download_path(url, dest_folder)
+    temp_path = f"{file_path}.{os.getpid()}.{id(asyncio.current_task())}.part"
+
+    host = await limiter.acquire(url)
+    try:
+        async with session.get(url, headers=conditional_headers(cached), ssl=False) as response:
+            if response.status == 304 and cached:
+                logging.info(f"Not modified, reusing cached download: {file_name}")
+                cached["cached"] = True
+                return cached
+            if response.status >= 500 or response.status == 429:
+                # Worth retrying: let the caller back off and try again
+                response.raise_for_status()
+            if response.status != 200:
+                logging.error(f"Failed to download {url} with status code {response.status}")
+                return None
+            if (response.content_length or 0) > PDF_DOWNLOAD_MAX_BYTES:
+                logging.error(f"Refusing to download {url}: {response.content_length} bytes exceeds the size cap")
+                return None
+
+            digest = sha256()
+            size = 0
+            pdf_file = await loop.run_in_executor(writer, open, temp_path, 'wb')
+            try:
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > PDF_DOWNLOAD_MAX_BYTES:
+                        raise DownloadTooLarge(f"{url} exceeds {PDF_DOWNLOAD_MAX_BYTES} bytes")
+                    digest.update(chunk)
+                    await loop.run_in_executor(writer, pdf_file.write, chunk)
+            finally:
+                await loop.run_in_executor(writer, pdf_file.close)
+            await loop.run_in_executor(writer, os.replace, temp_path, file_path)
+
+            file_metadata = {
+                "filename": file_name,
+                "path": file_path,
+                "size": size,
+                "sha256": digest.hexdigest(),
+                "url": url,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+            await loop.run_in_executor(writer, cache.put, url, file_metadata)
+            logging.info(f"Downloaded: {file_name}")
+            return dict(file_metadata, cached=False)
+    finally:
+        limiter.release(host)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+# fetch_pdf with exponential backoff (plus jitter) on network errors and 5xx/429
+async def fetch_pdf_with_retry(session, url, dest_folder, limiter, retries=None, backoff=None, writer=None):
+    retries = retries or FETCH_RETRIES
+    backoff = FETCH_BACKOFF if backoff is None else backoff
+    for attempt in range(1, retries + 1):
+        try:
+            return await fetch_pdf(session, url, dest_folder, limiter, writer)
+        except DownloadTooLarge as e:
+            logging.error(f"Refusing to download {e}")
+            return None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == retries:
+                logging.error(f"Error downloading {url} after {retries} attempts: {e}")
+                return None
+            delay = min(FETCH_MAX_BACKOFF, backoff * 2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+            logging.warning(f"Error downloading {url} (attempt {attempt}/{retries}), retrying in {delay:.1f}s: {e}")
+            await asyncio.sleep(delay)
+
+
+# Download every URL with up to max_in_flight requests overall and at most
+# per_host_limit per host. on_complete(url, file_metadata) is called from a
+# worker thread as each download finishes (file_metadata is None on failure,
+# and carries the time taken, retries included, as "download_seconds"),
+# so blocking hand-offs such as a bounded queue put slow fetching down instead
+# of stalling the event loop.
+async def fetch_all(urls, dest_folder, on_complete, max_in_flight=None, per_host_limit=None,
+                    delay=None, should_stop=None):
+    max_in_flight = max_in_flight or FETCH_MAX_IN_FLIGHT
+    os.makedirs(dest_folder, exist_ok=True)
+    limiter = HostLimiter(per_host_limit, delay)
+    pending = asyncio.Queue()
+    for url in urls:
+        pending.put_nowait(url)
+
+    loop = asyncio.get_running_loop()
+    connector = aiohttp.TCPConnector(limit=max_in_flight, limit_per_host=limiter.per_host_limit)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=FETCH_CONNECT_TIMEOUT, sock_read=FETCH_TIMEOUT)
+    writer = ThreadPoolExecutor(max_workers=FETCH_WRITER_THREADS, thread_name_prefix="fetch-writer")
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        async def worker():
+            while not pending.empty():
+                if should_stop and should_stop():
+                    return
+                url = pending.get_nowait()
+                started = time.perf_counter()
+                try:
+                    file_metadata = await fetch_pdf_with_retry(session, url, dest_folder, limiter, writer=writer)
+                    if file_metadata:
+                        file_metadata["download_seconds"] = time.perf_counter() - started
+                except Exception as e:
+                    logging.error(f"Error downloading {url}: {e}")
+                    file_metadata = None
+                await loop.run_in_executor(None, on_complete, url, file_metadata)
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(min(max_in_flight, pending.qsize()) or 1)))
+        finally:
+            writer.shutdown()
+
+
+# Blocking entry point: run the fetch stage on a fresh event loop
+def run_fetch_stage(urls, dest_folder, on_complete, **options):
+    asyncio.run(fetch_all(urls, dest_folder, on_complete, **options))
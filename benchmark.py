@@ -0,0 +1,357 @@
+import io
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import threading
+import functools
+import contextlib
+import http.server
+from collections import namedtuple
+from datetime import datetime, timezone
+from statistics import mean, median
+from importlib import metadata
+
+# Benchmark settings, overridable through the environment
+BENCHMARK_SAMPLES_DIR = os.getenv("BENCHMARK_SAMPLES_DIR", "uploads")
+BENCHMARK_RESULTS_FILE = os.getenv("BENCHMARK_RESULTS_FILE", "benchmark_results.json")
+BENCHMARK_BASELINE_FILE = os.getenv("BENCHMARK_BASELINE_FILE", "benchmark_baseline.json")
+# A metric regresses when it is this fraction worse than the baseline...
+BENCHMARK_TOLERANCE = float(os.getenv("BENCHMARK_TOLERANCE", "0.25"))
+# ...and, for latencies, at least this many seconds slower (filters timer noise on tiny inputs)
+BENCHMARK_MIN_DELTA_SECONDS = float(os.getenv("BENCHMARK_MIN_DELTA_SECONDS", "0.002"))
+
+# Packages whose versions are recorded with the results
+RECORDED_PACKAGES = ("PyMuPDF", "PyPDF2", "numpy", "nltk", "pymongo", "mongomock", "aiohttp")
+
+# Sample and synthetically scaled inputs: (name, path) for PDFs, (name, text) for texts
+Corpus = namedtuple("Corpus", ["pdfs", "texts"])
+
+
+# Point every piece of persistent state (document-frequency index, result
+# cache, output folders) into work_dir and disable the result cache, so each
+# measurement does the full work. Must run before the pipeline modules are
+# imported, since they read these settings at import.
+def configure_environment(work_dir):
+    os.environ["DF_INDEX_DIR"] = os.path.join(work_dir, "df_index")
+    os.environ["RESULT_CACHE_DIR"] = os.path.join(work_dir, "result_cache")
+    os.environ["TEXT_STORE_DIR"] = os.path.join(work_dir, "text_store")
+    os.environ["RESULT_CACHE_MEMORY_BYTES"] = "0"
+    os.environ["RESULT_CACHE_DISK_BYTES"] = "0"
+    os.environ["PDF_OUTPUT_DIR"] = os.path.join(work_dir, "output", "PDFSummary")
+    os.environ["FETCH_POLITENESS_DELAY"] = "0"
+    os.environ["FETCH_PER_HOST_LIMIT"] = "64"
+
+
+# Remove the state left by a previous run (outputs, downloads, index, cache)
+# and drop this process's handles on it, so the next run starts from empty
+# stores instead of reusing open segments and cached entries of deleted files
+def reset_state(work_dir):
+    import df_index
+    import text_store
+    import result_cache
+
+    for module, handle in ((text_store, "_text_store"), (df_index, "_df_index")):
+        if getattr(module, handle) is not None:
+            getattr(module, handle).close()
+            setattr(module, handle, None)
+    with result_cache._result_cache_lock:
+        result_cache._result_cache = None
+    for name in ("df_index", "result_cache", "text_store", "output"):
+        shutil.rmtree(os.path.join(work_dir, name), ignore_errors=True)
+
+
+# Latency statistics over timing samples; "value" is the figure compared against the baseline
+def latency_stats(samples):
+    ordered = sorted(samples)
+    return {
+        "unit": "seconds",
+        "better": "lower",
+        "value": median(ordered),
+        "runs": len(ordered),
+        "min": ordered[0],
+        "median": median(ordered),
+        "p95": ordered[max(0, math.ceil(0.95 * len(ordered)) - 1)],
+        "mean": mean(ordered),
+    }
+
+
+# Time function(*args) `repeat` times after `warmup` untimed calls
+def time_call(function, *args, repeat=5, warmup=1):
+    for _ in range(warmup):
+        function(*args)
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(*args)
+        samples.append(time.perf_counter() - started)
+    return latency_stats(samples)
+
+
+def _short_name(file_name):
+    return os.path.splitext(file_name)[0][:12]
+
+
+# Function to collect the sample PDFs and texts and scale each one up by
+# repetition: texts are repeated, PDFs have their pages appended again
+def build_corpus(samples_dir, corpus_dir, scales):
+    import fitz  # PyMuPDF
+
+    os.makedirs(corpus_dir, exist_ok=True)
+    pdfs, texts = [], []
+    for file_name in sorted(os.listdir(samples_dir)):
+        path = os.path.join(samples_dir, file_name)
+        name = _short_name(file_name)
+        if file_name.endswith(".pdf"):
+            with fitz.open(path) as source:
+                for scale in scales:
+                    scaled_path = os.path.join(corpus_dir, f"{name}x{scale}.pdf")
+                    with fitz.open() as scaled:
+                        for _ in range(scale):
+                            scaled.insert_pdf(source)
+                        scaled.save(scaled_path)
+                    pdfs.append((f"{name}x{scale}", scaled_path))
+        elif file_name.endswith(".txt"):
+            with open(path, 'r', encoding='utf-8', errors='ignore') as text_file:
+                text = text_file.read()
+            for scale in scales:
+                texts.append((f"{name}x{scale}", "\n".join([text] * scale)))
+    return Corpus(pdfs, texts)
+
+
+# Function to give every document in the end-to-end run its own bytes (a
+# distinct title), so downloads, hashes and cache keys never coincide
+def make_unique_copies(pdfs, count, folder):
+    import fitz  # PyMuPDF
+
+    os.makedirs(folder, exist_ok=True)
+    names = []
+    for number in range(count):
+        name, path = pdfs[number % len(pdfs)]
+        copy_name = f"{name}-{number}.pdf"
+        with fitz.open(path) as document:
+            document.set_metadata({"title": f"benchmark copy {number}"})
+            document.save(os.path.join(folder, copy_name))
+        names.append(copy_name)
+    return names
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+# Serve a folder over HTTP on a free local port; returns the server and its base URL
+def serve_folder(folder):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=folder))
+    threading.Thread(target=server.serve_forever, name="benchmark-http", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+# Latency of parse_pdf and process_pdf (pdf_utils) per PDF, and of
+# generate_summary and extract_keywords per text
+def benchmark_functions(corpus, repeat):
+    from pdf_utils import parse_pdf, process_pdf
+    from summarization import generate_summary, extract_keywords
+
+    metrics = {}
+    for name, path in corpus.pdfs:
+        metrics[f"parse_pdf[{name}]"] = time_call(parse_pdf, path, repeat=repeat)
+        metrics[f"pdf_utils.process_pdf[{name}]"] = time_call(process_pdf, path, repeat=repeat)
+    for name, text in corpus.texts:
+        metrics[f"generate_summary[{name}]"] = time_call(generate_summary, text, repeat=repeat)
+        metrics[f"extract_keywords[{name}]"] = time_call(extract_keywords, text, repeat=repeat)
+    return metrics
+
+
+# Swap MongoDB for an in-memory mongomock client; returns the documents collection
+def use_mongomock():
+    import mongomock
+    import mongodb_utils
+
+    client = mongomock.MongoClient()
+    mongodb_utils.get_mongo_client = lambda uri=None: client
+    return client["pdf_database"]["pdf_documents"]
+
+
+# Full per-document latency of main.process_pdf (download, parse, summarize,
+# store) and pipeline throughput in documents per second for each CPU worker
+# count, with documents served from a local HTTP server and stored in mongomock
+def benchmark_end_to_end(corpus, work_dir, repeat, worker_counts, documents):
+    import main
+
+    collection = use_mongomock()
+    served_dir = os.path.join(work_dir, "served")
+    served = make_unique_copies(corpus.pdfs, max(documents, len(corpus.pdfs)), served_dir)
+    server, base_url = serve_folder(served_dir)
+    metrics = {}
+    try:
+        for (name, _), file_name in zip(corpus.pdfs, served):
+            samples = []
+            for _ in range(repeat):
+                reset_state(work_dir)
+                collection.delete_many({})
+                main.prepare_output_folders()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    started = time.perf_counter()
+                    main.process_pdf(base_url + file_name)
+                    samples.append(time.perf_counter() - started)
+            metrics[f"main.process_pdf[{name}]"] = latency_stats(samples)
+
+        urls = [base_url + file_name for file_name in served[:documents]]
+        for workers in worker_counts:
+            reset_state(work_dir)
+            collection.delete_many({})
+            main.prepare_output_folders()
+            with contextlib.redirect_stdout(io.StringIO()):
+                started = time.perf_counter()
+                main.concurrent_pdf_processing(urls, cpu_workers=workers, io_workers=max(2, workers),
+                                               report_interval=None)
+                elapsed = time.perf_counter() - started
+            processed = collection.count_documents({"status": "processed"})
+            if processed < len(urls):
+                raise RuntimeError(f"only {processed} of {len(urls)} documents processed with "
+                                   f"{workers} workers; see the logs")
+            metrics[f"throughput[workers={workers}]"] = {
+                "unit": "documents/second",
+                "better": "higher",
+                "value": processed / elapsed,
+                "documents": processed,
+                "seconds": elapsed,
+            }
+    finally:
+        server.shutdown()
+    return metrics
+
+
+def environment_info():
+    versions = {}
+    for package in RECORDED_PACKAGES:
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "packages": versions,
+    }
+
+
+# Function to compare metrics with a baseline; returns one row per metric
+# present in both, flagging those worse than the tolerance allows
+def compare_with_baseline(metrics, baseline_metrics, tolerance=None, min_delta=None):
+    tolerance = BENCHMARK_TOLERANCE if tolerance is None else tolerance
+    min_delta = BENCHMARK_MIN_DELTA_SECONDS if min_delta is None else min_delta
+    rows = []
+    for name, metric in metrics.items():
+        baseline = baseline_metrics.get(name)
+        if not baseline or not baseline.get("value"):
+            continue
+        current, previous = metric["value"], baseline["value"]
+        if metric["better"] == "lower":
+            change = current / previous - 1
+            regressed = change > tolerance and current - previous > min_delta
+        else:
+            change = 1 - current / previous
+            regressed = change > tolerance
+        rows.append({"metric": name, "baseline": previous, "current": current,
+                     "worse_by": change, "regressed": regressed})
+    return rows
+
+
+def format_comparison(rows):
+    lines = [f"{'metric':<48} {'baseline':>12} {'current':>12} {'worse by':>9}"]
+    for row in rows:
+        flag = "  REGRESSION" if row["regressed"] else ""
+        lines.append(f"{row['metric']:<48} {row['baseline']:>12.4f} {row['current']:>12.4f} "
+                     f"{row['worse_by']:>8.1%}{flag}")
+    return "\n".join(lines)
+
+
+def run_benchmarks(args):
+    samples_dir = os.path.abspath(args.samples)
+    work_dir = tempfile.mkdtemp(prefix="pdf-benchmark-")
+    configure_environment(work_dir)
+    try:
+        corpus = build_corpus(samples_dir, os.path.join(work_dir, "corpus"), args.scales)
+        if not corpus.pdfs and not corpus.texts:
+            sys.exit(f"No sample PDFs or texts found in {samples_dir}")
+        print(f"Benchmarking {len(corpus.pdfs)} PDFs and {len(corpus.texts)} texts (scales {args.scales})")
+
+        metrics = benchmark_functions(corpus, args.repeat)
+        if args.skip_end_to_end:
+            print("Skipping end-to-end benchmarks")
+        elif not corpus.pdfs:
+            print("Skipping end-to-end benchmarks: no sample PDFs")
+        else:
+            try:
+                import mongomock  # noqa: F401
+            except ImportError:
+                sys.exit("The end-to-end benchmarks need mongomock (pip install -r requirements-dev.txt); "
+                         "use --skip-end-to-end to run without them")
+            metrics.update(benchmark_end_to_end(corpus, work_dir, args.repeat, args.workers, args.documents))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "environment": environment_info(),
+        "settings": {"scales": args.scales, "repeat": args.repeat, "workers": args.workers,
+                     "documents": args.documents},
+        "metrics": metrics,
+    }
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(",") if item]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark parsing, summarization and pipeline throughput.")
+    parser.add_argument("--samples", default=BENCHMARK_SAMPLES_DIR, help="Folder with sample .pdf and .txt files (default: %(default)s)")
+    parser.add_argument("--scales", type=_int_list, default=[1, 4, 16], help="Comma-separated repetition factors for synthetic documents (default: 1,4,16)")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per latency measurement (default: %(default)s)")
+    parser.add_argument("--workers", type=_int_list, default=[1, 2, 4], help="Comma-separated CPU worker counts for the throughput runs (default: 1,2,4)")
+    parser.add_argument("--documents", type=int, default=12, help="Documents per throughput run (default: %(default)s)")
+    parser.add_argument("--skip-end-to-end", action="store_true", help="Only benchmark the individual functions")
+    parser.add_argument("--output", default=BENCHMARK_RESULTS_FILE, help="Results file (default: %(default)s)")
+    parser.add_argument("--baseline", default=BENCHMARK_BASELINE_FILE, help="Baseline results to compare with (default: %(default)s)")
+    parser.add_argument("--save-baseline", action="store_true", help="Also store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=BENCHMARK_TOLERANCE, help="Allowed fraction a metric may be worse than the baseline (default: %(default)s)")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args)
+
+    regressions = []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+        rows = compare_with_baseline(results["metrics"], baseline.get("metrics", {}), args.tolerance)
+        print(format_comparison(rows))
+        regressions = [row for row in rows if row["regressed"]]
+        results["baseline"] = {"file": args.baseline, "created": baseline.get("created"), "comparison": rows}
+    else:
+        for name, metric in results["metrics"].items():
+            print(f"{name:<48} {metric['value']:>12.4f} {metric['unit']}")
+        if not args.save_baseline:
+            print(f"No baseline at {args.baseline}, nothing to compare with. Record one on this machine "
+                  f"with: python benchmark.py --save-baseline")
+
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=4)
+    print(f"Saved results to {args.output}")
+    if args.save_baseline:
+        shutil.copyfile(args.output, args.baseline)
+        print(f"Saved baseline to {args.baseline}")
+
+    if regressions:
+        print(f"{len(regressions)} metric(s) regressed by more than {args.tolerance:.0%}: "
+              f"{', '.join(row['metric'] for row in regressions)}")
+        sys.exit(1)
@@ -0,0 +1,78 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+from statistics import median
+
+# Cold-start checks for the web app, for CI and before deploying. Importing
+# app must stay under the time budget, open no network connections and leave
+# the heavy libraries (S3, MongoDB, PDF engines, NumPy, nltk) unloaded until a
+# request needs them. Exits non-zero when any check fails.
+IMPORT_BUDGET_SECONDS = float(os.getenv("IMPORT_BUDGET_SECONDS", "0.75"))
+LAZY_MODULES = ("boto3", "botocore", "pymongo", "bson", "fitz", "pymupdf", "PyPDF2", "numpy", "nltk", "requests")
+
+# Runs in a fresh interpreter: block the network, time the import, report what was loaded
+PROBE = """
+import sys, json, time, socket
+
+attempts = []
+
+def refuse(*args, **kwargs):
+    attempts.append(repr(args[1:] if args and isinstance(args[0], socket.socket) else args)[:200])
+    raise OSError("network access during import")
+
+socket.socket.connect = refuse
+socket.socket.connect_ex = refuse
+socket.getaddrinfo = refuse
+socket.create_connection = refuse
+
+started = time.perf_counter()
+import app
+elapsed = time.perf_counter() - started
+print(json.dumps({"seconds": elapsed, "network": attempts, "modules": sorted(sys.modules)}))
+"""
+
+
+# Function to cold-import the module in a fresh interpreter and return the probe's report
+def probe_import(module="app"):
+    code = PROBE.replace("import app", f"import {module}")
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+    completed = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+    if completed.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{completed.stderr}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+# Function to run the checks; returns a list of failure messages (empty when all pass)
+def check_startup(module="app", runs=5, budget=None):
+    budget = IMPORT_BUDGET_SECONDS if budget is None else budget
+    reports = [probe_import(module) for _ in range(runs)]
+    seconds = median(report["seconds"] for report in reports)
+    print(f"Cold import of {module}: median {seconds:.3f}s over {runs} runs (budget {budget:.3f}s)")
+
+    failures = []
+    if seconds > budget:
+        failures.append(f"import took {seconds:.3f}s, over the {budget:.3f}s budget")
+    network = sorted({attempt for report in reports for attempt in report["network"]})
+    if network:
+        failures.append(f"network access during import: {', '.join(network)}")
+    loaded = sorted({name.split(".")[0] for report in reports for name in report["modules"]} & set(LAZY_MODULES))
+    if loaded:
+        failures.append(f"heavy modules loaded at import: {', '.join(loaded)}")
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the web app's cold-start import time and side effects.")
+    parser.add_argument("--module", default="app", help="Module to import (default: %(default)s)")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters to time (default: %(default)s)")
+    parser.add_argument("--budget", type=float, default=IMPORT_BUDGET_SECONDS,
+                        help="Maximum median import time in seconds (default: %(default)s)")
+    args = parser.parse_args()
+
+    failures = check_startup(args.module, args.runs, args.budget)
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,242 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from metrics import get_metrics
+
+# Logging setup
+logging.basicConfig(filename='concurrency.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Controller settings, overridable through the environment. The RSS limit
+# covers this process and its pool workers; 0 means half the machine's memory.
+ADAPTIVE_CONCURRENCY = os.getenv("ADAPTIVE_CONCURRENCY", "1").lower() in ("1", "true", "yes")
+ADAPTIVE_MIN_WORKERS = int(os.getenv("ADAPTIVE_MIN_WORKERS", "1"))
+ADAPTIVE_SAMPLE_INTERVAL = float(os.getenv("ADAPTIVE_SAMPLE_INTERVAL", "2.0"))
+ADAPTIVE_MAX_RSS_BYTES = int(os.getenv("ADAPTIVE_MAX_RSS_BYTES", "0"))
+ADAPTIVE_MIN_AVAILABLE_PERCENT = float(os.getenv("ADAPTIVE_MIN_AVAILABLE_PERCENT", "15"))
+ADAPTIVE_TARGET_CPU_PERCENT = float(os.getenv("ADAPTIVE_TARGET_CPU_PERCENT", "85"))
+ADAPTIVE_MAX_CPU_PERCENT = float(os.getenv("ADAPTIVE_MAX_CPU_PERCENT", "97"))
+# Memory headroom required for each "long" document in flight
+ADAPTIVE_LONG_DOCUMENT_BYTES = int(os.getenv("ADAPTIVE_LONG_DOCUMENT_BYTES", str(512 * 1024 * 1024)))
+# PDFs of at least this size are parsed as long documents. The size is known
+# from the download, so the admission decision needs no read of the file.
+ADAPTIVE_LONG_FILE_BYTES = int(os.getenv("ADAPTIVE_LONG_FILE_BYTES", str(20 * 1024 * 1024)))
+
+
+# Decides how many CPU tasks (parse, summarize) may run at once, between
+# min_workers and max_workers, from psutil samples taken every interval:
+# - memory pressure (RSS of this process and its children over max_rss_bytes,
+#   or system available memory under min_available_percent) halves the limit;
+# - system CPU at or above max_cpu_percent lowers it by one when other
+#   processes use at least a core (the pool alone is meant to fill the CPUs);
+# - CPU under target_cpu_percent while tasks are waiting raises it by one.
+# Heavy (long-category) tasks are admitted only while the memory headroom
+# covers long_document_bytes for each heavy task in flight. A heavy task that
+# is refused holds back new light ones, so the running tasks drain and it is
+# admitted once nothing else runs. Every change of limit is logged and kept
+# in snapshot()["decisions"].
+class ConcurrencyController:
+    def __init__(self, max_workers, min_workers=None, interval=None, max_rss_bytes=None,
+                 min_available_percent=None, target_cpu_percent=None, max_cpu_percent=None,
+                 long_document_bytes=None):
+        import psutil
+
+        self._psutil = psutil
+        self._process = psutil.Process()
+        self._children = {}
+        self._cpu_count = psutil.cpu_count() or 1
+        self.max_workers = max(max_workers, 1)
+        self.min_workers = min(max(ADAPTIVE_MIN_WORKERS if min_workers is None else min_workers, 1), self.max_workers)
+        self.interval = interval or ADAPTIVE_SAMPLE_INTERVAL
+        self.max_rss_bytes = (max_rss_bytes or ADAPTIVE_MAX_RSS_BYTES
+                              or psutil.virtual_memory().total // 2)
+        self.min_available_percent = (ADAPTIVE_MIN_AVAILABLE_PERCENT if min_available_percent is None
+                                      else min_available_percent)
+        self.target_cpu_percent = ADAPTIVE_TARGET_CPU_PERCENT if target_cpu_percent is None else target_cpu_percent
+        self.max_cpu_percent = ADAPTIVE_MAX_CPU_PERCENT if max_cpu_percent is None else max_cpu_percent
+        self.long_document_bytes = long_document_bytes or ADAPTIVE_LONG_DOCUMENT_BYTES
+
+        # Start in the middle and let the samples move the limit
+        self.limit = max(self.min_workers, (self.max_workers + 1) // 2)
+        self.active = 0
+        self.heavy_active = 0
+        self.waiting = 0
+        self.heavy_waiting = 0
+        self.sample = {}
+        self.decisions = deque(maxlen=50)
+        self._condition = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+        self._sample()
+
+    def start(self):
+        self._psutil.cpu_percent(interval=None)
+        self._process.cpu_percent(interval=None)
+        self._thread = threading.Thread(target=self._run, name="concurrency-controller", daemon=True)
+        self._thread.start()
+        self._export()
+        logging.info(f"Concurrency controller started: limit {self.limit} "
+                     f"(min {self.min_workers}, max {self.max_workers}), RSS limit {self.max_rss_bytes} bytes")
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._condition:
+            self._condition.notify_all()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self._sample()
+                self._adjust()
+            except Exception as e:
+                logging.error(f"Concurrency controller sample failed: {e}")
+
+    # RSS and CPU of this process and its children (the pool workers), system memory and CPU
+    def _sample(self):
+        rss = self._process.memory_info().rss
+        own_cpu = self._process.cpu_percent(interval=None)
+        children = {}
+        for child in self._process.children(recursive=True):
+            # Keep the same Process objects: cpu_percent measures since the previous call
+            child = self._children.get(child.pid, child)
+            try:
+                rss += child.memory_info().rss
+                own_cpu += child.cpu_percent(interval=None)
+                children[child.pid] = child
+            except self._psutil.Error:
+                pass
+        self._children = children
+        memory = self._psutil.virtual_memory()
+        reserve = memory.total * self.min_available_percent / 100
+        cpu_percent = self._psutil.cpu_percent(interval=None)
+        with self._condition:
+            self.sample = {
+                "rss_bytes": rss,
+                "available_bytes": memory.available,
+                "available_percent": round(memory.available * 100 / memory.total, 1),
+                "cpu_percent": cpu_percent,
+                # Cores busy with work outside this process tree
+                "other_cores": round(max(cpu_percent * self._cpu_count - own_cpu, 0) / 100, 2),
+                "headroom_bytes": int(max(min(self.max_rss_bytes - rss, memory.available - reserve), 0)),
+                "memory_pressure": rss > self.max_rss_bytes or memory.available < reserve,
+            }
+            self._condition.notify_all()
+
+    def _adjust(self):
+        with self._condition:
+            sample = self.sample
+            limit = self.limit
+            if sample["memory_pressure"]:
+                limit, reason = max(self.min_workers, limit // 2), "memory pressure"
+            elif sample["cpu_percent"] >= self.max_cpu_percent and sample["other_cores"] >= 1:
+                limit, reason = max(self.min_workers, limit - 1), "CPU saturated by other processes"
+            elif sample["cpu_percent"] < self.target_cpu_percent and self.waiting and self.active >= limit:
+                limit, reason = min(self.max_workers, limit + 1), "CPU headroom with tasks waiting"
+            if limit != self.limit:
+                self._decide(limit, reason)
+
+    def _decide(self, limit, reason):
+        sample = self.sample
+        decision = {
+            "time": time.time(),
+            "from": self.limit,
+            "to": limit,
+            "reason": reason,
+            "rss_bytes": sample["rss_bytes"],
+            "available_percent": sample["available_percent"],
+            "cpu_percent": sample["cpu_percent"],
+        }
+        self.decisions.append(decision)
+        logging.info(f"Worker limit {self.limit} -> {limit}: {reason} (RSS {sample['rss_bytes']} bytes, "
+                     f"{sample['available_percent']}% memory available, CPU {sample['cpu_percent']}%)")
+        self.limit = limit
+        self._export()
+        self._condition.notify_all()
+
+    # Publish the limit and load as Prometheus gauges (when prometheus_client is installed)
+    def _export(self):
+        metrics = get_metrics()
+        if metrics:
+            metrics.worker_limit.set(self.limit)
+            metrics.workers_active.set(self.active)
+
+    def _can_admit(self, heavy):
+        if self._stop.is_set():
+            return True
+        if not heavy:
+            return self.active < self.limit and not self.heavy_waiting
+        if self.active == 0:
+            return True
+        return (self.active < self.limit and
+                self.sample["headroom_bytes"] >= self.long_document_bytes * (self.heavy_active + 1))
+
+    # Hold a slot for one CPU task for the duration of the block; heavy marks a long document
+    @contextmanager
+    def slot(self, heavy=False):
+        with self._condition:
+            self.waiting += 1
+            counted_heavy_wait = False
+            try:
+                while not self._can_admit(heavy):
+                    if heavy and not counted_heavy_wait:
+                        self.heavy_waiting += 1
+                        counted_heavy_wait = True
+                        logging.info(f"Holding back a long document: {self.sample['headroom_bytes']} bytes "
+                                     f"of headroom, {self.heavy_active} long and {self.active} tasks in flight")
+                    self._condition.wait(self.interval)
+            finally:
+                self.waiting -= 1
+                if counted_heavy_wait:
+                    self.heavy_waiting -= 1
+            self.active += 1
+            if heavy:
+                self.heavy_active += 1
+            self._export()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.active -= 1
+                if heavy:
+                    self.heavy_active -= 1
+                self._export()
+                self._condition.notify_all()
+
+    # Current limit, load, last sample and recent decisions, for tuning
+    def snapshot(self):
+        with self._condition:
+            return {
+                "limit": self.limit,
+                "min_workers": self.min_workers,
+                "max_workers": self.max_workers,
+                "active": self.active,
+                "heavy_active": self.heavy_active,
+                "waiting": self.waiting,
+                **self.sample,
+                "decisions": list(self.decisions),
+            }
+
+    def format_snapshot(self):
+        snapshot = self.snapshot()
+        return (f"workers: limit {snapshot['limit']} ({snapshot['min_workers']}-{snapshot['max_workers']}), "
+                f"{snapshot['active']} active ({snapshot['heavy_active']} long), {snapshot['waiting']} waiting, "
+                f"RSS {snapshot['rss_bytes'] / 1024 / 1024:.0f} MB, "
+                f"{snapshot['available_percent']}% memory available, CPU {snapshot['cpu_percent']}%, "
+                f"{len(snapshot['decisions'])} limit changes")
+
+
+# Function to start a controller for up to max_workers CPU tasks; None when
+# ADAPTIVE_CONCURRENCY is off or psutil is not installed
+def start_controller(max_workers, **options):
+    if not ADAPTIVE_CONCURRENCY:
+        return None
+    try:
+        return ConcurrencyController(max_workers, **options).start()
+    except ImportError:
+        logging.warning("psutil is not installed; worker concurrency is fixed")
+        return None
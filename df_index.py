@@ -0,0 +1,290 @@
+import os
+import sys
+import math
+import mmap
+import time
+import fcntl
+import struct
+import shutil
+import logging
+import argparse
+import threading
+
+# Logging setup
+logging.basicConfig(filename='df_index.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Index location, overridable through the environment
+DF_INDEX_DIR = os.getenv("DF_INDEX_DIR", os.path.join("uploads", ".df_index"))
+
+# File layout inside the index directory:
+#   terms.txt  - append-only, one term per line; a term's id is its line number
+#   df.bin     - header (document count, term count) followed by one uint32
+#                document frequency per term id; memory-mapped by readers
+#   docs.txt   - append-only ids of the documents already counted
+#   lock       - flock'd by writers so several processes can update the index
+TERMS_FILE = "terms.txt"
+COUNTS_FILE = "df.bin"
+DOCS_FILE = "docs.txt"
+LOCK_FILE = "lock"
+HEADER = struct.Struct("<QQ")
+INITIAL_CAPACITY = 1 << 16
+
+
+# Corpus-wide document frequencies shared by every worker process through the
+# file system. Readers map df.bin once and pick up new terms incrementally, so
+# looking up IDF never reloads the index; writers serialize on an flock.
+class DocumentFrequencyIndex:
+    def __init__(self, path=None):
+        self.path = path or DF_INDEX_DIR
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._terms = {}
+        self._terms_offset = 0
+        self._documents = set()
+        self._documents_offset = 0
+        self._file = None
+        self._map = None
+        self._counts = None
+        self._writable = False
+        self._inode = None
+
+    def _file_path(self, name):
+        return os.path.join(self.path, name)
+
+    def exists(self):
+        return os.path.exists(self._file_path(COUNTS_FILE))
+
+    def _create(self):
+        os.makedirs(self.path, exist_ok=True)
+        with open(self._file_path(LOCK_FILE), 'a'):
+            pass
+        counts_path = self._file_path(COUNTS_FILE)
+        if not os.path.exists(counts_path):
+            temp_path = f"{counts_path}.{os.getpid()}.tmp"
+            with open(temp_path, 'wb') as counts_file:
+                counts_file.write(HEADER.pack(0, 0))
+                counts_file.truncate(HEADER.size + 4 * INITIAL_CAPACITY)
+            for name in (TERMS_FILE, DOCS_FILE):
+                with open(self._file_path(name), 'a'):
+                    pass
+            os.replace(temp_path, counts_path)
+
+    def _close_map(self):
+        if self._counts is not None:
+            self._counts.release()
+            self._counts = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    # Map df.bin, remapping when it has grown or been replaced by a rebuild
+    def _ensure_map(self, writable=False):
+        counts_path = self._file_path(COUNTS_FILE)
+        stat = os.stat(counts_path)
+        if self._inode is not None and stat.st_ino != self._inode:
+            self._close_map()
+            self._reset()
+        if self._map is not None and len(self._map) == stat.st_size and (not writable or self._writable):
+            return
+        self._close_map()
+        self._file = open(counts_path, 'r+b' if writable else 'rb')
+        access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+        self._map = mmap.mmap(self._file.fileno(), 0, access=access)
+        self._counts = memoryview(self._map)[HEADER.size:].cast('I')
+        self._writable = writable
+        self._inode = stat.st_ino
+
+    # Read lines appended to an append-only file since the last call
+    def _read_new_lines(self, name, offset):
+        with open(self._file_path(name), 'rb') as lines_file:
+            lines_file.seek(offset)
+            data = lines_file.read()
+        end = data.rfind(b"\n") + 1
+        return data[:end].decode('utf-8').split("\n")[:-1], offset + end
+
+    def _refresh_terms(self):
+        lines, self._terms_offset = self._read_new_lines(TERMS_FILE, self._terms_offset)
+        for term in lines:
+            self._terms[term] = len(self._terms)
+
+    def _refresh_documents(self):
+        lines, self._documents_offset = self._read_new_lines(DOCS_FILE, self._documents_offset)
+        self._documents.update(lines)
+
+    def _header(self):
+        return HEADER.unpack_from(self._map, 0)
+
+    @property
+    def num_docs(self):
+        with self._lock:
+            if not self.exists():
+                return 0
+            self._ensure_map()
+            return self._header()[0]
+
+    @property
+    def num_terms(self):
+        with self._lock:
+            if not self.exists():
+                return 0
+            self._ensure_map()
+            return self._header()[1]
+
+    # Function to get the document frequency of each term (0 for unseen terms)
+    def document_frequencies(self, terms):
+        with self._lock:
+            if not self.exists():
+                return {term: 0 for term in terms}
+            self._ensure_map()
+            num_terms = self._header()[1]
+            if len(self._terms) < num_terms:
+                self._refresh_terms()
+                self._ensure_map()
+            counts = self._counts
+            frequencies = {}
+            for term in terms:
+                term_id = self._terms.get(term)
+                frequencies[term] = counts[term_id] if term_id is not None and term_id < len(counts) else 0
+            return frequencies
+
+    # Function to get smoothed IDF scores, log((1 + N) / (1 + df)) + 1, for the given terms
+    def idf(self, terms):
+        frequencies = self.document_frequencies(terms)
+        num_docs = self.num_docs
+        return {term: math.log((1 + num_docs) / (1 + df)) + 1 for term, df in frequencies.items()}
+
+    # Function to count one document's distinct terms; a document id is only counted once
+    def add_document(self, document_id, terms):
+        with self._lock:
+            self._create()
+            with open(self._file_path(LOCK_FILE), 'r+') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    return self._add_document_locked(document_id, set(terms))
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _add_document_locked(self, document_id, terms):
+        self._ensure_map(writable=True)
+        self._refresh_documents()
+        if document_id in self._documents:
+            return False
+        self._refresh_terms()
+
+        new_terms = [term for term in terms if term not in self._terms and "\n" not in term]
+        if new_terms:
+            with open(self._file_path(TERMS_FILE), 'ab') as terms_file:
+                terms_file.write("".join(term + "\n" for term in new_terms).encode('utf-8'))
+            self._refresh_terms()
+
+        num_docs, _ = self._header()
+        num_terms = len(self._terms)
+        if num_terms > len(self._counts):
+            capacity = len(self._counts)
+            while capacity < num_terms:
+                capacity *= 2
+            self._close_map()
+            with open(self._file_path(COUNTS_FILE), 'r+b') as counts_file:
+                counts_file.truncate(HEADER.size + 4 * capacity)
+            self._ensure_map(writable=True)
+
+        counts = self._counts
+        for term in terms:
+            term_id = self._terms.get(term)
+            if term_id is not None:
+                counts[term_id] += 1
+        HEADER.pack_into(self._map, 0, num_docs + 1, num_terms)
+        self._map.flush()
+
+        with open(self._file_path(DOCS_FILE), 'ab') as docs_file:
+            docs_file.write(f"{document_id}\n".encode('utf-8'))
+        self._refresh_documents()
+        return True
+
+    def close(self):
+        with self._lock:
+            self._close_map()
+
+
+_df_index = None
+_df_index_pid = None
+
+
+# Function to get this process's handle on the shared index, or None when
+# DF_INDEX_DIR has not been created (keywords then fall back to estimated IDF)
+def get_df_index(create=False):
+    global _df_index, _df_index_pid
+    if _df_index is None or _df_index_pid != os.getpid():
+        _df_index = DocumentFrequencyIndex()
+        _df_index_pid = os.getpid()
+    if create or _df_index.exists():
+        return _df_index
+    return None
+
+
+# Yield (document id, text) for every .txt file below the given folders
+def iter_text_files(folders):
+    for folder in folders:
+        for root, _, files in os.walk(folder):
+            for name in sorted(files):
+                if name.endswith(".txt"):
+                    with open(os.path.join(root, name), 'r', encoding='utf-8', errors='ignore') as text_file:
+                        yield os.path.splitext(name)[0], text_file.read()
+
+
+# Function to rebuild the index from scratch out of (document id, text) pairs.
+# The new index is built in a versioned directory next to path, and path is
+# a symlink to the current version: the swap is a single os.replace of that
+# link, so readers always find an index there, notice the new one and reopen
+# it. An index that is still a plain directory is moved to a version first.
+def rebuild_index(documents, path=None):
+    from summarization import significant_words
+
+    path = os.path.abspath(path or DF_INDEX_DIR)
+    version_path = f"{path}.v{int(time.time() * 1000)}-{os.getpid()}"
+    index = DocumentFrequencyIndex(version_path)
+    count = 0
+    for document_id, text in documents:
+        if index.add_document(document_id, significant_words(text)):
+            count += 1
+    index.close()
+    if count == 0:
+        index._create()
+
+    old_path = None
+    if os.path.islink(path):
+        old_path = os.path.realpath(path)
+    elif os.path.exists(path):
+        old_path = f"{path}.v0-{os.getpid()}"
+        os.replace(path, old_path)
+    link_path = f"{path}.link-{os.getpid()}"
+    os.symlink(os.path.basename(version_path), link_path)
+    os.replace(link_path, path)
+    if old_path:
+        shutil.rmtree(old_path, ignore_errors=True)
+    logging.info(f"Rebuilt document-frequency index at {path} ({version_path}) from {count} documents")
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the corpus-wide document-frequency index.")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    rebuild = subcommands.add_parser("rebuild", help="Rebuild the index from parsed text files")
+    rebuild.add_argument("folders", nargs="+", help="Folders searched recursively for parsed .txt files")
+    rebuild.add_argument("--index", default=DF_INDEX_DIR, help="Index directory (default: %(default)s)")
+    stats = subcommands.add_parser("stats", help="Show document and term counts")
+    stats.add_argument("--index", default=DF_INDEX_DIR, help="Index directory (default: %(default)s)")
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        print(f"Indexed {rebuild_index(iter_text_files(args.folders), args.index)} documents into {args.index}")
+    else:
+        index = DocumentFrequencyIndex(args.index)
+        if not index.exists():
+            sys.exit(f"No index at {args.index}")
+        print(f"{index.num_docs} documents, {index.num_terms} terms")
@@ -1,19 +1,15 @@
 import json
-import pymongo
 import logging
 from datetime import datetime
 from bson import json_util as bson_json  # Corrected import for json_util
-
-# MongoDB connection setup
-client = pymongo.MongoClient("mongodb://localhost:27017/")
-db = client["pdf_database"]
-collection = db["pdf_documents"]
+from mongodb_utils import get_collection
 
 # Function to insert/update document metadata with summaries and keywords in MongoDB
 def insert_or_update_document_metadata(filepath, summary, keywords):
     try:
         json_data = create_json_structure(summary, keywords)
-        
+        collection = get_collection("pdf_database", "pdf_documents")
+
         # Update MongoDB with the generated JSON structure
         collection.update_one(
             {"path": filepath},
@@ -51,6 +47,7 @@ def save_json_to_file(filepath, summary, keywords):
 # Function to handle error logging for JSON/MongoDB operations
 def handle_error(filepath, error_message):
     try:
+        collection = get_collection("pdf_database", "pdf_documents")
         collection.update_one(
             {"path": filepath},
             {"$set": {
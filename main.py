@@ -1,138 +1,407 @@
 import os
 import json
 import shutil
-from pdf_utils import download_pdf, parse_pdf, move_pdf_to_respective_folder, save_parsed_text
-from mongodb_utils import document_exists, update_document_error, count_documents, export_collection
-from mongodb_utils import get_collection, insert_metadata, update_document
-from summarization import generate_summary, extract_keywords
+import signal
+import argparse
+import threading
+from pdf_utils import download_pdf
+from mongodb_utils import update_document_error, count_documents, export_collection
+from mongodb_utils import get_collection, update_document, check_mongo_health, close_mongo_client
+from mongodb_utils import start_bulk_writer, stop_bulk_writer, ensure_indexes
+from mongodb_utils import start_document, checkpoint_document, load_checkpoints
+from async_fetch import run_fetch_stage
+from result_cache import get_result_cache
+from near_duplicates import link_near_duplicate
+from text_store import get_text_store
+from pipeline import Pipeline, parse_document, summarize_document, ignore_interrupts
+from pipeline import PIPELINE_CPU_WORKERS, PIPELINE_IO_WORKERS
+from metrics import track_stage, stage_in_flight, record_stage, record_timings, count_stage_error
+from metrics import count_document, timings_breakdown, serve_metrics
+from concurrency import start_controller, ADAPTIVE_LONG_FILE_BYTES
 import logging
 import concurrent.futures
-import time
 
 # Logging setup
 logging.basicConfig(filename='pipeline_errors.log', level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Define main folder paths
-primary_folder = os.path.join(os.path.expanduser("~"), "Desktop", "PDFDownloadParse", "PDFSummary")
+# Define main folder paths (PDF_OUTPUT_DIR overrides the default location)
+primary_folder = os.getenv("PDF_OUTPUT_DIR", os.path.join(os.path.expanduser("~"), "Desktop", "PDFDownloadParse", "PDFSummary"))
 short_folder = os.path.join(primary_folder, "short")
 medium_folder = os.path.join(primary_folder, "medium")
 long_folder = os.path.join(primary_folder, "long")
 json_folder = os.path.join(primary_folder, ".json")
+# Summaries and keywords, one JSON line per stored document (the latest line
+# for a document wins); appended to by the store stage's threads
+results_file_name = "results.jsonl"
+results_lock = threading.Lock()
+# Downloads live outside primary_folder so their ETag cache survives a rerun
+download_folder = os.path.join(os.path.dirname(primary_folder), "downloads")
+# Folder trees for each page-count category; "unknown" documents go with the long ones
+category_folders = {"short": short_folder, "medium": medium_folder, "long": long_folder}
 
-# Delete existing folders and recreate them
-if os.path.exists(primary_folder):
-    shutil.rmtree(primary_folder)
+# Process pool for the CPU-bound stages and the controller that sizes how
+# many of its tasks run at once; set while the staged pipeline runs
+cpu_pool = None
+concurrency_controller = None
 
-# Create necessary folders if they don't exist
-for folder in [short_folder, medium_folder, long_folder]:
-    os.makedirs(os.path.join(folder, "pdfs"), exist_ok=True)
-    os.makedirs(os.path.join(folder, "texts"), exist_ok=True)
-os.makedirs(json_folder, exist_ok=True)
+# Create the output folders; a fresh run deletes the earlier outputs first
+def prepare_output_folders(fresh=False):
+    if fresh and os.path.exists(primary_folder):
+        shutil.rmtree(primary_folder)
+
+    # Create necessary folders if they don't exist
+    for folder in [short_folder, medium_folder, long_folder]:
+        os.makedirs(os.path.join(folder, "pdfs"), exist_ok=True)
+    os.makedirs(json_folder, exist_ok=True)
 
 # Load PDF URLs from dataset.json
-with open('Dataset.json', 'r') as file:
-    dataset = json.load(file)
-    pdf_urls = list(dataset.values())
+def load_dataset_urls(path='Dataset.json'):
+    with open(path, 'r') as file:
+        dataset = json.load(file)
+        return list(dataset.values())
 
 # Clear MongoDB collection before starting
-collection = get_collection("pdf_database", "pdf_documents")
-collection.delete_many({})
-print("Cleared MongoDB collection.")
+def clear_collection():
+    collection = get_collection("pdf_database", "pdf_documents")
+    collection.delete_many({})
+    print("Cleared MongoDB collection.")
 
-# Download, move, and parse PDFs with concurrency
-def process_pdf(url):
-    try:
-        # Check if the document already exists in MongoDB
-        if document_exists(url):
-            print(f"Document already processed or downloaded, skipping: {url}")
-            return
+# Run a CPU-bound task on the process pool when the pipeline is running, inline otherwise
+def run_cpu_task(task, *args, heavy=False):
+    if cpu_pool is None:
+        return task(*args)
+    if concurrency_controller is None:
+        return cpu_pool.submit(task, *args).result()
+    with concurrency_controller.slot(heavy):
+        return cpu_pool.submit(task, *args).result()
 
+# What an incremental run does with a downloaded URL, given its record from
+# an earlier run (or None): None to skip it (processed and the bytes are
+# unchanged), {} to process it from the start (new, changed or errored), or
+# the record itself to resume after its last completed stage
+def resume_point(checkpoint, file_metadata):
+    if not checkpoint or checkpoint.get("sha256") != file_metadata.get("sha256"):
+        return {}
+    if checkpoint.get("status") == "processed":
+        return None
+    if checkpoint.get("status") == "error":
+        return {}
+    return checkpoint
+
+# Download, move, and parse a single PDF
+def process_pdf(url, checkpoint=None):
+    try:
         # Step 1: Download PDF
-        downloaded_file = download_pdf(url, primary_folder)
-        if not downloaded_file:
-            update_document_error(downloaded_file, "Failed to download file.")
+        timings = {}
+        with track_stage("download", timings):
+            file_metadata = download_pdf(url, download_folder)
+        if not file_metadata:
+            count_stage_error("download")
+            logging.error(f"Failed to download file: {url}")
+            return
+        resume = resume_point(checkpoint, file_metadata)
+        if resume is None:
+            print(f"Unchanged since the last run, skipping: {url}")
             return
+        process_downloaded_pdf(url, file_metadata, timings, resume)
+    except Exception as e:
+        logging.error(f"Error processing PDF {url}: {e}")
 
-        # Insert metadata after downloading
-        insert_metadata(downloaded_file, url)
+# Run every stage after the download for one PDF, in the calling thread
+def process_downloaded_pdf(url, file_metadata, timings=None, resume=None):
+    try:
+        job = {"url": url, "file_metadata": file_metadata, "timings": timings if timings is not None else {},
+               "resume": resume or {}}
+        for stage in (parse_stage, summarize_stage, store_stage):
+            job = stage(job)
+            if job is None:
+                return
+    except Exception as e:
+        logging.error(f"Error processing PDF {url}: {e}")
 
-        # Step 2: Move PDF to appropriate folder based on length
-        moved_file, text_folder = move_pdf_to_respective_folder(
-            downloaded_file, short_folder, medium_folder, long_folder)
-        
-        if not moved_file:
-            update_document_error(downloaded_file, "Failed to move file based on length.")
-            return
+# Parse stage: record the download, then decode the PDF once for its text,
+# page count and category, and file the text by category. Each completed
+# stage is checkpointed on the document so an interrupted run can resume.
+def parse_stage(job):
+    file_metadata = job["file_metadata"]
+    resume = job["resume"]
+
+    # Record the download (a resumed document keeps its record)
+    if not resume:
+        with track_stage("db_write", job["timings"]):
+            start_document(file_metadata, job["url"])
+
+    # Resuming after the parse: the text was stored by the interrupted run
+    if resume.get("stage") in ("parsed", "summarized") and text_key(file_metadata) in get_text_store():
+        job.update(category=resume.get("category"), page_count=resume.get("page_count"), text=None)
+        if resume["stage"] == "summarized":
+            job.update(summary=resume["summary"], keywords=resume["keywords"],
+                       processing_time=resume.get("processing_time") or 0.0)
+        print(f"Resuming after stage {resume['stage']}: {job['url']}")
+        return job
+
+    # Bytes seen before: reuse the cached summary and keywords, skip the parser
+    cached = get_result_cache().get(file_metadata["sha256"]) if file_metadata.get("sha256") else None
+    if cached:
+        job.update(cached, text=None, processing_time=0.0, cache_hit=True)
+        return job
+
+    # Step 2: Decode the PDF once for its text, page count and category.
+    # Very long documents are summarized while they are parsed, page by page,
+    # with their text written straight to a file next to the download.
+    text_path = os.path.splitext(file_metadata["path"])[0] + ".txt"
+    # Long documents are admitted only with memory headroom. The page count is
+    # only known once the PDF is decoded, so the download's size stands in for it.
+    heavy = (file_metadata.get("size") or 0) >= ADAPTIVE_LONG_FILE_BYTES
+    with stage_in_flight("parse"):
+        parsed = run_cpu_task(parse_document, file_metadata["path"], text_path, file_metadata.get("sha256"),
+                              heavy=heavy)
+    if not parsed or not (parsed["text"] or parsed.get("summary")):
+        count_stage_error("parse")
+        count_document("error")
+        update_document_error(file_metadata, "Failed to parse PDF.", timings_breakdown(job["timings"]))
+        return None
+    record_timings(parsed.pop("timings"), job["timings"])
+    signature = parsed.pop("minhash", None)
+    job.update(parsed)
+
+    # A near duplicate of a processed document (a re-scan, a re-issue, the
+    # same text with different OCR noise) reuses its summary and keywords
+    with track_stage("db_write", job["timings"]):
+        match = link_near_duplicate(file_metadata, signature, reuse="summary" not in job)
+    if match:
+        job.update(summary=match["summary"], keywords=match["keywords"], processing_time=0.0,
+                   duplicate_of=match["duplicate_of"])
+        print(f"Near duplicate of {match['duplicate_of']} ({match['similarity']:.0%}): {job['url']}")
+
+    # Step 3: Save parsed text in the text store (streamed documents wrote
+    # theirs to a file next to the download, which is stored in chunks)
+    if job["text"] is not None:
+        get_text_store().put(text_key(file_metadata), job["text"])
+    else:
+        get_text_store().put_file(text_key(file_metadata), job["text_path"])
+        os.remove(job.pop("text_path"))
+    print(f"Parsed text stored for: {file_metadata['filename']}")
+
+    checkpoint_document(file_metadata, "parsed", category=job["category"], page_count=job["page_count"])
+    if "summary" in job:
+        checkpoint_summary(job)
+    return job
+
+# Key of a document's text in the text store: the hash of its PDF bytes
+def text_key(file_metadata):
+    return file_metadata.get("sha256") or os.path.splitext(file_metadata["filename"])[0]
+
+# Checkpoint a document's summary and keywords before it is stored
+def checkpoint_summary(job):
+    checkpoint_document(job["file_metadata"], "summarized", summary=job["summary"], keywords=job["keywords"],
+                        processing_time=job["processing_time"])
+
+# Summarize stage: summary and keywords for the parsed text
+def summarize_stage(job):
+    if job.get("cache_hit"):
+        return job
 
-        # Step 3: Parse PDF to extract text
-        text = parse_pdf(moved_file)
-        if not text:
-            update_document_error(moved_file, "Failed to parse PDF.")
+    # Step 4: Generate Summary and Keywords (already done for streamed documents
+    # and documents resumed after this stage)
+    if "summary" not in job:
+        text = job["text"]
+        if text is None:
+            # Resumed after the parse: read the text back from the store
+            text = get_text_store().get(text_key(job["file_metadata"]))
+        with stage_in_flight("summarize"):
+            summarized = run_cpu_task(summarize_document, text, job["file_metadata"].get("sha256"),
+                                      heavy=job["category"] == "long")
+        record_timings(summarized.pop("timings"), job["timings"])
+        job.update(summarized)
+        checkpoint_summary(job)
+    # Cache only a summary made from these bytes: a near duplicate's borrowed
+    # summary would later be served for them without its duplicate_of link
+    if job["file_metadata"].get("sha256") and not job.get("duplicate_of"):
+        get_result_cache().put(job["file_metadata"]["sha256"], {
+            "summary": job["summary"],
+            "keywords": job["keywords"],
+            "category": job["category"],
+            "page_count": job["page_count"],
+        })
+    return job
+
+# Store stage: file the PDF by category, write the JSON and update MongoDB
+def store_stage(job):
+    file_metadata = job["file_metadata"]
+    file_name = file_metadata["filename"]
+    job.pop("text", None)
+
+    # Move PDF to appropriate folder based on length
+    category_folder = category_folders.get(job["category"], long_folder)
+    moved_file = os.path.join(category_folder, "pdfs", file_name)
+    shutil.copyfile(file_metadata["path"], moved_file)
+
+    # Save Summary and Keywords as a line of the results file
+    json_data = {
+        "document_name": file_name,
+        "summary": job["summary"],
+        "keywords": job["keywords"],
+        "processing_time": f"{job['processing_time']:.2f} seconds"
+    }
+    if job.get("duplicate_of"):
+        json_data["duplicate_of"] = job["duplicate_of"]
+    results_file = os.path.join(json_folder, results_file_name)
+    with results_lock, open(results_file, "a") as json_file:
+        json_file.write(json.dumps(json_data) + "\n")
+    print(f"Saved JSON to: {results_file}")
+
+    # Step 5: Clean Up - Delete summaries and keywords folders after saving JSON
+    summary_folder = os.path.join(os.path.dirname(moved_file), "summaries")
+    keywords_folder = os.path.join(os.path.dirname(moved_file), "keywords")
+
+    if os.path.exists(summary_folder):
+        shutil.rmtree(summary_folder)
+        print(f"Deleted folder: {summary_folder}")
+
+    if os.path.exists(keywords_folder):
+        shutil.rmtree(keywords_folder)
+        print(f"Deleted folder: {keywords_folder}")
+
+    # Step 6: Update MongoDB, with the stage breakdown so far (this write's own
+    # time only reaches the metrics)
+    breakdown = timings_breakdown(job["timings"])
+    with track_stage("db_write"):
+        update_document(file_metadata, job["summary"], job["keywords"], job["processing_time"], breakdown)
+    count_document("processed")
+    print(f"Parsed and updated MongoDB for: {moved_file}")
+    return job
+
+# Run the staged pipeline: the asyncio fetch stage feeds bounded queues for
+# parse and summarize (threads waiting on a process pool sized to the cores)
+# and store (I/O threads for files and MongoDB). A full queue blocks the
+# stage before it, so downloads never run far ahead of the CPU work.
+# checkpoints maps URLs to their records from earlier runs (see resume_point).
+# The first Ctrl-C stops new downloads and lets every document already
+# downloaded finish; a second one aborts, dropping the queued documents and
+# cancelling the CPU tasks that have not started. With psutil, the concurrency
+# controller decides how many of the cpu_workers run at a time.
+def concurrent_pdf_processing(urls, cpu_workers=PIPELINE_CPU_WORKERS, io_workers=PIPELINE_IO_WORKERS,
+                              report_interval=30, checkpoints=None):
+    global cpu_pool, concurrency_controller
+    checkpoints = checkpoints or {}
+    unchanged = []
+    pipeline = Pipeline(report_interval=report_interval)
+    downloads = pipeline.add_source("download")
+    pipeline.add_stage("parse", parse_stage, workers=cpu_workers)
+    pipeline.add_stage("summarize", summarize_stage, workers=cpu_workers)
+    pipeline.add_stage("store", store_stage, workers=io_workers)
+
+    def on_downloaded(url, file_metadata):
+        downloads.end(downloads.begin(), failed=not file_metadata)
+        if not file_metadata:
+            count_stage_error("download")
+            logging.error(f"Failed to download file: {url}")
             return
+        timings = {}
+        record_stage("download", file_metadata.pop("download_seconds", 0.0), timings)
+        resume = resume_point(checkpoints.get(url), file_metadata)
+        if resume is None:
+            unchanged.append(url)
+            return
+        pipeline.submit({"url": url, "file_metadata": file_metadata, "timings": timings, "resume": resume})
 
-        # Save parsed text
-        save_parsed_text(os.path.join(text_folder, os.path.basename(moved_file)), text)
-        print(f"Parsed text saved for: {moved_file}")
-
-        # Step 4: Generate Summary and Keywords
-        start_time = time.time()
-        summary = generate_summary(text)
-        keywords = extract_keywords(text)
-        end_time = time.time()
-
-        # Save Summary and Keywords to JSON
-        json_data = {
-            "document_name": os.path.basename(moved_file),
-            "summary": summary,
-            "keywords": keywords,
-            "processing_time": f"{end_time - start_time:.2f} seconds"
-        }
-        json_filename = os.path.join(json_folder, os.path.basename(moved_file).replace(".pdf", ".json"))
-        with open(json_filename, "w") as json_file:
-            json.dump(json_data, json_file, indent=4)
-        print(f"Saved JSON to: {json_filename}")
-
-        # Step 5: Clean Up - Delete summaries and keywords folders after saving JSON
-        summary_folder = os.path.join(os.path.dirname(moved_file), "summaries")
-        keywords_folder = os.path.join(os.path.dirname(moved_file), "keywords")
-        
-        if os.path.exists(summary_folder):
-            shutil.rmtree(summary_folder)
-            print(f"Deleted folder: {summary_folder}")
-
-        if os.path.exists(keywords_folder):
-            shutil.rmtree(keywords_folder)
-            print(f"Deleted folder: {keywords_folder}")
-
-        # Step 6: Update MongoDB
-        update_document(moved_file, summary, keywords, end_time - start_time)
-        print(f"Parsed and updated MongoDB for: {moved_file}")
+    stop_requested = threading.Event()
 
-    except Exception as e:
-        logging.error(f"Error processing PDF {url}: {e}")
+    def request_stop(signum, frame):
+        if stop_requested.is_set():
+            pipeline.abort()
+            raise KeyboardInterrupt
+        stop_requested.set()
+        print("Stopping: no new downloads, finishing the documents in flight (Ctrl-C again to abort)")
 
-# Use concurrent.futures to process PDFs concurrently
-def concurrent_pdf_processing(urls):
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-        executor.map(process_pdf, urls)
+    on_main_thread = threading.current_thread() is threading.main_thread()
+    previous_handler = signal.signal(signal.SIGINT, request_stop) if on_main_thread else None
+    # Pool workers ignore Ctrl-C so the documents in flight can finish
+    with concurrent.futures.ProcessPoolExecutor(max_workers=cpu_workers, initializer=ignore_interrupts) as pool:
+        cpu_pool = pool
+        controller = concurrency_controller = start_controller(cpu_workers)
+        if controller is not None:
+            pipeline.add_reporter(controller.format_snapshot)
+        pipeline.start()
+        try:
+            run_fetch_stage(urls, download_folder, on_downloaded, should_stop=stop_requested.is_set)
+        finally:
+            if pipeline.aborted.is_set():
+                # Abort: cancel the queued CPU tasks instead of draining the stages
+                if controller is not None:
+                    controller.stop()
+                pool.shutdown(wait=False, cancel_futures=True)
+            pipeline.close()
+            cpu_pool = concurrency_controller = None
+            if controller is not None:
+                controller.stop()
+            if on_main_thread:
+                signal.signal(signal.SIGINT, previous_handler)
+    print(pipeline.format_stats())
+    if controller is not None:
+        print(controller.format_snapshot())
+    if unchanged:
+        print(f"Unchanged since the last run, skipped: {len(unchanged)}")
+    if stop_requested.is_set():
+        print("Stopped early; run again to process the remaining documents")
+    return pipeline.stats()
 
 # Execute the pipeline
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download, parse and summarize the PDFs listed in Dataset.json.")
+    parser.add_argument("--fresh", action="store_true",
+                        help="Delete earlier outputs and MongoDB records and process every URL again")
+    parser.add_argument("--no-revalidate", action="store_true",
+                        help="Skip processed URLs without checking whether they changed")
+    args = parser.parse_args()
+
+    prepare_output_folders(fresh=args.fresh)
+    pdf_urls = load_dataset_urls()
+
     # Test MongoDB Connection
-    collection = get_collection('pdf_database', 'pdf_documents')
-    if collection is None:
-        print("Failed to connect to MongoDB")
-    else:
+    try:
+        check_mongo_health(force=True)
         print("MongoDB connection is successful")
+    except Exception:
+        print("Failed to connect to MongoDB")
+    if args.fresh:
+        clear_collection()
+    ensure_indexes()
+
+    # Expose Prometheus metrics for the run when METRICS_PORT is set
+    if os.getenv("METRICS_PORT"):
+        serve_metrics(int(os.getenv("METRICS_PORT")))
 
-    # Concurrently download, move, parse, summarize, and update MongoDB
-    concurrent_pdf_processing(pdf_urls)
+    # Incremental run: every URL's record from earlier runs is looked up in one
+    # batch. Processed URLs are revalidated with a conditional request and
+    # skipped when unchanged; new, changed and errored URLs are processed and
+    # interrupted ones resume after their last completed stage.
+    checkpoints = load_checkpoints(pdf_urls)
+    statuses = [checkpoints[url].get("status") for url in pdf_urls if url in checkpoints]
+    print(f"{len(pdf_urls) - len(statuses)} new, {statuses.count('processed')} processed, "
+          f"{statuses.count('error')} errored, "
+          f"{len(statuses) - statuses.count('processed') - statuses.count('error')} interrupted URLs")
+    if args.no_revalidate:
+        pdf_urls = [url for url in pdf_urls if checkpoints.get(url, {}).get("status") != "processed"]
+
+    # Concurrently download, move, parse, summarize, and update MongoDB.
+    # Status writes are batched; stopping the writer flushes the remainder.
+    start_bulk_writer()
+    try:
+        concurrent_pdf_processing(pdf_urls, checkpoints=checkpoints)
+    finally:
+        stop_bulk_writer()
 
     # Exporting MongoDB collection
     export_collection("exported_mongodb_collection.json")
     print("Exported MongoDB collection to exported_mongodb_collection.json")
 
-    # Document counts in MongoDB
-    print(f"Downloaded documents: {count_documents('downloaded')}")
+    # Document counts in MongoDB. A document stays "uploaded" from its download
+    # until it is processed (its checkpointed stage is kept in "stage"), so
+    # these are the ones an interrupted run left to resume.
     print(f"Processed documents: {count_documents('processed')}")
+    print(f"Unfinished documents (downloaded, to resume): {count_documents('uploaded')}")
     print(f"Error documents: {count_documents('error')}")
+
+    close_mongo_client()
@@ -0,0 +1,241 @@
+import os
+import sys
+import time
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+# Logging setup
+logging.basicConfig(filename='metrics.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Stages timed for every document; their durations are stored as a breakdown
+# ("timings") on the document in MongoDB and exported as Prometheus histograms
+STAGES = ("download", "s3_upload", "parse", "summarize", "keywords", "db_write")
+
+# Histogram buckets in seconds, shared by stages and HTTP requests
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# Opt-in sampling profiler: requests slower than PROFILE_SLOW_REQUEST_SECONDS
+# leave a profile in PROFILE_DIR. Unset (the default) disables profiling.
+PROFILE_SLOW_REQUEST_SECONDS = float(os.getenv("PROFILE_SLOW_REQUEST_SECONDS") or 0) or None
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+# prometheus_client is optional and imported on first use (it is not cheap to
+# import); without it timings are still measured and stored, only not exported
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+# Function to get the process's Prometheus metrics, creating them on first use; None without prometheus_client
+def get_metrics():
+    global _metrics
+    if _metrics is not None:
+        return _metrics or None
+    with _metrics_lock:
+        if _metrics is None:
+            try:
+                from prometheus_client import Counter as PromCounter, Gauge, Histogram
+            except ImportError:
+                logging.warning("prometheus_client is not installed; metrics are not exported")
+                _metrics = False
+                return None
+            _metrics = SimpleNamespace(
+                stage_seconds=Histogram("pdf_stage_duration_seconds", "Time spent in each document processing stage",
+                                        ["stage"], buckets=LATENCY_BUCKETS),
+                stage_in_flight=Gauge("pdf_stage_in_flight", "Documents currently in each stage",
+                                      ["stage"], multiprocess_mode="livesum"),
+                stage_errors=PromCounter("pdf_stage_errors", "Documents that failed in each stage", ["stage"]),
+                documents=PromCounter("pdf_documents", "Documents finished, by final status", ["status"]),
+                request_seconds=Histogram("http_request_duration_seconds", "HTTP request latency",
+                                          ["method", "endpoint"], buckets=LATENCY_BUCKETS),
+                requests_in_flight=Gauge("http_requests_in_flight", "HTTP requests being handled",
+                                         multiprocess_mode="livesum"),
+                worker_limit=Gauge("pdf_worker_limit", "CPU tasks the concurrency controller lets run at once",
+                                   multiprocess_mode="livemax"),
+                workers_active=Gauge("pdf_workers_active", "CPU tasks running under the concurrency controller",
+                                     multiprocess_mode="livesum"),
+                request_errors=PromCounter("http_request_errors", "HTTP requests answered with a 5xx status",
+                                           ["method", "endpoint", "status"]),
+            )
+    return _metrics or None
+
+
+# Function to record a stage duration measured elsewhere (e.g. in a worker
+# process), adding it to the document's timings when given
+def record_stage(stage, seconds, timings=None):
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+    metrics = get_metrics()
+    if metrics:
+        metrics.stage_seconds.labels(stage).observe(seconds)
+
+
+# Function to record every stage of a timings dict returned by a worker
+def record_timings(stage_timings, timings=None):
+    for stage, seconds in stage_timings.items():
+        record_stage(stage, seconds, timings)
+
+
+def count_stage_error(stage):
+    metrics = get_metrics()
+    if metrics:
+        metrics.stage_errors.labels(stage).inc()
+
+
+def count_document(status):
+    metrics = get_metrics()
+    if metrics:
+        metrics.documents.labels(status).inc()
+
+
+# Count a stage as in flight for the duration of the block, and as failed if it raises
+@contextmanager
+def stage_in_flight(stage):
+    metrics = get_metrics()
+    if metrics:
+        metrics.stage_in_flight.labels(stage).inc()
+    try:
+        yield
+    except Exception:
+        count_stage_error(stage)
+        raise
+    finally:
+        if metrics:
+            metrics.stage_in_flight.labels(stage).dec()
+
+
+# Time a stage running in this process: in-flight gauge, histogram, error counter and the document's timings
+@contextmanager
+def track_stage(stage, timings=None):
+    started = time.perf_counter()
+    try:
+        with stage_in_flight(stage):
+            yield
+    finally:
+        record_stage(stage, time.perf_counter() - started, timings)
+
+
+# Rounded copy of a timings dict for storage
+def timings_breakdown(timings):
+    return {stage: round(seconds, 4) for stage, seconds in timings.items()}
+
+
+# Function to render the metrics in the Prometheus text format; returns (body, content type).
+# Under gunicorn, set PROMETHEUS_MULTIPROC_DIR so every worker's metrics are aggregated.
+def render_metrics():
+    if not get_metrics():
+        return None, None
+    from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+# Function to serve the metrics over HTTP on a background thread, for
+# processes without a web app (the batch pipeline); False without prometheus_client
+def serve_metrics(port):
+    if not get_metrics():
+        return False
+    from prometheus_client import start_http_server
+    start_http_server(port)
+    logging.info(f"Serving metrics on port {port}")
+    return True
+
+
+# Function to start timing an HTTP request (and profiling it when enabled);
+# returns the state to hand to request_finished
+def request_started():
+    metrics = get_metrics()
+    if metrics:
+        metrics.requests_in_flight.inc()
+    return time.perf_counter(), start_profiler()
+
+
+def request_finished(state, method, endpoint, status):
+    if state is None:
+        return
+    started, profiler = state
+    elapsed = time.perf_counter() - started
+    metrics = get_metrics()
+    if metrics:
+        metrics.requests_in_flight.dec()
+        metrics.request_seconds.labels(method, endpoint).observe(elapsed)
+        if status >= 500:
+            metrics.request_errors.labels(method, endpoint, str(status)).inc()
+    finish_profiler(profiler, f"{method} {endpoint}", elapsed)
+
+
+# Samples one thread's stack every `interval` seconds from a background thread
+# and counts identical stacks. The result is written in the folded format
+# ("outer;inner;leaf count" per line) read by flamegraph.pl and speedscope.
+# Only the sampled thread is seen: work it hands to pools is not.
+class SamplingProfiler:
+    def __init__(self, thread_id=None, interval=None):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval or PROFILE_SAMPLE_INTERVAL
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self.stacks
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def dump(self, path):
+        with open(path, 'w') as profile_file:
+            for stack, count in self.stacks.most_common():
+                profile_file.write(f"{stack} {count}\n")
+
+
+# Function to start profiling the current thread when slow-request profiling is enabled; None otherwise
+def start_profiler():
+    if PROFILE_SLOW_REQUEST_SECONDS is None:
+        return None
+    return SamplingProfiler().start()
+
+
+# Function to stop a profiler and keep its profile if the work took at least
+# PROFILE_SLOW_REQUEST_SECONDS; returns the profile's path or None
+def finish_profiler(profiler, label, elapsed):
+    if profiler is None:
+        return None
+    profiler.stop()
+    if elapsed < PROFILE_SLOW_REQUEST_SECONDS or not profiler.samples:
+        return None
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        safe_label = "".join(char if char.isalnum() else "_" for char in label).strip("_")
+        path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{safe_label}-{elapsed:.2f}s.folded")
+        profiler.dump(path)
+        logging.info(f"Slow request {label} took {elapsed:.2f}s, profile saved to {path}")
+        return path
+    except OSError as e:
+        logging.error(f"Error saving profile for {label}: {e}")
+        return None
@@ -1,114 +1,554 @@
-import pymongo
+import os
+import gzip
+import atexit
+import threading
+from collections import OrderedDict
 from datetime import datetime
-from bson import json_util as bson_json  # Correct import for exporting MongoDB data
 import logging
 import time
-from retry import retry
+from retry.api import retry_call
 
 # Logging setup
 logging.basicConfig(filename='mongodb_utils.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# MongoDB setup with retry for connection failures
-@retry(tries=3, delay=5, backoff=2)
-def get_mongo_client(uri="mongodb://localhost:27017/"):
+# Connection settings, overridable through the environment
+MONGODB_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017/")
+MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", "50"))
+MONGODB_MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE", "0"))
+MONGODB_HEALTH_CHECK_INTERVAL = float(os.getenv("MONGODB_HEALTH_CHECK_INTERVAL", "30"))
+BULK_WRITE_BATCH_SIZE = int(os.getenv("MONGODB_BULK_BATCH_SIZE", "500"))
+BULK_WRITE_MAX_AGE = float(os.getenv("MONGODB_BULK_MAX_AGE", "2.0"))
+
+# Process-wide client state. The client owns a connection pool and is shared
+# by every thread; it is rebuilt when the pid changes (e.g. gunicorn workers
+# forked from a preloaded master) because pymongo clients are not fork-safe.
+_client = None
+_client_pid = None
+_client_uri = None
+_client_lock = threading.Lock()
+# pymongo and bson are imported on first use, which keeps importing this module cheap
+_last_health_check = 0.0
+_bulk_writer = None
+_indexes_ensured = False
+
+# Indexes on the fields the pipeline filters by (name, key, options); 1 is ascending
+PDF_DOCUMENT_INDEXES = [
+    ("url_1", [("url", 1)], {}),
+    ("document_name_1", [("document_name", 1)], {}),
+    ("status_1", [("status", 1)], {}),
+    ("job_id_1", [("job_id", 1)], {"unique": True, "sparse": True}),
+    # Multikey index for near-duplicate candidate lookups (see near_duplicates.py)
+    ("lsh_bands_1", [("lsh_bands", 1)], {}),
+]
+
+# Job statuses after which a job's document no longer changes
+JOB_TERMINAL_STATUSES = ("processed", "error")
+
+
+def _reset_client_after_fork():
+    global _client, _client_pid, _client_lock, _last_health_check, _bulk_writer
+    # Drop the parent's client without closing it; its sockets belong to the parent
+    _client = None
+    _client_pid = None
+    _client_lock = threading.Lock()
+    _last_health_check = 0.0
+    # The writer's flush thread does not survive fork; its buffer belongs to the parent
+    _bulk_writer = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_client_after_fork)
+
+
+# Get the shared MongoDB client, creating it on first use in this process
+def get_mongo_client(uri=None):
+    global _client, _client_pid, _client_uri
+    uri = uri or MONGODB_URI
+    if _client is not None and _client_pid == os.getpid() and _client_uri == uri:
+        return _client
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid() or _client_uri != uri:
+            import pymongo
+            # MongoClient connects in the background, so creating it does not block
+            _client = pymongo.MongoClient(
+                uri,
+                serverSelectionTimeoutMS=5000,
+                maxPoolSize=MONGODB_MAX_POOL_SIZE,
+                minPoolSize=MONGODB_MIN_POOL_SIZE,
+                connect=False,
+            )
+            _client_pid = os.getpid()
+            _client_uri = uri
+            logging.info(f"Created MongoDB client (maxPoolSize={MONGODB_MAX_POOL_SIZE})")
+    return _client
+
+
+# Close the shared client, e.g. on shutdown
+def close_mongo_client():
+    global _client, _client_pid, _client_uri
+    with _client_lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client = None
+        _client_pid = None
+        _client_uri = None
+
+
+# Ping the server, at most once per health check interval unless forced
+def check_mongo_health(force=False):
+    from pymongo.errors import ConnectionFailure
+    return retry_call(_ping_mongo, fargs=(force,), exceptions=ConnectionFailure, tries=3, delay=1, backoff=2)
+
+
+# One health check attempt for check_mongo_health
+def _ping_mongo(force):
+    global _last_health_check
+    from pymongo.errors import ConnectionFailure
+    now = time.monotonic()
+    if not force and _last_health_check and now - _last_health_check < MONGODB_HEALTH_CHECK_INTERVAL:
+        return True
     try:
-        client = pymongo.MongoClient(uri, serverSelectionTimeoutMS=5000)
-        client.server_info()  # Forces a call to check the server status
-        return client
-    except pymongo.errors.ConnectionFailure as e:
+        get_mongo_client().admin.command("ping")
+        _last_health_check = now
+        return True
+    except ConnectionFailure as e:
+        _last_health_check = 0.0
         logging.error(f"Failed to connect to MongoDB: {e}")
         raise
 
 # Get a specific MongoDB collection
 def get_collection(db_name, collection_name):
     client = get_mongo_client()
-    if client:
+    if client is not None:
         db = client[db_name]
         return db[collection_name]
     else:
         logging.error(f"Could not connect to MongoDB to get collection: {collection_name}")
     return None
 
+# Create the pdf_documents indexes once per process; create_indexes is a no-op for existing ones
+def ensure_indexes(force=False):
+    global _indexes_ensured
+    if _indexes_ensured and not force:
+        return True
+    try:
+        collection = get_collection("pdf_database", "pdf_documents")
+        if collection is not None:
+            import pymongo
+            collection.create_indexes([
+                pymongo.IndexModel(keys, name=name, **options)
+                for name, keys, options in PDF_DOCUMENT_INDEXES
+            ])
+            _indexes_ensured = True
+            logging.info("Ensured indexes on pdf_documents")
+            return True
+    except Exception as e:
+        logging.error(f"Error creating indexes on pdf_documents: {e}")
+    return False
+
+# Resolve the document name from a metadata dict or a plain name/key
+def _document_name(file_metadata):
+    if isinstance(file_metadata, dict):
+        return file_metadata['filename']
+    return file_metadata
+
+
+# Buffers pipeline writes and sends them as unordered bulk_write batches.
+# Writes are coalesced per document_name so each batch holds at most one
+# operation per document: an update queued behind a pending insert is folded
+# into the inserted document, and repeated updates merge their $set fields.
+# That keeps unordered execution safe while every error stays on its record.
+class BulkWriter:
+    def __init__(self, collection=None, batch_size=None, max_age=None):
+        self.collection = collection
+        self.batch_size = batch_size or BULK_WRITE_BATCH_SIZE
+        self.max_age = max_age or BULK_WRITE_MAX_AGE
+        self._pending = OrderedDict()  # document_name -> [kind, fields]
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_periodically, name="mongo-bulk-writer", daemon=True)
+        self._flusher.start()
+
+    def _get_collection(self):
+        if self.collection is None:
+            self.collection = get_collection("pdf_database", "pdf_documents")
+        return self.collection
+
+    # Queue an insert of a full document
+    def insert(self, document):
+        key = document["document_name"]
+        with self._lock:
+            conflict = key in self._pending
+        if conflict:
+            # Keep the original insert/update order for this document
+            self.flush()
+        self._enqueue(key, "insert", dict(document))
+
+    # Queue a $set update for the document with the given name
+    def update(self, document_name, fields):
+        self._enqueue(document_name, "update", dict(fields))
+
+    # Queue a $set update that creates the document if it does not exist yet
+    def upsert(self, document_name, fields):
+        self._enqueue(document_name, "upsert", dict(fields, document_name=document_name))
+
+    def _enqueue(self, key, kind, fields):
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is None:
+                self._pending[key] = [kind, fields]
+            else:
+                pending[1].update(fields)
+                if kind == "upsert" and pending[0] == "update":
+                    pending[0] = "upsert"
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self.flush()
+
+    # Send everything buffered so far in one unordered bulk_write
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                batch = self._pending
+                self._pending = OrderedDict()
+                self._oldest = None
+
+            import pymongo
+            keys = list(batch)
+            operations = []
+            for key in keys:
+                kind, fields = batch[key]
+                if kind == "insert":
+                    operations.append(pymongo.InsertOne(fields))
+                elif kind == "upsert":
+                    operations.append(pymongo.UpdateOne({"document_name": key}, {"$set": fields}, upsert=True))
+                else:
+                    operations.append(pymongo.UpdateOne({"document_name": key}, {"$set": fields}))
+
+            try:
+                result = self._get_collection().bulk_write(operations, ordered=False)
+                logging.info(f"Bulk write: {result.inserted_count} inserted, {result.modified_count} updated")
+            except pymongo.errors.BulkWriteError as e:
+                for error in e.details.get("writeErrors", []):
+                    logging.error(f"Bulk write failed for {keys[error['index']]}: {error.get('errmsg')}")
+            except Exception as e:
+                logging.error(f"Error flushing {len(operations)} bulk operations ({', '.join(keys)}): {e}")
+
+    def _flush_periodically(self):
+        while not self._stop.wait(self.max_age / 2):
+            with self._lock:
+                expired = self._oldest is not None and time.monotonic() - self._oldest >= self.max_age
+            if expired:
+                self.flush()
+
+    # Stop the age-based flusher and write out anything still buffered
+    def close(self):
+        self._stop.set()
+        if self._flusher.is_alive() and self._flusher is not threading.current_thread():
+            self._flusher.join()
+        self.flush()
+
+
+# Route insert_metadata/update_document/update_document_error through a shared BulkWriter
+def start_bulk_writer(batch_size=None, max_age=None):
+    global _bulk_writer
+    if _bulk_writer is None:
+        _bulk_writer = BulkWriter(batch_size=batch_size, max_age=max_age)
+        atexit.register(stop_bulk_writer)
+    return _bulk_writer
+
+
+# Flush and stop the shared BulkWriter; later writes go straight to MongoDB again
+def stop_bulk_writer():
+    global _bulk_writer
+    writer, _bulk_writer = _bulk_writer, None
+    if writer is not None:
+        writer.close()
+
+
 # Function to insert metadata after processing a PDF
 def insert_metadata(file_metadata, url):
+    if not isinstance(file_metadata, dict):
+        file_metadata = {"filename": file_metadata}
     metadata = {
         "document_name": file_metadata['filename'],
-        "size": file_metadata['size'],
+        "size": file_metadata.get('size'),
         "url": url,
         "status": "uploaded",
         "timestamp": datetime.now()
     }
+    if file_metadata.get('sha256'):
+        metadata["sha256"] = file_metadata['sha256']
     try:
+        if _bulk_writer is not None:
+            _bulk_writer.insert(metadata)
+            return
         collection = get_collection("pdf_database", "pdf_documents")
-        if collection:
+        if collection is not None:
             collection.insert_one(metadata)
             logging.info(f"Inserted metadata for {file_metadata['filename']}")
     except Exception as e:
         logging.error(f"Error inserting metadata for {file_metadata['filename']}: {e}")
 
-# Function to update MongoDB with processing results
-def update_document(file_metadata, summary, keywords, processing_time):
+# Function to record that a pipeline document completed a stage ("downloaded",
+# "parsed", "summarized"), with the fields needed to resume after it. The
+# record is created if needed, so a rerun of the same URL reuses it.
+def checkpoint_document(file_metadata, stage, **fields):
+    document_name = _document_name(file_metadata)
+    fields = dict(fields, stage=stage, timestamp=datetime.now())
     try:
+        if _bulk_writer is not None:
+            _bulk_writer.upsert(document_name, fields)
+            return
         collection = get_collection("pdf_database", "pdf_documents")
-        if collection:
-            collection.update_one(
-                {"document_name": file_metadata['filename']},
-                {"$set": {
-                    "summary": summary,
-                    "keywords": keywords,
-                    "status": "processed",
-                    "summary_length": len(summary.split()),
-                    "keywords_count": len(keywords),
-                    "processing_time": processing_time,
-                    "timestamp": datetime.now()
-                }}
-            )
-            logging.info(f"Updated document metadata for {file_metadata['filename']}")
+        if collection is not None:
+            collection.update_one({"document_name": document_name}, {"$set": fields}, upsert=True)
+            logging.info(f"Checkpointed {document_name} at stage {stage}")
     except Exception as e:
-        logging.error(f"Error updating document metadata for {file_metadata['filename']}: {e}")
+        logging.error(f"Error checkpointing {document_name} at stage {stage}: {e}")
+
+# Function to (re)start a downloaded document: its metadata replaces that of
+# any earlier run, and a previous error or result status is reset
+def start_document(file_metadata, url):
+    checkpoint_document(
+        file_metadata, "downloaded",
+        url=url,
+        size=file_metadata.get('size'),
+        sha256=file_metadata.get('sha256'),
+        path=file_metadata.get('path'),
+        status="uploaded",
+        error_message=None,
+    )
+
+# Function to update MongoDB with processing results. processing_time is the
+# summarize plus keywords time; timings is the per-stage breakdown in seconds.
+def update_document(file_metadata, summary, keywords, processing_time, timings=None):
+    document_name = _document_name(file_metadata)
+    fields = {
+        "summary": summary,
+        "keywords": keywords,
+        "status": "processed",
+        "stage": "stored",
+        "summary_length": len(summary.split()),
+        "keywords_count": len(keywords),
+        "processing_time": processing_time,
+        "timestamp": datetime.now()
+    }
+    if timings:
+        fields["timings"] = timings
+    try:
+        if _bulk_writer is not None:
+            _bulk_writer.update(document_name, fields)
+            return
+        collection = get_collection("pdf_database", "pdf_documents")
+        if collection is not None:
+            collection.update_one({"document_name": document_name}, {"$set": fields})
+            logging.info(f"Updated document metadata for {document_name}")
+    except Exception as e:
+        logging.error(f"Error updating document metadata for {document_name}: {e}")
+
+# Function to replace the summary and keywords of every document with the
+# given PDF hash (after re-summarizing stored text)
+def update_documents_by_sha256(sha256, summary, keywords, processing_time):
+    fields = {
+        "summary": summary,
+        "keywords": keywords,
+        "summary_length": len(summary.split()),
+        "keywords_count": len(keywords),
+        "processing_time": processing_time,
+        "timestamp": datetime.now()
+    }
+    try:
+        collection = get_collection("pdf_database", "pdf_documents")
+        if collection is not None:
+            result = collection.update_many({"sha256": sha256, "status": "processed"}, {"$set": fields})
+            return result.modified_count
+    except Exception as e:
+        logging.error(f"Error updating documents with hash {sha256}: {e}")
+    return 0
 
 # Function to update document status in case of an error
-def update_document_error(file_metadata, error_message):
+def update_document_error(file_metadata, error_message, timings=None):
+    document_name = _document_name(file_metadata)
+    fields = {"status": "error", "error_message": error_message, "timestamp": datetime.now()}
+    if timings:
+        fields["timings"] = timings
     try:
+        if _bulk_writer is not None:
+            _bulk_writer.update(document_name, fields)
+            logging.error(f"Queued error update for {document_name}: {error_message}")
+            return
         collection = get_collection("pdf_database", "pdf_documents")
-        if collection:
-            collection.update_one(
-                {"document_name": file_metadata['filename']},
-                {"$set": {"status": "error", "error_message": error_message, "timestamp": datetime.now()}}
-            )
-            logging.error(f"Updated document with error for {file_metadata['filename']}: {error_message}")
+        if collection is not None:
+            collection.update_one({"document_name": document_name}, {"$set": fields})
+            logging.error(f"Updated document with error for {document_name}: {error_message}")
+    except Exception as e:
+        logging.error(f"Error updating error status for {document_name}: {e}")
+
+# Build the find() filter for an export from a status and a timestamp range
+def _export_filter(status=None, since=None, until=None):
+    query = {}
+    if status is not None:
+        query["status"] = {"$in": list(status)} if isinstance(status, (list, tuple, set)) else status
+    if since is not None or until is not None:
+        query["timestamp"] = {}
+        if since is not None:
+            query["timestamp"]["$gte"] = since
+        if until is not None:
+            query["timestamp"]["$lt"] = until
+    return query
+
+# Function to record a queued upload job; the job's document is the PDF's record
+def create_job(job_id, file_metadata, url):
+    document = {
+        "job_id": job_id,
+        "document_name": file_metadata['filename'],
+        "size": file_metadata.get('size'),
+        "sha256": file_metadata.get('sha256'),
+        "url": url,
+        "status": "queued",
+        "timestamp": datetime.now()
+    }
+    try:
+        collection = get_collection("pdf_database", "pdf_documents")
+        if collection is not None:
+            collection.insert_one(document)
+            logging.info(f"Queued job {job_id} for {file_metadata['filename']}")
+            return True
+    except Exception as e:
+        logging.error(f"Error creating job {job_id}: {e}")
+    return False
+
+# Function to move a job to a new status (e.g. "running")
+def update_job_status(job_id, status):
+    try:
+        collection = get_collection("pdf_database", "pdf_documents")
+        if collection is not None:
+            collection.update_one({"job_id": job_id}, {"$set": {"status": status, "timestamp": datetime.now()}})
+    except Exception as e:
+        logging.error(f"Error updating job {job_id} to {status}: {e}")
+
+# Function to fetch a job's document by id
+def get_job(job_id):
+    try:
+        collection = get_collection("pdf_database", "pdf_documents")
+        if collection is not None:
+            return collection.find_one({"job_id": job_id}, {"_id": 0})
     except Exception as e:
-        logging.error(f"Error updating error status for {file_metadata['filename']}: {e}")
+        logging.error(f"Error fetching job {job_id}: {e}")
+    return None
 
-# Function to export MongoDB collection to a JSON file
-def export_collection(output_file):
+# Function to export MongoDB collection to a JSON file.
+# Documents are streamed from the cursor in batches and written one at a time,
+# so memory stays flat regardless of collection size. fmt is "json" (an array)
+# or "ndjson" (one document per line); gzip is used when compress is set or the
+# file name ends in .gz. progress_callback(count) runs every progress_every docs.
+def export_collection(output_file, fmt="json", compress=None, projection=None, status=None,
+                      since=None, until=None, batch_size=500, progress_callback=None, progress_every=1000):
+    if fmt not in ("json", "ndjson"):
+        raise ValueError(f"Unsupported export format: {fmt}")
+    if compress is None:
+        compress = output_file.endswith(".gz")
+    exported = 0
     try:
+        from bson import json_util as bson_json
         collection = get_collection("pdf_database", "pdf_documents")
-        if collection:
-            documents = collection.find()
-            with open(output_file, 'w') as file:
-                file.write(bson_json.dumps(list(documents), indent=4))
-            logging.info(f"Exported MongoDB collection to {output_file}")
+        if collection is not None:
+            documents = collection.find(_export_filter(status, since, until), projection, batch_size=batch_size)
+            opener = gzip.open if compress else open
+            with opener(output_file, 'wt', encoding='utf-8') as file:
+                if fmt == "json":
+                    file.write("[")
+                for document in documents:
+                    if fmt == "json":
+                        file.write(",\n" if exported else "\n")
+                        file.write(bson_json.dumps(document, indent=4))
+                    else:
+                        file.write(bson_json.dumps(document))
+                        file.write("\n")
+                    exported += 1
+                    if progress_callback and exported % progress_every == 0:
+                        progress_callback(exported)
+                if fmt == "json":
+                    file.write("\n]\n" if exported else "]\n")
+            # The final count, unless the loop just reported it
+            if progress_callback and exported % progress_every:
+                progress_callback(exported)
+            logging.info(f"Exported {exported} documents from MongoDB collection to {output_file}")
     except Exception as e:
         logging.error(f"Error exporting MongoDB collection: {e}")
+    return exported
 
 # Function to count documents based on their status
 def count_documents(status):
     try:
         collection = get_collection("pdf_database", "pdf_documents")
-        if collection:
+        if collection is not None:
             return collection.count_documents({"status": status})
     except Exception as e:
         logging.error(f"Error counting documents with status {status}: {e}")
     return 0
 
-# Function to check if a document already exists in MongoDB
-def document_exists(url):
+# Fields of a document's record that an incremental run resumes from
+CHECKPOINT_FIELDS = ("url", "document_name", "status", "stage", "sha256", "category",
+                     "page_count", "summary", "keywords", "processing_time")
+
+# Function to fetch the latest record for each URL; url -> record. URLs are
+# queried in chunks with a projected $in so the lookup is served by the url index.
+def load_checkpoints(urls, chunk_size=1000):
+    checkpoints = {}
+    urls = list(dict.fromkeys(urls))
+    projection = dict.fromkeys(CHECKPOINT_FIELDS, 1)
+    projection["_id"] = 0
     try:
         collection = get_collection("pdf_database", "pdf_documents")
-        if collection:
-            existing_document = collection.find_one({"url": url})
-            return existing_document is not None
+        if collection is not None:
+            for i in range(0, len(urls), chunk_size):
+                cursor = collection.find({"url": {"$in": urls[i:i + chunk_size]}}, projection).sort("timestamp", 1)
+                checkpoints.update((document["url"], document) for document in cursor)
     except Exception as e:
-        logging.error(f"Error checking document existence for URL {url}: {e}")
-    return False
+        logging.error(f"Error loading checkpoints for {len(urls)} URLs: {e}")
+    return checkpoints
+
+# Function to store a document's MinHash signature and LSH band keys, and the
+# document it is a near duplicate of (if any)
+def record_signature(file_metadata, signature, bands, duplicate_of=None, similarity=None):
+    document_name = _document_name(file_metadata)
+    fields = {"minhash": signature, "lsh_bands": bands}
+    if duplicate_of:
+        fields.update(duplicate_of=duplicate_of, duplicate_similarity=round(similarity, 4))
+    try:
+        if _bulk_writer is not None:
+            _bulk_writer.update(document_name, fields)
+            return
+        collection = get_collection("pdf_database", "pdf_documents")
+        if collection is not None:
+            collection.update_one({"document_name": document_name}, {"$set": fields})
+    except Exception as e:
+        logging.error(f"Error recording signature for {document_name}: {e}")
+
+# Function to fetch processed documents sharing at least one LSH band key,
+# other than the given document; uses the lsh_bands index. The `limit` kept
+# are those sharing the most bands (the likeliest near duplicates), ties
+# broken by document name so the same candidates come back every time.
+def find_by_lsh_bands(bands, exclude_document_name=None, limit=20):
+    query = {"lsh_bands": {"$in": bands}, "status": "processed"}
+    if exclude_document_name:
+        query["document_name"] = {"$ne": exclude_document_name}
+    collection = get_collection("pdf_database", "pdf_documents")
+    if collection is None:
+        return []
+    return list(collection.aggregate([
+        {"$match": query},
+        {"$project": {"_id": 0, "document_name": 1, "minhash": 1, "summary": 1, "keywords": 1, "duplicate_of": 1,
+                      "shared_bands": {"$size": {"$filter": {"input": "$lsh_bands", "as": "band",
+                                                              "cond": {"$in": ["$$band", bands]}}}}}},
+        {"$sort": {"shared_bands": -1, "document_name": 1}},
+        {"$limit": limit},
+    ]))
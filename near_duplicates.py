@@ -0,0 +1,153 @@
+import os
+import re
+import zlib
+import random
+import hashlib
+import logging
+from summarization import load_numpy
+from mongodb_utils import find_by_lsh_bands, record_signature
+
+# Logging setup
+logging.basicConfig(filename='near_duplicates.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Documents whose estimated Jaccard similarity to a processed document is at
+# least this reuse its summary and keywords; 0 disables the lookup
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", "0.8"))
+# Candidates sharing an LSH band that are compared signature to signature
+NEAR_DUPLICATE_MAX_CANDIDATES = int(os.getenv("NEAR_DUPLICATE_MAX_CANDIDATES", "20"))
+
+# Signature layout: MinHash over word 3-shingles, split into 20 bands of 6
+# rows for LSH. Two documents share a band with probability 1 - (1 - s^6)^20
+# for Jaccard similarity s: about 0.998 at 0.8 and under 0.05 at 0.4.
+# Signatures from another layout are not comparable, so the layout is part of
+# the version that prefixes every band key.
+SHINGLE_SIZE = 3
+LSH_BANDS = 20
+LSH_ROWS = 6
+NUM_PERMUTATIONS = LSH_BANDS * LSH_ROWS
+MINHASH_SEED = 1
+MINHASH_VERSION = f"minhash-v1-k{SHINGLE_SIZE}-{LSH_BANDS}x{LSH_ROWS}"
+
+# Permutations are h(x) = (a * x + b) mod p over 32-bit shingle hashes; with a
+# and b below 2^31 the products stay within 64 bits
+_PRIME = (1 << 32) + 15
+_BLOCK_SIZE = 8192
+_TOKEN = re.compile(r"[a-z0-9]+")
+_permutations = None
+
+
+def _get_permutations():
+    global _permutations
+    if _permutations is None:
+        rng = random.Random(MINHASH_SEED)
+        _permutations = ([rng.randrange(1, 1 << 31) for _ in range(NUM_PERMUTATIONS)],
+                         [rng.randrange(0, 1 << 31) for _ in range(NUM_PERMUTATIONS)])
+    return _permutations
+
+
+# MinHash signature built up from text fed in pieces (e.g. page by page).
+# Text is reduced to lowercase alphanumeric words, so punctuation and
+# whitespace noise from OCR do not change the shingles.
+class MinHash:
+    def __init__(self):
+        self.mins = None
+        self._tail = []
+
+    def update(self, text):
+        tokens = self._tail + _TOKEN.findall(text.lower())
+        self._tail = tokens[-(SHINGLE_SIZE - 1):]
+        if len(tokens) < SHINGLE_SIZE:
+            return
+        hashes = {zlib.crc32(" ".join(tokens[i:i + SHINGLE_SIZE]).encode('utf-8'))
+                  for i in range(len(tokens) - SHINGLE_SIZE + 1)}
+        mins = self._min_hashes(hashes)
+        self.mins = mins if self.mins is None else [min(old, new) for old, new in zip(self.mins, mins)]
+
+    def _min_hashes(self, hashes):
+        a, b = _get_permutations()
+        numpy = load_numpy()
+        if not numpy:
+            return [min((a_i * x + b_i) % _PRIME for x in hashes) for a_i, b_i in zip(a, b)]
+        values = numpy.fromiter(hashes, dtype=numpy.uint64, count=len(hashes))
+        a = numpy.array(a, dtype=numpy.uint64)
+        b = numpy.array(b, dtype=numpy.uint64)
+        mins = numpy.full(NUM_PERMUTATIONS, _PRIME, dtype=numpy.uint64)
+        # Blocks bound the (shingles x permutations) matrix
+        for start in range(0, len(values), _BLOCK_SIZE):
+            block = values[start:start + _BLOCK_SIZE, None]
+            mins = numpy.minimum(mins, ((block * a + b) % _PRIME).min(axis=0))
+        return mins.tolist()
+
+    # The signature as a list of ints, or None if no shingle was seen
+    def signature(self):
+        return self.mins
+
+
+# Function to compute the MinHash signature of a text; None for texts too short to shingle
+def signature_for_text(text):
+    minhash = MinHash()
+    minhash.update(text)
+    return minhash.signature()
+
+
+# Function to get the LSH band keys of a signature (one per band, version-prefixed)
+def lsh_bands(signature):
+    bands = []
+    for band in range(LSH_BANDS):
+        rows = signature[band * LSH_ROWS:(band + 1) * LSH_ROWS]
+        digest = hashlib.blake2b(",".join(map(str, rows)).encode('ascii'), digest_size=8).hexdigest()
+        bands.append(f"{MINHASH_VERSION}:{band}:{digest}")
+    return bands
+
+
+# Estimated Jaccard similarity: the fraction of matching signature rows
+def signature_similarity(signature, other):
+    if not signature or not other or len(signature) != len(other):
+        return 0.0
+    return sum(1 for x, y in zip(signature, other) if x == y) / len(signature)
+
+
+# Function to find the processed document most similar to a signature. The
+# LSH bands narrow the search to the documents sharing at least one band
+# (an indexed lookup), whose signatures are then compared. Returns the match
+# with its "similarity", or None below the threshold.
+def find_near_duplicate(signature, document_name=None, threshold=None):
+    threshold = NEAR_DUPLICATE_THRESHOLD if threshold is None else threshold
+    if not signature or threshold <= 0:
+        return None
+    best, best_similarity = None, 0.0
+    for candidate in find_by_lsh_bands(lsh_bands(signature), document_name, NEAR_DUPLICATE_MAX_CANDIDATES):
+        similarity = signature_similarity(signature, candidate.get("minhash"))
+        if similarity > best_similarity:
+            best, best_similarity = candidate, similarity
+    if best is None or best_similarity < threshold:
+        return None
+    return dict(best, similarity=best_similarity)
+
+
+# Function to store a document's signature and look up its near duplicate.
+# A match is linked through duplicate_of (to the original when the match is a
+# duplicate itself) and returned with its summary and keywords; None otherwise.
+# With reuse=False (the document already has its own summary, e.g. streamed
+# documents) only the signature is stored: duplicate_of marks reused summaries.
+def link_near_duplicate(file_metadata, signature, reuse=True):
+    if not signature:
+        return None
+    if not reuse:
+        record_signature(file_metadata, signature, lsh_bands(signature))
+        return None
+    document_name = file_metadata['filename'] if isinstance(file_metadata, dict) else file_metadata
+    try:
+        match = find_near_duplicate(signature, document_name)
+    except Exception as e:
+        logging.error(f"Error looking up near duplicates of {document_name}: {e}")
+        match = None
+    duplicate_of = None
+    if match:
+        duplicate_of = match.get("duplicate_of") or match["document_name"]
+        match["duplicate_of"] = duplicate_of
+        logging.info(f"{document_name} is a near duplicate of {duplicate_of} "
+                     f"(similarity {match['similarity']:.2f})")
+    record_signature(file_metadata, signature, lsh_bands(signature), duplicate_of,
+                     match["similarity"] if match else None)
+    return match
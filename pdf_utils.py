@@ -1,99 +1,566 @@
-import requests
-import fitz  # PyMuPDF
+import io
+import os
+import json
+import atexit
+import tempfile
+import threading
 import logging
+from collections import deque, namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from hashlib import sha256
 import time
-from retry import retry
-from PyPDF2 import PdfReader
+from retry.api import retry_call
 
 # Logging setup
 logging.basicConfig(filename='pdf_utils.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Function to download a PDF with retry mechanism
-@retry(tries=3, delay=5, backoff=2)
-def download_pdf(url):
+# Text extraction settings, overridable through the environment
+PDF_EXTRACT_ENGINE = os.getenv("PDF_EXTRACT_ENGINE", "pymupdf")
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", str(os.cpu_count() or 1)))
+PDF_PARALLEL_PAGE_THRESHOLD = int(os.getenv("PDF_PARALLEL_PAGE_THRESHOLD", "60"))
+PDF_PAGES_PER_CHUNK = int(os.getenv("PDF_PAGES_PER_CHUNK", "20"))
+
+# Bump whenever extracted text changes for the same engine, so cached results are not reused
+EXTRACTOR_VERSION = "1"
+
+# Download settings, overridable through the environment
+PDF_DOWNLOAD_MAX_BYTES = int(os.getenv("PDF_DOWNLOAD_MAX_BYTES", str(200 * 1024 * 1024)))
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "10"))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "20"))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_CACHE_FILE = ".download_cache.json"
+DOWNLOAD_CACHE_JOURNAL_LINES = 1000
+
+
+# Raised while streaming a response that grows past PDF_DOWNLOAD_MAX_BYTES
+class DownloadTooLarge(Exception):
+    pass
+
+# requests, PyMuPDF and PyPDF2 are imported where they are first used, so that
+# importing this module (e.g. from the web app) stays cheap
+
+# Shared HTTP session so downloads reuse keep-alive connections per host
+_http_session = None
+_http_session_pid = None
+_http_session_lock = threading.Lock()
+
+
+# Function to get the process-wide HTTP session, creating it on first use
+def get_http_session():
+    global _http_session, _http_session_pid
+    if _http_session is not None and _http_session_pid == os.getpid():
+        return _http_session
+    with _http_session_lock:
+        if _http_session is None or _http_session_pid != os.getpid():
+            import requests
+            import requests.adapters
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_session = session
+            _http_session_pid = os.getpid()
+    return _http_session
+
+
+# Validators (ETag/Last-Modified) and content details of previously downloaded
+# URLs, persisted as JSON next to the downloaded files. Each put appends one
+# line to a journal beside the JSON snapshot rather than rewriting it; the
+# journal is folded into the snapshot once it has as many lines as the
+# snapshot has entries (and at least DOWNLOAD_CACHE_JOURNAL_LINES).
+class DownloadCache:
+    def __init__(self, path):
+        self.path = path
+        self.journal_path = f"{path}.journal"
+        self._lock = threading.Lock()
+        self._entries = None
+        self._journal_lines = 0
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path, 'r') as cache_file:
+                    self._entries = json.load(cache_file)
+            except (OSError, ValueError):
+                self._entries = {}
+            try:
+                with open(self.journal_path, 'r') as journal_file:
+                    for line in journal_file:
+                        try:
+                            url, entry = json.loads(line)
+                        except ValueError:
+                            # A line cut short by a crash
+                            continue
+                        self._entries[url] = entry
+                        self._journal_lines += 1
+            except OSError:
+                pass
+        return self._entries
+
+    def get(self, url):
+        with self._lock:
+            entry = self._load().get(url)
+        if entry and os.path.exists(entry["path"]):
+            return dict(entry)
+        return None
+
+    def put(self, url, entry):
+        with self._lock:
+            entries = self._load()
+            entries[url] = entry
+            with open(self.journal_path, 'a') as journal_file:
+                journal_file.write(json.dumps([url, entry]) + "\n")
+            self._journal_lines += 1
+            if self._journal_lines >= max(len(entries), DOWNLOAD_CACHE_JOURNAL_LINES):
+                self._compact()
+
+    # Write every entry to the snapshot and start an empty journal
+    def _compact(self):
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as cache_file:
+            json.dump(self._entries, cache_file)
+        os.replace(temp_path, self.path)
+        try:
+            os.remove(self.journal_path)
+        except FileNotFoundError:
+            pass
+        self._journal_lines = 0
+
+
+_download_caches = {}
+
+
+# Function to get the download cache for a destination folder
+def get_download_cache(dest_folder):
+    cache_path = os.path.join(os.path.abspath(dest_folder), DOWNLOAD_CACHE_FILE)
+    with _http_session_lock:
+        if cache_path not in _download_caches:
+            _download_caches[cache_path] = DownloadCache(cache_path)
+        return _download_caches[cache_path]
+
+
+# Conditional request headers that revalidate a cached download
+def conditional_headers(cached):
+    headers = {}
+    if cached:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+    return headers
+
+
+# Final file name and path for a URL's download (named by the URL's hash)
+def download_path(url, dest_folder):
+    file_name = sha256(url.encode()).hexdigest() + ".pdf"
+    return file_name, os.path.join(dest_folder, file_name)
+
+
+# Function to download a PDF with retry mechanism. The body is streamed to
+# dest_folder in chunks and hashed on the fly; responses larger than
+# PDF_DOWNLOAD_MAX_BYTES are rejected. A URL downloaded before is revalidated
+# with If-None-Match/If-Modified-Since and reused on 304 Not Modified.
+# Returns file metadata (filename, path, size, sha256, url, cached) or None.
+def download_pdf(url, dest_folder="."):
+    import requests
+    return retry_call(_download_pdf_once, fargs=(url, dest_folder),
+                      exceptions=requests.exceptions.RequestException, tries=3, delay=5, backoff=2)
+
+
+# One download attempt for download_pdf; request errors are re-raised for retrying
+def _download_pdf_once(url, dest_folder):
+    import requests
+    os.makedirs(dest_folder, exist_ok=True)
+    cache = get_download_cache(dest_folder)
+    cached = cache.get(url)
+    headers = conditional_headers(cached)
+    file_name, file_path = download_path(url, dest_folder)
+    temp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.part"
     try:
-        response = requests.get(url, stream=True, timeout=10, verify=False)
-        if response.status_code == 200:
-            file_content = response.content
-            file_name = sha256(url.encode()).hexdigest() + ".pdf"
+        with get_http_session().get(url, stream=True, timeout=10, verify=False, headers=headers) as response:
+            if response.status_code == 304 and cached:
+                logging.info(f"Not modified, reusing cached download: {file_name}")
+                cached["cached"] = True
+                return cached
+            if response.status_code != 200:
+                logging.error(f"Failed to download {url} with status code {response.status_code}")
+                return None
+
+            declared_size = int(response.headers.get("Content-Length") or 0)
+            if declared_size > PDF_DOWNLOAD_MAX_BYTES:
+                logging.error(f"Refusing to download {url}: {declared_size} bytes exceeds the size cap")
+                return None
+
+            digest = sha256()
+            size = 0
+            with open(temp_path, 'wb') as pdf_file:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > PDF_DOWNLOAD_MAX_BYTES:
+                        raise DownloadTooLarge(f"{url} exceeds {PDF_DOWNLOAD_MAX_BYTES} bytes")
+                    digest.update(chunk)
+                    pdf_file.write(chunk)
+            os.replace(temp_path, file_path)
+
+            file_metadata = {
+                "filename": file_name,
+                "path": file_path,
+                "size": size,
+                "sha256": digest.hexdigest(),
+                "url": url,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+            cache.put(url, file_metadata)
             logging.info(f"Downloaded: {file_name}")
-            return file_name, file_content
-        else:
-            logging.error(f"Failed to download {url} with status code {response.status_code}")
+            return dict(file_metadata, cached=False)
+    except DownloadTooLarge as e:
+        logging.error(f"Refusing to download {e}")
+        return None
     except requests.exceptions.RequestException as e:
         logging.error(f"Error downloading {url}: {e}")
         raise
-    return None, None
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+# A PDF source the engines can open: paths are kept (opened in place),
+# anything else is read into bytes
+def _pdf_data(source):
+    return source if isinstance(source, str) else _read_pdf_bytes(source)
+
+
+# Read a PDF source (path, bytes or file-like object) into bytes
+def _read_pdf_bytes(source):
+    if isinstance(source, (bytes, bytearray)):
+        return bytes(source)
+    if isinstance(source, str):
+        with open(source, 'rb') as pdf_file:
+            return pdf_file.read()
+    if hasattr(source, 'seek'):
+        try:
+            source.seek(0)
+        except Exception:
+            pass
+    return source.read()
+
+
+# Text extraction with PyPDF2; slow, but tolerant of some files MuPDF rejects
+class PyPDF2Engine:
+    name = "pypdf2"
+
+    def open(self, data):
+        from PyPDF2 import PdfReader
+        return PdfReader(data if isinstance(data, str) else io.BytesIO(data))
+
+    def page_count(self, document):
+        return len(document.pages)
+
+    def metadata(self, document):
+        info = document.metadata or {}
+        return {key.lstrip('/').lower(): str(value) for key, value in info.items() if value}
+
+    def extract_pages(self, data, start=0, stop=None, document=None):
+        pages = (self.open(data) if document is None else document).pages
+        stop = len(pages) if stop is None else min(stop, len(pages))
+        return [pages[number].extract_text() or "" for number in range(start, stop)]
+
+
+# Text extraction with PyMuPDF; pages that fail are retried with PyPDF2
+class PyMuPDFEngine:
+    name = "pymupdf"
+
+    def __init__(self):
+        self.fallback = PyPDF2Engine()
+
+    def open(self, data):
+        import fitz  # PyMuPDF
+        if isinstance(data, str):
+            return fitz.open(data, filetype="pdf")
+        return fitz.open(stream=data, filetype="pdf")
+
+    def page_count(self, document):
+        return document.page_count
+
+    def metadata(self, document):
+        return {key: value for key, value in (document.metadata or {}).items() if value}
+
+    def extract_pages(self, data, start=0, stop=None, document=None):
+        owned = document is None
+        try:
+            # Not `document or ...`: a document without pages is falsy
+            if document is None:
+                document = self.open(data)
+        except Exception as e:
+            logging.warning(f"PyMuPDF could not open PDF, falling back to PyPDF2: {e}")
+            return self.fallback.extract_pages(data, start, stop)
+
+        try:
+            stop = document.page_count if stop is None else min(stop, document.page_count)
+            pages = []
+            for number in range(start, stop):
+                try:
+                    pages.append(document.load_page(number).get_text())
+                except Exception as e:
+                    logging.warning(f"PyMuPDF failed on page {number}, falling back to PyPDF2: {e}")
+                    pages.append(self._fallback_page(data, number))
+            return pages
+        finally:
+            if owned:
+                document.close()
+
+    def _fallback_page(self, data, number):
+        try:
+            return self.fallback.extract_pages(data, number, number + 1)[0]
+        except Exception as e:
+            logging.error(f"PyPDF2 fallback failed on page {number}: {e}")
+            return ""
+
+
+EXTRACTION_ENGINES = {
+    PyMuPDFEngine.name: PyMuPDFEngine,
+    PyPDF2Engine.name: PyPDF2Engine,
+}
+
+
+# Identifies the text a PDF's cached results were built from: extractor version plus engine
+def extractor_version(engine=None):
+    return f"{EXTRACTOR_VERSION}-{(engine or PDF_EXTRACT_ENGINE).lower()}"
+
+
+# Function to get a text extraction engine by name (defaults to PDF_EXTRACT_ENGINE)
+def get_extraction_engine(name=None):
+    name = (name or PDF_EXTRACT_ENGINE).lower()
+    if name not in EXTRACTION_ENGINES:
+        raise ValueError(f"Unknown PDF extraction engine: {name}")
+    return EXTRACTION_ENGINES[name]()
+
+
+# Worker entry point for page-parallel extraction; module level so it can be
+# pickled. Workers get the PDF's path and open it themselves.
+def _extract_page_range(engine_name, path, start, stop):
+    return get_extraction_engine(engine_name).extract_pages(path, start, stop)
+
+
+# Process pool for page-parallel extraction, started on first use and shared
+# by every large document, so worker processes (and their PyMuPDF imports)
+# are started once rather than per document
+_extract_pool = None
+_extract_pool_pid = None
+_extract_pool_lock = threading.Lock()
+
+
+def get_extract_pool():
+    global _extract_pool, _extract_pool_pid
+    with _extract_pool_lock:
+        if _extract_pool is None or _extract_pool_pid != os.getpid():
+            _extract_pool = ProcessPoolExecutor(max_workers=max(PDF_EXTRACT_WORKERS, 1))
+            _extract_pool_pid = os.getpid()
+        return _extract_pool
+
+
+# Function to stop the extraction pool; a later extraction starts a new one
+def shutdown_extract_pool(pool=None):
+    global _extract_pool
+    with _extract_pool_lock:
+        if _extract_pool is None or (pool is not None and pool is not _extract_pool):
+            return
+        pool, _extract_pool = _extract_pool, None
+    if _extract_pool_pid == os.getpid():
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+atexit.register(shutdown_extract_pool)
+
+
+# Extract every page from an already opened document, splitting documents with
+# at least PDF_PARALLEL_PAGE_THRESHOLD pages into ranges for the shared
+# extraction pool, with at most `workers` ranges in flight. data is a path or
+# bytes; bytes are spooled to a temporary file once so that every task only
+# carries a path.
+def _extract_all_pages(engine, data, document, page_count, workers):
+    workers = workers or PDF_EXTRACT_WORKERS
+    if workers <= 1 or page_count < PDF_PARALLEL_PAGE_THRESHOLD:
+        return engine.extract_pages(data, document=document)
+
+    ranges = [(start, min(start + PDF_PAGES_PER_CHUNK, page_count))
+              for start in range(0, page_count, PDF_PAGES_PER_CHUNK)]
+    temp_path = None
+    if isinstance(data, str):
+        path = data
+    else:
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as temp_file:
+            temp_file.write(data)
+        path = temp_path = temp_file.name
+
+    pool = get_extract_pool()
+    pages = []
+    pending = deque()
+
+    def collect():
+        (start, stop), future = pending.popleft()
+        try:
+            pages.extend(future.result())
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                shutdown_extract_pool(pool)
+            logging.warning(f"Parallel extraction of pages {start}-{stop} failed, retrying in-process: {e}")
+            pages.extend(engine.extract_pages(data, start, stop, document=document))
 
-# Function to parse a PDF from a file-like object
-def parse_pdf(file_like_object):
     try:
-        pdf_reader = PdfReader(file_like_object)
-        text = ""
-        for page in pdf_reader.pages:
-            text += page.extract_text()
-        return text
-    except Exception as e:
-        logging.error(f"Error parsing PDF: {e}")
-        return None
+        for start, stop in ranges:
+            try:
+                future = pool.submit(_extract_page_range, engine.name, path, start, stop)
+            except Exception as e:
+                future = Future()
+                future.set_exception(e)
+            pending.append(((start, stop), future))
+            if len(pending) >= workers:
+                collect()
+        while pending:
+            collect()
+    finally:
+        for _, future in pending:
+            future.cancel()
+        if temp_path:
+            os.remove(temp_path)
+    return pages
 
-# Function to save parsed text to a file-like storage (optional: for debugging or further use)
-def save_parsed_text(file_like_name, parsed_text):
+
+# Open a PDF once with the given engine, falling back to PyPDF2 if it cannot be opened
+def _open_document(engine, data):
     try:
-        txt_file_name = file_like_name.replace('.pdf', '.txt')
-        with open(txt_file_name, 'w') as txt_file:
-            txt_file.write(parsed_text)
-        logging.info(f"Saved parsed text to {txt_file_name}")
+        return engine, engine.open(data)
     except Exception as e:
-        logging.error(f"Error saving parsed text: {e}")
+        if isinstance(engine, PyPDF2Engine):
+            raise
+        logging.warning(f"{engine.name} could not open PDF, falling back to PyPDF2: {e}")
+        engine = PyPDF2Engine()
+        return engine, engine.open(data)
+
+
+# Function to extract the text of every page of a PDF, one string per page
+def extract_pages(source, engine=None, workers=None):
+    data = _pdf_data(source)
+    engine = engine if hasattr(engine, 'extract_pages') else get_extraction_engine(engine)
+    engine, document = _open_document(engine, data)
+    try:
+        return _extract_all_pages(engine, data, document, engine.page_count(document), workers)
+    finally:
+        if hasattr(document, 'close'):
+            document.close()
+
+
+# Result of analyze_pdf: the full text plus per-page text and character offsets
+# (page_offsets[i] is the (start, end) slice of page i within text)
+PdfAnalysis = namedtuple('PdfAnalysis', ['text', 'pages', 'page_count', 'category', 'page_offsets', 'metadata'])
 
-# Function to determine the number of pages in a PDF file-like object
-def determine_pdf_page_count(file_like_object):
+
+# Function to decode a PDF exactly once and return its text, page count,
+# length category, per-page offsets and document metadata together. source
+# may also be an open PdfPageStream, whose document is used (and left open)
+# instead of opening the PDF again.
+def analyze_pdf(source, engine=None, workers=None):
     try:
-        document = fitz.open(stream=file_like_object, filetype="pdf")
-        page_count = document.page_count
-        document.close()
-        return page_count
+        if isinstance(source, PdfPageStream):
+            return _analyze_document(source.engine, source.source, source.document, workers)
+        data = _pdf_data(source)
+        engine = engine if hasattr(engine, 'extract_pages') else get_extraction_engine(engine)
+        engine, document = _open_document(engine, data)
+        try:
+            return _analyze_document(engine, data, document, workers)
+        finally:
+            if hasattr(document, 'close'):
+                document.close()
     except Exception as e:
-        logging.error(f"Error determining page count: {e}")
+        logging.error(f"Error analyzing PDF: {e}")
         return None
 
-# Function to categorize a PDF based on page count
-def categorize_pdf(file_like_object):
+
+def _analyze_document(engine, data, document, workers):
+    page_count = engine.page_count(document)
+    metadata = engine.metadata(document)
+    pages = _extract_all_pages(engine, data, document, page_count, workers)
+
+    page_offsets = []
+    position = 0
+    for page in pages:
+        page_offsets.append((position, position + len(page)))
+        position += len(page)
+
+    return PdfAnalysis(
+        text="".join(pages),
+        pages=pages,
+        page_count=page_count,
+        category=categorize_page_count(page_count),
+        page_offsets=page_offsets,
+        metadata=metadata,
+    )
+
+
+# Pages of a PDF decoded one at a time, for consumers that must not hold the
+# whole text (see summarization.summarize_pages). A path is opened in place
+# rather than read into memory. Use as a context manager and iterate:
+#     with PdfPageStream(path) as pages:
+#         for page_text in pages: ...
+class PdfPageStream:
+    def __init__(self, source, engine=None):
+        self.source = _pdf_data(source)
+        engine = engine if hasattr(engine, 'extract_pages') else get_extraction_engine(engine)
+        self.engine, self.document = _open_document(engine, self.source)
+        self.page_count = self.engine.page_count(self.document)
+        self.category = categorize_page_count(self.page_count)
+
+    def __iter__(self):
+        for number in range(self.page_count):
+            yield self.engine.extract_pages(self.source, number, number + 1, document=self.document)[0]
+
+    def close(self):
+        if hasattr(self.document, 'close'):
+            self.document.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Function to parse a PDF from a path, bytes or a file-like object
+def parse_pdf(file_like_object, engine=None):
     try:
-        page_count = determine_pdf_page_count(file_like_object)
-        
-        if page_count is None:
-            return "unknown"
-
-        if 1 <= page_count <= 10:
-            return "short"
-        elif 11 <= page_count <= 30:
-            return "medium"
-        else:
-            return "long"
+        return "".join(extract_pages(file_like_object, engine=engine))
     except Exception as e:
-        logging.error(f"Error categorizing PDF: {e}")
+        logging.error(f"Error parsing PDF: {e}")
+        return None
+
+# Function to map a page count to the short/medium/long category
+def categorize_page_count(page_count):
+    if not page_count:
         return "unknown"
 
+    if 1 <= page_count <= 10:
+        return "short"
+    elif 11 <= page_count <= 30:
+        return "medium"
+    else:
+        return "long"
+
 # Function to handle the entire PDF processing pipeline
 def process_pdf(file_like_object):
     try:
-        # Extract the text content from the PDF
-        parsed_text = parse_pdf(file_like_object)
+        # Decode the PDF once for both the text and the page-count category
+        analysis = analyze_pdf(file_like_object)
 
-        if not parsed_text:
+        if analysis is None or not analysis.text:
             logging.error("Parsed text is empty or None")
             return None
 
-        # Determine PDF category based on the page count
-        pdf_category = categorize_pdf(file_like_object)
-
-        logging.info(f"PDF processed. Category: {pdf_category}")
-        return parsed_text, pdf_category
+        logging.info(f"PDF processed. Category: {analysis.category}")
+        return analysis.text, analysis.category
 
     except Exception as e:
         logging.error(f"Error in processing PDF: {e}")
         return None, None
-
@@ -0,0 +1,286 @@
+import os
+import time
+import signal
+import queue
+import logging
+import threading
+from pdf_utils import analyze_pdf, PdfPageStream
+from summarization import summarize_text, summarize_pages
+from near_duplicates import MinHash, signature_for_text
+
+# Logging setup
+logging.basicConfig(filename='pipeline_errors.log', level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Pipeline sizing, overridable through the environment
+PIPELINE_CPU_WORKERS = int(os.getenv("PIPELINE_CPU_WORKERS", str(os.cpu_count() or 1)))
+PIPELINE_IO_WORKERS = int(os.getenv("PIPELINE_IO_WORKERS", "8"))
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "16"))
+# Documents with at least this many pages are summarized page by page instead of in memory
+STREAMING_MIN_PAGES = int(os.getenv("STREAMING_MIN_PAGES", "200"))
+
+# Marks the end of a stage's input
+_STOP = object()
+
+
+# Counters for one stage; safe to update from several threads
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.processed = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.busy_seconds = 0.0
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def begin(self):
+        with self._lock:
+            self.in_flight += 1
+        return time.monotonic()
+
+    def end(self, started, failed=False):
+        with self._lock:
+            self.in_flight -= 1
+            self.busy_seconds += time.monotonic() - started
+            if failed:
+                self.errors += 1
+            else:
+                self.processed += 1
+
+    def snapshot(self, queue_depth=0):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        with self._lock:
+            return {
+                "stage": self.name,
+                "processed": self.processed,
+                "errors": self.errors,
+                "in_flight": self.in_flight,
+                "queue_depth": queue_depth,
+                "throughput": self.processed / elapsed,
+                "avg_seconds": self.busy_seconds / max(self.processed + self.errors, 1),
+            }
+
+
+# One pipeline stage: a bounded input queue drained by `workers` threads.
+# handler(item) returns the item for the next stage, or None to drop it.
+# Putting into a full queue blocks, which pushes back on the stage upstream.
+# Once the `aborted` event is set, puts are dropped and workers stop taking items.
+class Stage:
+    def __init__(self, name, handler, workers=1, queue_size=None, aborted=None):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size or PIPELINE_QUEUE_SIZE)
+        self.downstream = None
+        self.stats = StageStats(name)
+        self._aborted = aborted or threading.Event()
+        self._threads = []
+
+    def start(self):
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"{self.name}-{number}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def put(self, item):
+        while not self._aborted.is_set():
+            try:
+                self.queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP or self._aborted.is_set():
+                return
+            started = self.stats.begin()
+            try:
+                result = self.handler(item)
+            except Exception as e:
+                logging.error(f"Stage {self.name} failed: {e}")
+                self.stats.end(started, failed=True)
+                continue
+            self.stats.end(started)
+            if result is not None and self.downstream is not None:
+                self.downstream.put(result)
+
+    # Let the workers finish what is queued, then stop them. Once aborted,
+    # what is queued is dropped and the workers stop after their current item.
+    def close(self):
+        if self._aborted.is_set():
+            try:
+                while True:
+                    self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            for _ in self._threads:
+                try:
+                    self.queue.put_nowait(_STOP)
+                except queue.Full:
+                    # Workers see the abort on whatever they take next
+                    break
+        else:
+            for _ in self._threads:
+                self.queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+
+    def snapshot(self):
+        return self.stats.snapshot(self.queue.qsize())
+
+
+# A chain of stages; items submitted to the pipeline flow through every stage
+# in order. Sources that run outside a Stage (like the asyncio fetch stage)
+# can register their own StageStats so they show up in stats().
+class Pipeline:
+    def __init__(self, report_interval=None):
+        self.stages = []
+        self.sources = []
+        self.report_interval = report_interval
+        self.reporters = []
+        self.aborted = threading.Event()
+        self._reporter_stop = threading.Event()
+        self._reporter = None
+
+    def add_stage(self, name, handler, workers=1, queue_size=None):
+        stage = Stage(name, handler, workers, queue_size, self.aborted)
+        if self.stages:
+            self.stages[-1].downstream = stage
+        self.stages.append(stage)
+        return stage
+
+    def add_source(self, name):
+        stats = StageStats(name)
+        self.sources.append(stats)
+        return stats
+
+    # Extra status lines for the periodic report: callables returning a string
+    def add_reporter(self, reporter):
+        self.reporters.append(reporter)
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+        if self.report_interval:
+            self._reporter = threading.Thread(target=self._report, name="pipeline-stats", daemon=True)
+            self._reporter.start()
+
+    def submit(self, item):
+        self.stages[0].put(item)
+
+    # Stop processing: queued items are dropped and nothing more is accepted.
+    # Only sets a flag, so it is safe to call from a signal handler; close()
+    # then stops the stages.
+    def abort(self):
+        self.aborted.set()
+
+    # Drain and stop the stages front to back, so nothing is left queued
+    # (after abort(), stop them without draining)
+    def close(self):
+        for stage in self.stages:
+            stage.close()
+        self._reporter_stop.set()
+        if self._reporter is not None:
+            self._reporter.join()
+
+    def stats(self):
+        return [source.snapshot() for source in self.sources] + [stage.snapshot() for stage in self.stages]
+
+    def format_stats(self):
+        return " | ".join(
+            f"{s['stage']}: {s['processed']} done, {s['errors']} err, "
+            f"{s['throughput']:.2f}/s, queue {s['queue_depth']}, busy {s['in_flight']}"
+            for s in self.stats()
+        )
+
+    def _report(self):
+        while not self._reporter_stop.wait(self.report_interval):
+            print(self.format_stats())
+            for reporter in self.reporters:
+                print(reporter())
+
+
+# Process pool initializer: leave Ctrl-C to the parent, which drains the pipeline
+def ignore_interrupts():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+# CPU stage tasks. These run in a process pool, so they live at module level
+# and only take and return picklable values. Each returns the seconds spent per
+# stage under "timings" for the parent to record (metrics do not cross processes).
+
+# Parse task: decode the PDF once (page-parallelism is left to the pool itself)
+# and compute the text's MinHash signature for near-duplicate lookups.
+# Given a text_path, documents of STREAMING_MIN_PAGES or more are streamed
+# instead (see stream_document); the document opened to count the pages is
+# the one that is then analyzed or streamed.
+def parse_document(path, text_path=None, document_id=None):
+    started = time.perf_counter()
+    if text_path is None:
+        analysis = analyze_pdf(path, workers=1)
+    else:
+        try:
+            pages = PdfPageStream(path)
+        except Exception:
+            # analyze_pdf reports the unreadable document
+            pages = None
+        if pages is None:
+            analysis = analyze_pdf(path, workers=1)
+        else:
+            with pages:
+                if pages.page_count >= STREAMING_MIN_PAGES:
+                    return stream_document(pages, text_path, document_id)
+                analysis = analyze_pdf(pages, workers=1)
+    if analysis is None:
+        return None
+    return {"text": analysis.text, "category": analysis.category, "page_count": analysis.page_count,
+            "minhash": signature_for_text(analysis.text) if analysis.text else None,
+            "timings": {"parse": time.perf_counter() - started}}
+
+
+# Summarize task: summary and keywords for the parsed text, with their CPU time.
+# The document is counted into the corpus document-frequency index first.
+def summarize_document(text, document_id=None):
+    timings = {}
+    summary, keywords = summarize_text(text, document_id, timings)
+    return {"summary": summary, "keywords": keywords,
+            "processing_time": timings["summarize"] + timings["keywords"], "timings": timings}
+
+
+# Streaming task for large documents: each page is written to text_path and
+# fed to the summarizer as it is extracted, so the full text is never held in
+# memory. Returns the summary and keywords along with the parse fields, with
+# text set to None.
+def stream_document(pages, text_path, document_id=None):
+    timings = {"parse": 0.0}
+    minhash = MinHash()
+
+    def written_pages():
+        page_iterator = iter(pages)
+        with open(text_path, 'w') as text_file:
+            while True:
+                started = time.perf_counter()
+                page = next(page_iterator, _STOP)
+                timings["parse"] += time.perf_counter() - started
+                if page is _STOP:
+                    return
+                text_file.write(page)
+                minhash.update(page)
+                yield page
+
+    summary, keywords = summarize_pages(written_pages(), document_id, timings=timings)
+    # summarize_pages' clock also ran while the pages were being extracted
+    timings["summarize"] -= timings["parse"]
+    return {
+        "text": None,
+        "text_path": text_path,
+        "category": pages.category,
+        "page_count": pages.page_count,
+        "summary": summary,
+        "keywords": keywords,
+        "processing_time": timings["summarize"] + timings["keywords"],
+        "minhash": minhash.signature(),
+        "timings": timings,
+    }
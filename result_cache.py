@@ -0,0 +1,132 @@
+import os
+import json
+import logging
+import threading
+from collections import OrderedDict
+from pdf_utils import extractor_version
+from summarization import SUMMARIZER_VERSION, sentence_splitter
+
+# Logging setup
+logging.basicConfig(filename='result_cache.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Cache settings, overridable through the environment
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", os.path.join("uploads", ".cache"))
+RESULT_CACHE_MEMORY_BYTES = int(os.getenv("RESULT_CACHE_MEMORY_BYTES", str(32 * 1024 * 1024)))
+RESULT_CACHE_DISK_BYTES = int(os.getenv("RESULT_CACHE_DISK_BYTES", str(512 * 1024 * 1024)))
+
+
+# Summary/keyword results keyed by the SHA-256 of the PDF bytes plus the
+# summarizer and extractor versions. Results live in a memory tier and a
+# disk tier (one JSON file per key); both evict least recently used entries
+# once their byte budget is exceeded.
+class ResultCache:
+    def __init__(self, cache_dir=None, memory_bytes=None, disk_bytes=None):
+        self.cache_dir = cache_dir or RESULT_CACHE_DIR
+        self.memory_bytes = RESULT_CACHE_MEMORY_BYTES if memory_bytes is None else memory_bytes
+        self.disk_bytes = RESULT_CACHE_DISK_BYTES if disk_bytes is None else disk_bytes
+        self._memory = OrderedDict()  # key -> (result, size)
+        self._memory_used = 0
+        self._disk = None  # file name -> size, least recently used first
+        self._disk_used = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, pdf_sha256, engine=None):
+        return f"{pdf_sha256}.s{SUMMARIZER_VERSION}-{sentence_splitter()}.e{extractor_version(engine)}"
+
+    def _load_disk_index(self):
+        if self._disk is not None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and entry.name.endswith(".json"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        self._disk = OrderedDict((name, size) for _, name, size in sorted(entries))
+        self._disk_used = sum(self._disk.values())
+
+    def _remember(self, key, result, size):
+        if key in self._memory:
+            self._memory_used -= self._memory.pop(key)[1]
+        if size > self.memory_bytes:
+            return
+        self._memory[key] = (result, size)
+        self._memory_used += size
+        while self._memory_used > self.memory_bytes:
+            _, (_, evicted_size) = self._memory.popitem(last=False)
+            self._memory_used -= evicted_size
+
+    # Function to look up the cached result for a PDF hash; None on a miss
+    def get(self, pdf_sha256, engine=None):
+        key = self.key(pdf_sha256, engine)
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return dict(self._memory[key][0])
+
+            self._load_disk_index()
+            file_name = key + ".json"
+            if file_name in self._disk:
+                path = os.path.join(self.cache_dir, file_name)
+                try:
+                    with open(path, 'r') as cache_file:
+                        payload = cache_file.read()
+                    result = json.loads(payload)
+                    os.utime(path)
+                    self._disk.move_to_end(file_name)
+                    self._remember(key, result, len(payload))
+                    self.hits += 1
+                    return dict(result)
+                except (OSError, ValueError) as e:
+                    logging.error(f"Dropping unreadable cache entry {file_name}: {e}")
+                    self._disk_used -= self._disk.pop(file_name)
+            self.misses += 1
+            return None
+
+    # Function to store a result (summary, keywords, ...) for a PDF hash in both tiers
+    def put(self, pdf_sha256, result, engine=None):
+        key = self.key(pdf_sha256, engine)
+        payload = json.dumps(result)
+        file_name = key + ".json"
+        with self._lock:
+            self._remember(key, dict(result), len(payload))
+            try:
+                self._load_disk_index()
+                path = os.path.join(self.cache_dir, file_name)
+                temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(temp_path, 'w') as cache_file:
+                    cache_file.write(payload)
+                os.replace(temp_path, path)
+                if file_name in self._disk:
+                    self._disk_used -= self._disk.pop(file_name)
+                self._disk[file_name] = len(payload)
+                self._disk_used += len(payload)
+                self._evict_disk()
+            except OSError as e:
+                logging.error(f"Error writing cache entry {file_name}: {e}")
+
+    def _evict_disk(self):
+        while self._disk_used > self.disk_bytes and self._disk:
+            file_name, size = self._disk.popitem(last=False)
+            self._disk_used -= size
+            try:
+                os.remove(os.path.join(self.cache_dir, file_name))
+            except OSError:
+                pass
+            logging.info(f"Evicted cache entry {file_name}")
+
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+# Function to get the process-wide result cache
+def get_result_cache():
+    global _result_cache
+    with _result_cache_lock:
+        if _result_cache is None:
+            _result_cache = ResultCache()
+        return _result_cache
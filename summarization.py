@@ -1,105 +1,377 @@
 import os
 import re
 import math
+import time
+import heapq
 from collections import Counter
+from functools import cached_property
+from itertools import chain
 import html
+import logging
+from df_index import get_df_index
 
-# Optional: Importing NLP libraries for enhanced summary generation
-try:
-    import nltk
-    from nltk.tokenize import sent_tokenize
-    nltk.download('punkt', quiet=True)
-except ImportError:
-    nltk = None
+# Bump whenever generate_summary/extract_keywords output changes, so cached results are not reused
+SUMMARIZER_VERSION = "2"
 
-# Function to generate a dynamic summary based on document length
-def generate_summary(text):
-    # Unescape HTML entities and remove unnecessary characters like line breaks and excess whitespace
+# Optional libraries are loaded on first use rather than at import: nltk's
+# Punkt sentence tokenizer for enhanced summary generation, and NumPy for
+# vectorized sentence scoring on long documents. Punkt data is only looked up
+# locally (NLTK_DATA_DIR first, then nltk's usual paths) and never downloaded;
+# vendor it once with: python -m nltk.downloader -d nltk_data punkt punkt_tab
+NLTK_DATA_DIR = os.getenv("NLTK_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "nltk_data"))
+_sentence_tokenizer = None  # False once known to be unavailable
+_numpy = None
+
+
+# Function to load the Punkt sentence tokenizer; None when nltk or its data is missing
+def load_sentence_tokenizer():
+    global _sentence_tokenizer
+    if _sentence_tokenizer is None:
+        try:
+            import nltk
+            from nltk.tokenize import sent_tokenize
+            if NLTK_DATA_DIR not in nltk.data.path:
+                nltk.data.path.insert(0, NLTK_DATA_DIR)
+            sent_tokenize("Loads the model. Raises LookupError without it.")
+            _sentence_tokenizer = sent_tokenize
+        except ImportError:
+            logging.warning("nltk is not installed, splitting sentences with a regex")
+            _sentence_tokenizer = False
+        except LookupError:
+            logging.warning(f"Punkt data not found (looked in {NLTK_DATA_DIR} and nltk's data paths), splitting sentences with a regex")
+            _sentence_tokenizer = False
+    return _sentence_tokenizer or None
+
+
+# Function to name the sentence splitter in use, "punkt" or "regex". The two
+# split text differently, so it is part of the summarizer's cache key.
+def sentence_splitter():
+    return "punkt" if load_sentence_tokenizer() else "regex"
+
+
+# Function to load NumPy; None when it is not installed
+def load_numpy():
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy or None
+
+# Documents with at least this many sentences are scored with NumPy when it is available
+VECTORIZED_SCORING_MIN_SENTENCES = int(os.getenv("VECTORIZED_SCORING_MIN_SENTENCES", "100"))
+
+# Candidate sentences kept by summarize_pages while streaming a document
+STREAMING_CANDIDATE_POOL = int(os.getenv("STREAMING_CANDIDATE_POOL", "64"))
+# Longest unfinished sentence summarize_pages carries over to the next page;
+# longer text without a sentence end (tables, OCR output, code) is taken as a sentence
+STREAMING_MAX_CARRY_CHARS = int(os.getenv("STREAMING_MAX_CARRY_CHARS", "10000"))
+
+# Common stop words ignored when scoring sentences and keywords
+STOP_WORDS = frozenset([
+    "the", "and", "is", "in", "to", "of", "a", "that", "it", "on", "for",
+    "with", "as", "by", "this", "an", "be", "at", "which", "or", "from",
+    "was", "were", "their", "there", "can", "will", "would"
+])
+
+# Precompiled patterns shared by the summary and keyword stages
+WORD_PATTERN = re.compile(r'\w+')
+WHITESPACE_PATTERN = re.compile(r'\s+')
+UNICODE_PUNCTUATION_PATTERN = re.compile(r'[\u201c\u201d\u2014\u2026]+')
+NUMBER_PATTERN = re.compile(r'\b\d+\b')
+SENTENCE_SPLIT_PATTERN = re.compile(r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)((?<=\.|\?|!))\s')
+
+
+# Function to clean text for summarization: unescape HTML entities and remove
+# line breaks, excess whitespace, unwanted unicode characters and numbers
+def normalize_text(text):
     text = html.unescape(text)
-    text = re.sub(r'\s+', ' ', text.replace("\n", " ").replace("\\", "").replace(";", "").replace(":", "")).strip()
-    text = re.sub(r'[\u201c\u201d\u2014\u2026]+', '', text)  # Remove unwanted unicode characters
-    text = re.sub(r'\b\d+\b', '', text)  # Remove numbers
-    
-    # Split the text into sentences using nltk if available, otherwise use regex
-    if nltk:
-        sentences = sent_tokenize(text)
-    else:
-        sentences = re.split(r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)((?<=\.|\?|!))\s', text)
-    
+    text = WHITESPACE_PATTERN.sub(' ', text.replace("\n", " ").replace("\\", "").replace(";", "").replace(":", "")).strip()
+    text = UNICODE_PUNCTUATION_PATTERN.sub('', text)  # Remove unwanted unicode characters
+    return NUMBER_PATTERN.sub('', text)  # Remove numbers
+
+
+# Function to split normalized text into sentences using nltk if available, otherwise regex
+def split_sentences(text):
+    sent_tokenize = load_sentence_tokenizer()
+    if sent_tokenize:
+        return sent_tokenize(text)
+    return SENTENCE_SPLIT_PATTERN.split(text)
+
+
+# Significant words of a piece of text: lowercased, not stop words, longer than 4 characters
+def significant_words(text):
+    if text.isascii():
+        # Lowercasing ASCII never changes word boundaries, so do it once for the whole text
+        return [word for word in WORD_PATTERN.findall(text.lower()) if len(word) > 4 and word not in STOP_WORDS]
+    return [word.lower() for word in WORD_PATTERN.findall(text) if len(word) > 4 and word.lower() not in STOP_WORDS]
+
+
+# Number of sentences to select based on document length
+def summary_length(sentence_count):
+    if sentence_count <= 10:
+        return 2  # Short document
+    elif sentence_count <= 30:
+        return 3  # Medium document
+    return 5  # Long document
+
+
+# Tokens and sentences of one document, built once and shared by the summary
+# and keyword stages. Each piece is computed on first use: the summary works
+# on the normalized text, keywords on the significant words of the raw text.
+class TextAnalysis:
+    def __init__(self, text):
+        self.raw_text = text
+
+    @cached_property
+    def text(self):
+        return normalize_text(self.raw_text)
+
+    @cached_property
+    def sentences(self):
+        return split_sentences(self.text)
+
+    # Significant words of each sentence, tokenized once
+    @cached_property
+    def sentence_words(self):
+        return [significant_words(sentence) for sentence in self.sentences]
+
+    # Frequencies of significant words in the normalized text
+    @cached_property
+    def word_freq(self):
+        word_freq = Counter()
+        for words in self.sentence_words:
+            word_freq.update(words)
+        return word_freq
+
+    # Counts of significant words in the raw text, in order of first appearance
+    @cached_property
+    def keyword_counts(self):
+        return Counter(significant_words(self.raw_text))
+
+    # Score sentences based on the frequency of significant words they contain
+    def sentence_scores(self):
+        word_freq = self.word_freq
+        return {i: sum(word_freq[word] for word in words) for i, words in enumerate(self.sentence_words)}
+
+    # Indices of the top_k best-scoring sentences in document order. Ties are
+    # broken by position, exactly like a stable sort by descending score.
+    def top_sentence_indices(self, top_k):
+        if len(self.sentences) >= VECTORIZED_SCORING_MIN_SENTENCES and load_numpy():
+            return self._top_sentence_indices_vectorized(top_k)
+        sentence_scores = self.sentence_scores()
+        return sorted(sorted(sentence_scores, key=sentence_scores.get, reverse=True)[:top_k])
+
+    # Same selection with NumPy: the sentence x term count matrix is held in
+    # coordinate form (one row/column pair per token), scores are its product
+    # with the term frequency vector, and the top k come from a partial
+    # partition instead of a full sort
+    def _top_sentence_indices_vectorized(self, top_k):
+        np = load_numpy()
+        sentence_words = self.sentence_words
+        sentence_count = len(sentence_words)
+        lengths = np.fromiter((len(words) for words in sentence_words), dtype=np.int64, count=sentence_count)
+        if not lengths.sum():
+            return list(range(min(top_k, sentence_count)))
+
+        word_freq = self.word_freq
+        term_ids = dict(zip(word_freq, range(len(word_freq))))
+        term_freq = np.fromiter(word_freq.values(), dtype=np.float64, count=len(word_freq))
+        rows = np.repeat(np.arange(sentence_count), lengths)
+        columns = np.fromiter(map(term_ids.__getitem__, chain.from_iterable(sentence_words)),
+                              dtype=np.int64, count=int(lengths.sum()))
+        scores = np.bincount(rows, weights=term_freq[columns], minlength=sentence_count)
+
+        if top_k >= sentence_count:
+            return list(range(sentence_count))
+        kth_score = np.partition(scores, sentence_count - top_k)[sentence_count - top_k]
+        above = np.flatnonzero(scores > kth_score)
+        ties = np.flatnonzero(scores == kth_score)[:top_k - len(above)]
+        return np.sort(np.concatenate([above, ties])).tolist()
+
+    @cached_property
+    def summary(self):
+        return summarize_analysis(self)
+
+    @cached_property
+    def keywords(self):
+        return keywords_from_analysis(self, get_df_index())
+
+
+# Function to analyze text once for both the summary and the keywords
+def analyze_text(text):
+    return TextAnalysis(text)
+
+
+# Function to generate a summary from an analyzed text
+def summarize_analysis(analysis):
+    sentences = analysis.sentences
     if len(sentences) <= 4:
         # If there are only a few sentences, use the entire text as the summary
-        return text
-
-    # Custom sentence scoring based on word frequency (ignoring common stop words)
-    stop_words = set([
-        "the", "and", "is", "in", "to", "of", "a", "that", "it", "on", "for", 
-        "with", "as", "by", "this", "an", "be", "at", "which", "or", "from", 
-        "was", "were", "their", "there", "can", "will", "would"
-    ])
-    
-    word_freq = Counter(
-        word.lower() for word in re.findall(r'\w+', text) if word.lower() not in stop_words and len(word) > 4
-    )
-    
-    # Score sentences based on the frequency of significant words they contain
-    sentence_scores = {}
-    for i, sentence in enumerate(sentences):
-        words = re.findall(r'\w+', sentence)
-        score = sum(word_freq[word.lower()] for word in words if word.lower() in word_freq)
-        sentence_scores[i] = score
-    
+        return analysis.text
+
     # Adjust the number of sentences selected based on document length
-    if len(sentences) <= 10:
-        num_sentences = 2  # Short document
-    elif len(sentences) <= 30:
-        num_sentences = 3  # Medium document
-    else:
-        num_sentences = 5  # Long document
-    
+    num_sentences = summary_length(len(sentences))
+
     # Select the top-scoring sentences for the summary
-    top_sentences_indices = sorted(sentence_scores, key=sentence_scores.get, reverse=True)[:num_sentences]
-    top_sentences = [sentences[i] for i in sorted(top_sentences_indices)]
-    
+    top_sentences = [sentences[i] for i in analysis.top_sentence_indices(num_sentences)]
+
     # Return the final summary
     summary = ' '.join(top_sentences)
     return summary.strip()
 
-# Function to extract domain-specific keywords using a custom TF-IDF implementation
-def extract_keywords(text):
-    # Remove unnecessary characters and filter out stop words
-    stop_words = set([
-        "the", "and", "is", "in", "to", "of", "a", "that", "it", "on", "for", 
-        "with", "as", "by", "this", "an", "be", "at", "which", "or", "from", 
-        "was", "were", "their", "there", "can", "will", "would"
-    ])
-    
-    # Preprocess the text to extract significant words
-    words = [word.lower() for word in re.findall(r'\w+', text) if word.lower() not in stop_words and len(word) > 4]
-    
+
+# Function to extract keywords from an analyzed text using TF-IDF. IDF comes
+# from the corpus-wide document-frequency index when one is available
+def keywords_from_analysis(analysis, df_index=None):
+    return keywords_from_counts(analysis.keyword_counts, df_index)
+
+
+# Function to pick the top TF-IDF keywords from significant-word counts
+def keywords_from_counts(word_counts, df_index=None):
     # Calculate term frequency (TF)
-    word_counts = Counter(words)
-    total_words = len(words)
+    total_words = sum(word_counts.values())
     tf_scores = {word: count / total_words for word, count in word_counts.items()}
-    
-    # Assume we have a larger document corpus and each word appears in multiple documents
-    num_docs = 20
-    df_scores = {word: min(5, max(1, word_counts[word] // 2)) for word in word_counts}
-    
-    # Calculate inverse document frequency (IDF)
-    idf_scores = {word: math.log(num_docs / (1 + df_scores[word])) for word in word_counts}
-    
+
+    # Calculate inverse document frequency (IDF) from real corpus statistics
+    idf_scores = None
+    if df_index is not None:
+        try:
+            if df_index.num_docs:
+                idf_scores = df_index.idf(word_counts)
+        except Exception as e:
+            logging.error(f"Error reading document-frequency index, estimating IDF instead: {e}")
+
+    if idf_scores is None:
+        # Assume we have a larger document corpus and each word appears in multiple documents
+        num_docs = 20
+        df_scores = {word: min(5, max(1, word_counts[word] // 2)) for word in word_counts}
+        idf_scores = {word: math.log(num_docs / (1 + df_scores[word])) for word in word_counts}
+
     # Calculate TF-IDF scores
     tf_idf_scores = {word: tf_scores[word] * idf_scores[word] for word in word_counts}
-    
+
     # Sort and select top 10 keywords, focusing on domain-specific terms
     sorted_keywords = sorted(tf_idf_scores, key=tf_idf_scores.get, reverse=True)[:10]
-    
+
     # Refine keywords to make them domain-specific and non-generic
     domain_specific_keywords = [
-        word for word in sorted_keywords if word not in stop_words and len(word) > 4
+        word for word in sorted_keywords if word not in STOP_WORDS and len(word) > 4
     ]
-    
+
     return domain_specific_keywords
 
-# Functions `generate_summary` and `extract_keywords` have been updated to work with text rather than requiring file paths.
 
+# Function to generate a dynamic summary based on document length
+def generate_summary(text):
+    return analyze_text(text).summary
+
+
+# Function to extract domain-specific keywords using a custom TF-IDF implementation
+def extract_keywords(text, df_index=None):
+    analysis = analyze_text(text)
+    if df_index is None:
+        return analysis.keywords
+    return keywords_from_analysis(analysis, df_index)
+
+
+# Function to generate the summary and keywords together from a single analysis.
+# With a document_id, the document's terms are first counted into the corpus
+# document-frequency index (once per id) so its keywords use real corpus IDF.
+# A timings dict, when given, receives the seconds spent on each ("summarize", "keywords").
+def summarize_text(text, document_id=None, timings=None):
+    started = time.perf_counter()
+    analysis = analyze_text(text)
+    summary = analysis.summary
+    summarized = time.perf_counter()
+    if document_id is not None:
+        try:
+            get_df_index(create=True).add_document(document_id, analysis.keyword_counts)
+        except Exception as e:
+            logging.error(f"Error updating document-frequency index for {document_id}: {e}")
+    keywords = analysis.keywords
+    if timings is not None:
+        timings["summarize"] = summarized - started
+        timings["keywords"] = time.perf_counter() - summarized
+    return summary, keywords
+
+
+# Function to summarize a document from an iterable of page texts without
+# holding the whole text. Word frequencies and keyword counts are accumulated
+# page by page; only a bounded pool of candidate sentences is kept. The pool
+# is rescored with the frequencies seen so far after every page, and the
+# final summary is picked from it with the complete frequencies. Peak memory
+# is one page plus the vocabulary and the pool, not the document. Output
+# matches generate_summary except that a best sentence can be missed if it
+# fell out of the pool early; widen candidate_pool to trade memory for that.
+# timings is filled as for summarize_text; "summarize" includes producing the pages.
+def summarize_pages(pages, document_id=None, candidate_pool=None, timings=None):
+    started = time.perf_counter()
+    candidate_pool = candidate_pool or STREAMING_CANDIDATE_POOL
+    word_freq = Counter()
+    keyword_counts = Counter()
+    pool = []  # heap of (score, -index, index, sentence, words): weakest candidate first
+    first_sentences = []  # kept verbatim for documents of four sentences or fewer
+    sentence_count = 0
+    carry = ""
+
+    def add_sentences(sentences):
+        nonlocal sentence_count, pool
+        sentence_words = [significant_words(sentence) for sentence in sentences]
+        for words in sentence_words:
+            word_freq.update(words)
+
+        # Frequencies only grow, so bring the pool's scores up to date before new sentences compete
+        pool = [(sum(word_freq[word] for word in words), neg_index, index, sentence, words)
+                for _, neg_index, index, sentence, words in pool]
+        heapq.heapify(pool)
+
+        for sentence, words in zip(sentences, sentence_words):
+            index = sentence_count
+            sentence_count += 1
+            if len(first_sentences) <= 4:
+                first_sentences.append(sentence)
+            candidate = (sum(word_freq[word] for word in words), -index, index, sentence, words)
+            if len(pool) < candidate_pool:
+                heapq.heappush(pool, candidate)
+            elif candidate[:2] > pool[0][:2]:
+                heapq.heapreplace(pool, candidate)
+
+    for page in pages:
+        keyword_counts.update(significant_words(page))
+        normalized = normalize_text(page)
+        if not normalized:
+            continue
+        sentences = split_sentences(f"{carry} {normalized}" if carry else normalized)
+        # The last piece may continue on the next page, unless it is already too long
+        carry = sentences.pop()
+        if len(carry) > STREAMING_MAX_CARRY_CHARS:
+            sentences.append(carry)
+            carry = ""
+        add_sentences(sentences)
+    if carry:
+        add_sentences([carry])
+
+    if sentence_count <= 4:
+        summary = ' '.join(sentence for sentence in first_sentences if sentence).strip()
+    else:
+        num_sentences = summary_length(sentence_count)
+        final = sorted(((sum(word_freq[word] for word in words), -index, index, sentence)
+                        for _, _, index, sentence, words in pool), reverse=True)[:num_sentences]
+        summary = ' '.join(sentence for _, _, _, sentence in sorted(final, key=lambda item: item[2])).strip()
+    summarized = time.perf_counter()
+
+    df_index = None
+    try:
+        df_index = get_df_index(create=document_id is not None)
+        if document_id is not None:
+            df_index.add_document(document_id, keyword_counts)
+    except Exception as e:
+        logging.error(f"Error updating document-frequency index for {document_id}: {e}")
+    keywords = keywords_from_counts(keyword_counts, df_index)
+    if timings is not None:
+        timings["summarize"] = summarized - started
+        timings["keywords"] = time.perf_counter() - summarized
+    return summary, keywords
@@ -0,0 +1,79 @@
+import io
+import zipfile
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+import app
+from app import BatchRejected, collect_batch_pdfs
+
+PDF = b"%PDF-1.4 " + b"x" * 100
+
+
+def upload(name, data=PDF):
+    return FileStorage(io.BytesIO(data), filename=name)
+
+
+def zip_upload(name, entries):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for entry, data in entries.items():
+            archive.writestr(entry, data)
+    return upload(name, buffer.getvalue())
+
+
+@pytest.fixture
+def spools(monkeypatch):
+    created = []
+
+    class RecordingSpool(app.UploadSpool):
+        def __init__(self, stream, *args, **kwargs):
+            super().__init__(stream, *args, **kwargs)
+            created.append(self)
+
+    monkeypatch.setattr(app, "UploadSpool", RecordingSpool)
+    return created
+
+
+def test_collects_pdfs_and_the_pdfs_inside_zip_archives(spools):
+    archive = zip_upload("batch.zip", {
+        "docs/b.pdf": PDF,
+        "docs/": b"",
+        "__MACOSX/docs/._b.pdf": b"resource fork",
+        "notes.txt": b"not a pdf",
+        "C.PDF": PDF,
+    })
+    pdfs = collect_batch_pdfs([upload("a.pdf"), archive])
+    assert [name for name, _ in pdfs] == ["a.pdf", "b.pdf", "C.PDF"]
+    assert all(spool.size == len(PDF) for _, spool in pdfs)
+
+
+def test_rejects_more_than_batch_max_files(monkeypatch, spools):
+    monkeypatch.setattr(app, "BATCH_MAX_FILES", 2)
+    with pytest.raises(BatchRejected) as rejected:
+        collect_batch_pdfs([upload("a.pdf"), upload("b.pdf"), upload("c.pdf")])
+    assert rejected.value.status == 413
+    # The PDFs already spooled are released
+    assert all(spool.data is None for spool in spools)
+
+
+def test_rejects_zip_entries_over_batch_max_bytes_before_extracting(monkeypatch, spools):
+    monkeypatch.setattr(app, "BATCH_MAX_BYTES", len(PDF) * 2)
+    archive = zip_upload("batch.zip", {"a.pdf": PDF, "big.pdf": b"%PDF" + b"\0" * (len(PDF) * 4)})
+    with pytest.raises(BatchRejected) as rejected:
+        collect_batch_pdfs([archive])
+    assert rejected.value.status == 413
+    assert len(spools) == 1 and spools[0].data is None
+
+
+def test_rejects_other_file_types_and_empty_batches(spools):
+    with pytest.raises(BatchRejected) as rejected:
+        collect_batch_pdfs([upload("a.pdf"), upload("script.exe")])
+    assert rejected.value.status == 400
+    assert spools[0].data is None
+
+    with pytest.raises(BatchRejected, match="No PDF files"):
+        collect_batch_pdfs([zip_upload("empty.zip", {"notes.txt": b"text"})])
+
+    with pytest.raises(BatchRejected, match="Not a valid ZIP"):
+        collect_batch_pdfs([upload("broken.zip", b"not a zip")])
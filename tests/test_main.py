@@ -0,0 +1,36 @@
+import main
+from result_cache import ResultCache
+
+
+def stored_job(**fields):
+    job = {
+        "url": "http://example.com/a.pdf",
+        "file_metadata": {"filename": "a.pdf", "sha256": "a" * 64},
+        "timings": {},
+        "summary": "A summary.",
+        "keywords": ["summary"],
+        "processing_time": 0.0,
+        "category": "short",
+        "page_count": 1,
+    }
+    job.update(fields)
+    return job
+
+
+def test_summarize_stage_caches_a_summary_made_for_the_document(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path), memory_bytes=1024 * 1024, disk_bytes=1024 * 1024)
+    monkeypatch.setattr(main, "get_result_cache", lambda: cache)
+
+    main.summarize_stage(stored_job())
+
+    assert cache.get("a" * 64)["summary"] == "A summary."
+
+
+def test_summarize_stage_does_not_cache_a_near_duplicates_summary(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path), memory_bytes=1024 * 1024, disk_bytes=1024 * 1024)
+    monkeypatch.setattr(main, "get_result_cache", lambda: cache)
+
+    job = main.summarize_stage(stored_job(duplicate_of="original.pdf"))
+
+    assert job["duplicate_of"] == "original.pdf"
+    assert cache.get("a" * 64) is None
@@ -0,0 +1,135 @@
+import gzip
+import json
+from datetime import datetime
+from types import SimpleNamespace
+
+import mongomock
+import pytest
+from bson import json_util
+from pymongo import InsertOne, UpdateOne
+
+import mongodb_utils
+from mongodb_utils import BulkWriter, export_collection
+
+
+# Collection stand-in that records every bulk_write call
+class RecordingCollection:
+    def __init__(self):
+        self.batches = []
+
+    def bulk_write(self, operations, ordered=True):
+        self.batches.append(list(operations))
+        return SimpleNamespace(inserted_count=0, modified_count=0)
+
+
+def make_writer(collection, batch_size=100):
+    # A long max_age keeps the background flusher out of the way
+    return BulkWriter(collection, batch_size=batch_size, max_age=3600)
+
+
+def test_bulk_writer_merges_updates_per_document():
+    collection = RecordingCollection()
+    writer = make_writer(collection)
+    writer.update("a.pdf", {"status": "parsed"})
+    writer.update("b.pdf", {"status": "parsed"})
+    writer.update("a.pdf", {"status": "processed", "summary": "S"})
+    assert collection.batches == []
+
+    writer.close()
+    assert collection.batches == [[
+        UpdateOne({"document_name": "a.pdf"}, {"$set": {"status": "processed", "summary": "S"}}),
+        UpdateOne({"document_name": "b.pdf"}, {"$set": {"status": "parsed"}}),
+    ]]
+
+
+def test_bulk_writer_upsert_after_update_creates_the_document():
+    collection = RecordingCollection()
+    writer = make_writer(collection)
+    writer.update("a.pdf", {"stage": "parsed"})
+    writer.upsert("a.pdf", {"status": "processed"})
+    writer.close()
+    assert collection.batches == [[
+        UpdateOne({"document_name": "a.pdf"},
+                  {"$set": {"stage": "parsed", "status": "processed", "document_name": "a.pdf"}}, upsert=True),
+    ]]
+
+
+def test_bulk_writer_keeps_insert_and_update_order_for_a_document():
+    collection = RecordingCollection()
+    writer = make_writer(collection)
+    writer.insert({"document_name": "a.pdf", "status": "uploaded"})
+    writer.update("a.pdf", {"status": "processed"})
+    # A second insert of the same document must not be merged ahead of the first
+    writer.insert({"document_name": "a.pdf", "status": "uploaded", "run": 2})
+    writer.close()
+    assert collection.batches == [
+        [InsertOne({"document_name": "a.pdf", "status": "processed"})],
+        [InsertOne({"document_name": "a.pdf", "status": "uploaded", "run": 2})],
+    ]
+
+
+def test_bulk_writer_flushes_when_the_batch_is_full():
+    collection = RecordingCollection()
+    writer = make_writer(collection, batch_size=2)
+    writer.update("a.pdf", {"status": "parsed"})
+    assert collection.batches == []
+    writer.update("b.pdf", {"status": "parsed"})
+    assert len(collection.batches) == 1 and len(collection.batches[0]) == 2
+
+    writer.update("c.pdf", {"status": "parsed"})
+    writer.close()
+    assert len(collection.batches) == 2
+    writer.flush()
+    assert len(collection.batches) == 2
+
+
+@pytest.fixture
+def documents(monkeypatch):
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(mongodb_utils, "get_mongo_client", lambda uri=None: client)
+    collection = client["pdf_database"]["pdf_documents"]
+    collection.insert_many([
+        {"document_name": f"{i}.pdf", "status": "processed" if i % 2 else "error",
+         "timestamp": datetime(2024, 1, 1 + i), "summary": f"Summary {i}"}
+        for i in range(5)
+    ])
+    return collection
+
+
+def read_ndjson(path, compressed=False):
+    with (gzip.open if compressed else open)(path, 'rt', encoding='utf-8') as file:
+        return [json_util.loads(line) for line in file]
+
+
+def test_export_collection_applies_status_and_time_filters(tmp_path, documents):
+    path = str(tmp_path / "export.ndjson")
+    export_collection(path, fmt="ndjson", status="processed", since=datetime(2024, 1, 3),
+                      projection={"_id": 0, "document_name": 1})
+    assert read_ndjson(path) == [{"document_name": "3.pdf"}]
+
+    export_collection(path, fmt="ndjson", status=["processed", "error"], until=datetime(2024, 1, 3),
+                      projection={"_id": 0, "document_name": 1})
+    assert read_ndjson(path) == [{"document_name": "0.pdf"}, {"document_name": "1.pdf"}]
+
+
+def test_export_collection_writes_gzip_json_for_gz_paths(tmp_path, documents):
+    path = str(tmp_path / "export.json.gz")
+    export_collection(path, projection={"_id": 0})
+    with gzip.open(path, 'rt', encoding='utf-8') as file:
+        exported = json_util.loads(file.read())
+    assert [document["document_name"] for document in exported] == [f"{i}.pdf" for i in range(5)]
+
+    export_collection(str(tmp_path / "empty.json"), status="missing")
+    with open(tmp_path / "empty.json") as file:
+        assert json.load(file) == []
+
+
+def test_export_collection_reports_progress_once_per_count(tmp_path, documents):
+    calls = []
+    export_collection(str(tmp_path / "export.json"), progress_callback=calls.append, progress_every=2)
+    assert calls == [2, 4, 5]
+
+    calls = []
+    documents.delete_one({"document_name": "4.pdf"})
+    export_collection(str(tmp_path / "export.json"), progress_callback=calls.append, progress_every=2)
+    assert calls == [2, 4]
@@ -0,0 +1,27 @@
+import pytest
+
+from pdf_utils import PyMuPDFEngine
+
+fitz = pytest.importorskip("fitz")
+
+
+def test_extract_pages_uses_a_given_document_without_pages(monkeypatch):
+    engine = PyMuPDFEngine()
+    opened = []
+    monkeypatch.setattr(engine, "open", lambda data: opened.append(data))
+    document = fitz.open()
+    assert not document  # an empty document is falsy
+
+    assert engine.extract_pages(b"unused", document=document) == []
+    assert opened == []
+    assert not document.is_closed
+
+
+def test_extract_pages_opens_the_pdf_when_no_document_is_given():
+    source = fitz.open()
+    for number in range(3):
+        source.new_page().insert_text((72, 72), f"page {number}")
+    data = source.tobytes()
+
+    pages = PyMuPDFEngine().extract_pages(data, 1)
+    assert [page.strip() for page in pages] == ["page 1", "page 2"]
@@ -0,0 +1,48 @@
+import json
+import os
+
+from result_cache import ResultCache
+
+ENTRY_BYTES = len(json.dumps({"summary": "x" * 100}))
+
+
+def result(name):
+    return {"summary": name * 100}
+
+
+def test_memory_tier_evicts_the_least_recently_used_entry(tmp_path):
+    # Nothing stays on disk, so every hit below comes from memory
+    cache = ResultCache(str(tmp_path), memory_bytes=int(ENTRY_BYTES * 2.5), disk_bytes=0)
+    cache.put("a", result("a"))
+    cache.put("b", result("b"))
+    assert cache.get("a") == result("a")
+
+    cache.put("c", result("c"))
+    assert cache.get("b") is None
+    assert cache.get("a") == result("a")
+    assert cache.get("c") == result("c")
+    assert os.listdir(tmp_path) == []
+
+
+def test_disk_tier_evicts_the_least_recently_used_file(tmp_path):
+    cache = ResultCache(str(tmp_path), memory_bytes=0, disk_bytes=int(ENTRY_BYTES * 2.5))
+    cache.put("a", result("a"))
+    cache.put("b", result("b"))
+    assert cache.get("a") == result("a")
+
+    cache.put("c", result("c"))
+    assert sorted(name.split(".")[0] for name in os.listdir(tmp_path)) == ["a", "c"]
+    assert cache.get("b") is None
+
+    # A new process finds the surviving entries on disk
+    reopened = ResultCache(str(tmp_path), memory_bytes=0, disk_bytes=int(ENTRY_BYTES * 2.5))
+    assert reopened.get("a") == result("a")
+    assert reopened.get("c") == result("c")
+    assert (reopened.hits, reopened.misses) == (2, 0)
+
+
+def test_entries_larger_than_the_memory_budget_are_served_from_disk(tmp_path):
+    cache = ResultCache(str(tmp_path), memory_bytes=ENTRY_BYTES // 2, disk_bytes=ENTRY_BYTES * 4)
+    cache.put("a", result("a"))
+    assert cache.get("a") == result("a")
+    assert len(os.listdir(tmp_path)) == 1
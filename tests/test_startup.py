@@ -0,0 +1,7 @@
+from check_startup import check_startup
+
+
+def test_app_import_stays_within_the_startup_budget():
+    # Each run cold-imports app in a fresh interpreter with the network blocked;
+    # failures name the budget overrun, connections or heavy modules loaded
+    assert check_startup("app", runs=3) == []
@@ -0,0 +1,54 @@
+import random
+
+import pytest
+
+import summarization
+from summarization import TextAnalysis, generate_summary, summarize_pages
+
+
+def test_summarize_pages_bounds_text_without_sentence_ends(monkeypatch):
+    monkeypatch.setattr(summarization, "STREAMING_MAX_CARRY_CHARS", 2000)
+    split_lengths = []
+    split_sentences = summarization.split_sentences
+
+    def recording_split(text):
+        split_lengths.append(len(text))
+        return split_sentences(text)
+
+    monkeypatch.setattr(summarization, "split_sentences", recording_split)
+    page = " ".join(f"cell{i} value{i}" for i in range(100))
+    pages = [page] * 300
+
+    summary, keywords = summarize_pages(iter(pages))
+
+    assert summary
+    assert keywords
+    # Each split sees at most the capped carry plus one page, never the whole document
+    assert max(split_lengths) <= 2000 + len(page) + 1
+
+
+def sample_text(sentence_count, seed):
+    rng = random.Random(seed)
+    # A small vocabulary gives many equal scores, so tie-breaking is exercised
+    vocabulary = [f"term{i}" for i in range(12)]
+    return " ".join(" ".join(rng.choice(vocabulary) for _ in range(rng.randint(0, 8))).capitalize() + "."
+                    for _ in range(sentence_count))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_vectorized_scoring_matches_pure_python(seed):
+    pytest.importorskip("numpy")
+    analysis = TextAnalysis(sample_text(300, seed))
+    sentence_scores = analysis.sentence_scores()
+    for top_k in (1, 5, 17, 60, 299, 300, 400):
+        expected = sorted(sorted(sentence_scores, key=sentence_scores.get, reverse=True)[:top_k])
+        assert analysis._top_sentence_indices_vectorized(top_k) == expected
+
+
+def test_generate_summary_is_the_same_with_and_without_numpy(monkeypatch):
+    pytest.importorskip("numpy")
+    text = sample_text(250, 7)
+    monkeypatch.setattr(summarization, "VECTORIZED_SCORING_MIN_SENTENCES", 1)
+    vectorized = generate_summary(text)
+    monkeypatch.setattr(summarization, "VECTORIZED_SCORING_MIN_SENTENCES", 10 ** 9)
+    assert generate_summary(text) == vectorized
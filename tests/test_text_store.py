@@ -0,0 +1,29 @@
+import shutil
+
+from text_store import TextStore
+
+
+def test_store_survives_its_directory_being_removed(tmp_path):
+    path = str(tmp_path / "store")
+    store = TextStore(path)
+    assert store.put("a", "first text")
+    assert "a" in store
+
+    shutil.rmtree(path)
+    assert "a" not in store
+    assert store.get("a") is None
+    assert len(store) == 0
+
+    assert store.put("b", "second text")
+    assert store.get("b") == "second text"
+    assert "a" not in store
+
+
+def test_store_survives_its_index_being_deleted(tmp_path):
+    path = tmp_path / "store"
+    store = TextStore(str(path))
+    store.put("a", "first text")
+    (path / "index.txt").unlink()
+    assert "a" not in store
+    assert store.reindex() == 1
+    assert store.get("a") == "first text"
@@ -0,0 +1,351 @@
+import os
+import sys
+import mmap
+import zlib
+import fcntl
+import struct
+import logging
+import argparse
+import threading
+
+# Logging setup
+logging.basicConfig(filename='text_store.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Store location and segment size, overridable through the environment
+TEXT_STORE_DIR = os.getenv("TEXT_STORE_DIR", os.path.join("uploads", ".text_store"))
+TEXT_STORE_SEGMENT_BYTES = int(os.getenv("TEXT_STORE_SEGMENT_BYTES", str(64 * 1024 * 1024)))
+TEXT_STORE_COMPRESSION_LEVEL = int(os.getenv("TEXT_STORE_COMPRESSION_LEVEL", "6"))
+
+# File layout inside the store directory:
+#   segment-NNNNNN.seg - append-only records, each a header (magic, key length,
+#                        CRC-32 and length of the text, compressed length)
+#                        followed by the key and the zlib-compressed UTF-8 text
+#   index.txt          - append-only "key segment offset" lines; the last line
+#                        for a key wins. Rebuilt from the segments by reindex().
+#   lock               - flock'd by writers so several processes can append
+SEGMENT_PATTERN = "segment-{:06d}.seg"
+INDEX_FILE = "index.txt"
+LOCK_FILE = "lock"
+RECORD_MAGIC = b"TXS1"
+RECORD_HEADER = struct.Struct("<4sHIQQ")
+CHUNK_SIZE = 1024 * 1024
+
+
+# Parsed text of every document, compressed into a few large append-only
+# segment files and keyed by the document's hash. Lookups go through the
+# offset index and read the record from a memory-mapped segment; iter_texts()
+# streams the whole store segment by segment, for re-summarizing the corpus
+# or rebuilding the document-frequency index without re-parsing any PDF.
+class TextStore:
+    def __init__(self, path=None, segment_bytes=None):
+        self.path = path or TEXT_STORE_DIR
+        self.segment_bytes = segment_bytes or TEXT_STORE_SEGMENT_BYTES
+        self._lock = threading.Lock()
+        self._index = {}
+        self._index_offset = 0
+        self._maps = {}
+
+    def _file_path(self, name):
+        return os.path.join(self.path, name)
+
+    def _segment_path(self, segment):
+        return self._file_path(SEGMENT_PATTERN.format(segment))
+
+    def exists(self):
+        return os.path.exists(self._file_path(INDEX_FILE))
+
+    def _segments(self):
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(int(name[8:14]) for name in os.listdir(self.path)
+                      if name.startswith("segment-") and name.endswith(".seg"))
+
+    # Read index lines appended since the last call (a stat when there are none)
+    def _refresh_index(self):
+        index_path = self._file_path(INDEX_FILE)
+        if not os.path.exists(index_path):
+            # Deleted (or the whole store removed): nothing is stored
+            if self._index_offset:
+                self._reset_index()
+            return
+        size = os.path.getsize(index_path)
+        if size == self._index_offset:
+            return
+        if size < self._index_offset:
+            # Rewritten by reindex(): read it again from the start
+            self._reset_index()
+        with open(index_path, 'rb') as index_file:
+            index_file.seek(self._index_offset)
+            data = index_file.read()
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].decode('utf-8').split("\n")[:-1]:
+            key, segment, offset = line.rsplit(" ", 2)
+            self._index[key] = (int(segment), int(offset))
+        self._index_offset += end
+
+    # Forget the index and the segment maps, which may point at replaced files
+    def _reset_index(self):
+        self._index, self._index_offset = {}, 0
+        self._close_maps()
+
+    def _close_maps(self):
+        for segment_file, segment_map in self._maps.values():
+            segment_map.close()
+            segment_file.close()
+        self._maps = {}
+
+    # Map a segment, remapping when it has grown past the bytes needed
+    def _segment_map(self, segment, needed=0):
+        cached = self._maps.get(segment)
+        if cached is not None and len(cached[1]) >= needed:
+            return cached[1]
+        if cached is not None:
+            cached[1].close()
+            cached[0].close()
+        segment_file = open(self._segment_path(segment), 'rb')
+        segment_map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps[segment] = (segment_file, segment_map)
+        return segment_map
+
+    # Decode the record at offset; returns (key, text, end offset)
+    def _read_record(self, segment, offset):
+        segment_map = self._segment_map(segment, offset + RECORD_HEADER.size)
+        magic, key_length, crc, raw_length, compressed_length = RECORD_HEADER.unpack_from(segment_map, offset)
+        if magic != RECORD_MAGIC:
+            raise ValueError(f"No record at offset {offset} of segment {segment}")
+        start = offset + RECORD_HEADER.size
+        end = start + key_length + compressed_length
+        segment_map = self._segment_map(segment, end)
+        key = segment_map[start:start + key_length].decode('utf-8')
+        data = zlib.decompress(segment_map[start + key_length:end])
+        if len(data) != raw_length or zlib.crc32(data) != crc:
+            raise ValueError(f"Corrupt record for {key} in segment {segment}")
+        return key, data.decode('utf-8'), end
+
+    def __contains__(self, key):
+        with self._lock:
+            self._refresh_index()
+            return key in self._index
+
+    def __len__(self):
+        with self._lock:
+            self._refresh_index()
+            return len(self._index)
+
+    def keys(self):
+        with self._lock:
+            self._refresh_index()
+            return list(self._index)
+
+    # Function to get a document's text, or None if it is not stored
+    def get(self, key):
+        with self._lock:
+            self._refresh_index()
+            location = self._index.get(key)
+            if location is None:
+                return None
+            try:
+                return self._read_record(*location)[1]
+            except Exception as e:
+                logging.error(f"Error reading text for {key}: {e}")
+                return None
+
+    # Function to store a document's text; returns False when the key is
+    # already stored (the same hash has the same text) unless replace is set
+    def put(self, key, text, replace=False):
+        return self._append(key, [text.encode('utf-8')], replace)
+
+    # Function to store the text in a file, read and compressed in chunks so
+    # that very long documents are never held in memory
+    def put_file(self, key, text_path, replace=False):
+        with open(text_path, 'rb') as text_file:
+            return self._append(key, iter(lambda: text_file.read(CHUNK_SIZE), b""), replace)
+
+    def _append(self, key, chunks, replace):
+        if " " in key or "\n" in key:
+            raise ValueError(f"Invalid text store key: {key!r}")
+        with self._lock:
+            os.makedirs(self.path, exist_ok=True)
+            with open(self._file_path(LOCK_FILE), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    self._refresh_index()
+                    if key in self._index and not replace:
+                        return False
+                    self._append_locked(key, chunks)
+                    return True
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _append_locked(self, key, chunks):
+        segments = self._segments()
+        segment = segments[-1] if segments else 1
+        segment_path = self._segment_path(segment)
+        if os.path.exists(segment_path) and os.path.getsize(segment_path) >= self.segment_bytes:
+            segment += 1
+            segment_path = self._segment_path(segment)
+
+        key_bytes = key.encode('utf-8')
+        compressor = zlib.compressobj(TEXT_STORE_COMPRESSION_LEVEL)
+        crc, raw_length, compressed_length = 0, 0, 0
+        # Not opened in append mode: the header is patched in place afterwards
+        with os.fdopen(os.open(segment_path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b') as segment_file:
+            offset = segment_file.seek(0, os.SEEK_END)
+            try:
+                # Header placeholder: the lengths and CRC are known once the text is written
+                segment_file.write(RECORD_HEADER.pack(b"\0" * 4, 0, 0, 0, 0) + key_bytes)
+                for chunk in chunks:
+                    crc = zlib.crc32(chunk, crc)
+                    raw_length += len(chunk)
+                    compressed = compressor.compress(chunk)
+                    segment_file.write(compressed)
+                    compressed_length += len(compressed)
+                compressed = compressor.flush()
+                segment_file.write(compressed)
+                compressed_length += len(compressed)
+                segment_file.seek(offset)
+                segment_file.write(RECORD_HEADER.pack(RECORD_MAGIC, len(key_bytes), crc, raw_length, compressed_length))
+                segment_file.flush()
+                os.fsync(segment_file.fileno())
+            except BaseException:
+                segment_file.truncate(offset)
+                raise
+
+        # The index line is written last, so readers never see a partial record
+        with open(self._file_path(INDEX_FILE), 'ab') as index_file:
+            index_file.write(f"{key} {segment} {offset}\n".encode('utf-8'))
+        self._refresh_index()
+
+    # Yield (key, offset, end offset) for the records of one segment in file order
+    def _scan_segment(self, segment):
+        size = os.path.getsize(self._segment_path(segment))
+        if size == 0:
+            return
+        segment_map = self._segment_map(segment, size)
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(segment_map):
+            magic, key_length, _, _, compressed_length = RECORD_HEADER.unpack_from(segment_map, offset)
+            if magic != RECORD_MAGIC:
+                # A record cut short by a crash ends the scan
+                logging.error(f"Unreadable record at offset {offset} of segment {segment}")
+                return
+            start = offset + RECORD_HEADER.size
+            end = start + key_length + compressed_length
+            yield segment_map[start:start + key_length].decode('utf-8'), offset, end
+            offset = end
+
+    # Function to stream (key, text) for every stored document, reading each
+    # segment front to back; superseded records are skipped
+    def iter_texts(self):
+        with self._lock:
+            self._refresh_index()
+            index = dict(self._index)
+        for segment in self._segments():
+            with self._lock:
+                records = [(key, offset) for key, offset, _ in self._scan_segment(segment)
+                           if index.get(key) == (segment, offset)]
+            for key, offset in records:
+                with self._lock:
+                    text = self._read_record(segment, offset)[1]
+                yield key, text
+
+    # Function to rebuild index.txt from the segments (after losing or
+    # damaging it); the last record for a key wins
+    def reindex(self):
+        with self._lock:
+            os.makedirs(self.path, exist_ok=True)
+            with open(self._file_path(LOCK_FILE), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    index = {}
+                    for segment in self._segments():
+                        for key, offset, _ in self._scan_segment(segment):
+                            index[key] = (segment, offset)
+                    index_path = self._file_path(INDEX_FILE)
+                    temp_path = f"{index_path}.{os.getpid()}.tmp"
+                    with open(temp_path, 'w') as index_file:
+                        for key, (segment, offset) in index.items():
+                            index_file.write(f"{key} {segment} {offset}\n")
+                    os.replace(temp_path, index_path)
+                    self._reset_index()
+                    self._refresh_index()
+                    return len(index)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # Function to summarize the store: documents, segments and bytes on disk
+    def stats(self):
+        segments = self._segments()
+        return {
+            "documents": len(self),
+            "segments": len(segments),
+            "bytes": sum(os.path.getsize(self._segment_path(segment)) for segment in segments),
+        }
+
+    def close(self):
+        with self._lock:
+            self._close_maps()
+
+
+_text_store = None
+_text_store_pid = None
+
+
+# Function to get this process's handle on the text store
+def get_text_store():
+    global _text_store, _text_store_pid
+    if _text_store is None or _text_store_pid != os.getpid():
+        _text_store = TextStore()
+        _text_store_pid = os.getpid()
+    return _text_store
+
+
+# Function to re-run the summarizer over every stored text and update the
+# documents with that hash in MongoDB; no PDF is parsed again
+def resummarize(store, limit=None):
+    from summarization import summarize_text
+    from mongodb_utils import update_documents_by_sha256
+
+    count = 0
+    for key, text in store.iter_texts():
+        timings = {}
+        summary, keywords = summarize_text(text, timings=timings)
+        update_documents_by_sha256(key, summary, keywords, timings["summarize"] + timings["keywords"])
+        count += 1
+        if limit and count >= limit:
+            break
+    logging.info(f"Re-summarized {count} documents from {store.path}")
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the compressed store of parsed document text.")
+    parser.add_argument("--store", default=TEXT_STORE_DIR, help="Store directory (default: %(default)s)")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    subcommands.add_parser("stats", help="Show document, segment and byte counts")
+    get = subcommands.add_parser("get", help="Print one document's text")
+    get.add_argument("key", help="Document hash (SHA-256 of the PDF bytes)")
+    subcommands.add_parser("reindex", help="Rebuild the offset index from the segments")
+    subcommands.add_parser("rebuild-df", help="Rebuild the document-frequency index from the stored texts")
+    resummarize_parser = subcommands.add_parser("resummarize", help="Re-summarize every stored text and update MongoDB")
+    resummarize_parser.add_argument("--limit", type=int, help="Stop after this many documents")
+    args = parser.parse_args()
+
+    text_store = TextStore(args.store)
+    if args.command != "reindex" and not text_store.exists():
+        sys.exit(f"No text store at {args.store}")
+    if args.command == "stats":
+        stats = text_store.stats()
+        print(f"{stats['documents']} documents, {stats['segments']} segments, {stats['bytes']} bytes")
+    elif args.command == "get":
+        text = text_store.get(args.key)
+        if text is None:
+            sys.exit(f"No text for {args.key}")
+        sys.stdout.write(text)
+    elif args.command == "reindex":
+        print(f"Indexed {text_store.reindex()} documents in {args.store}")
+    elif args.command == "rebuild-df":
+        from df_index import rebuild_index, DF_INDEX_DIR
+        print(f"Indexed {rebuild_index(text_store.iter_texts())} documents into {DF_INDEX_DIR}")
+    else:
+        print(f"Re-summarized {resummarize(text_store, args.limit)} documents")